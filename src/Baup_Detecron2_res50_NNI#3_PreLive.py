@@ -8,13 +8,16 @@ import random, cv2
 import matplotlib.pyplot as plt
 import numpy as np
 import pycocotools.mask as mask_util
+from toolbox.metric_box.competition_metric import iou_map
+from toolbox.metric_box.gt_cache import GTCache
+from toolbox.rle_box.rle_ops import InstanceRuns
 # import some common detectron2 utilities
 from detectron2 import model_zoo
 from detectron2.engine import DefaultPredictor, DefaultTrainer
 from detectron2.config import get_cfg
 from detectron2.utils.visualizer import Visualizer, ColorMode
 from detectron2.data import MetadataCatalog, DatasetCatalog
-from detectron2.data.datasets import register_coco_instances
+from toolbox.data_box.dataset_dicts import register_coco_instances
 from detectron2.utils.logger import setup_logger
 from detectron2.evaluation.evaluator import DatasetEvaluator
 import albumentations as A
@@ -35,46 +38,30 @@ matrix_fold_id = 0
 
 ## 注册  评估流程
 
-# Taken from https://www.kaggle.com/theoviel/competition-metric-map-iou
-def precision_at(threshold, iou):
-    matches = iou > threshold
-    true_positives = np.sum(matches, axis=1) == 1  # Correct objects
-    false_positives = np.sum(matches, axis=0) == 0  # Missed objects
-    false_negatives = np.sum(matches, axis=1) == 0  # Extra objects
-    return np.sum(true_positives), np.sum(false_positives), np.sum(false_negatives)
-
 def score(pred, targ):
     # pred_masks = pred['instances'].pred_masks.cpu().numpy()
 
     pred_class = torch.mode(pred['instances'].pred_classes)[0]
     take = pred['instances'].scores >= SCORE_THRESHOLDS[pred_class]
     pred_masks = pred['instances'].pred_masks[take]
-    pred_masks = pred_masks.cpu().numpy()
-
-    masks_after_threshold = []
-    for mask in pred_masks:
-        if mask.sum() >= MIN_PIXELS[pred_class]: # skip predictions with small area
-            masks_after_threshold.append(mask)
+    # 在 mask 所在的设备上编码成游程, 面积直接由游程长度求和, 不再对每个稠密 mask 调用 mask.sum()
+    pred_runs = InstanceRuns.from_dense(pred_masks)
+    pred_runs = pred_runs.select(pred_runs.areas() >= MIN_PIXELS[pred_class]) # skip predictions with small area
     
-    if masks_after_threshold == []:
+    if len(pred_runs) == 0:
         return 0
     
-    enc_preds = [mask_util.encode(np.asarray(p, order='F')) for p in masks_after_threshold]
+    enc_preds = pred_runs.to_coco()
 
     # enc_preds = [mask_util.encode(np.asarray(p, order='F')) for p in pred_masks]
     enc_targs = list(map(lambda x:x['segmentation'], targ))
     ious = mask_util.iou(enc_preds, enc_targs, [0]*len(enc_targs))
-    prec = []
-    for t in np.arange(0.5, 1.0, 0.05):
-        tp, fp, fn = precision_at(t, ious)
-        p = tp / (tp + fp + fn)
-        prec.append(p)
-    return np.mean(prec)
+    return iou_map(ious, strict=True)
 
 class MAPIOUEvaluator(DatasetEvaluator):
     def __init__(self, dataset_name):
-        dataset_dicts = DatasetCatalog.get(dataset_name)
-        self.annotations_cache = {item['image_id']:item['annotations'] for item in dataset_dicts}
+        # GT 预先解码后按标注文件哈希缓存在磁盘上, 每个 EVAL_PERIOD 重建 evaluator 时只需 mmap
+        self.annotations_cache = GTCache.from_dataset(dataset_name)
             
     def reset(self):
         self.scores = []
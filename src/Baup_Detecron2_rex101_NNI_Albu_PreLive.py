@@ -8,13 +8,17 @@ import random, cv2
 import matplotlib.pyplot as plt
 import numpy as np
 import pycocotools.mask as mask_util
+from toolbox.data_box.albu_mapper import AlbuDatasetMapper
+from toolbox.metric_box.competition_metric import iou_map
+from toolbox.metric_box.gt_cache import GTCache
+from toolbox.rle_box.rle_ops import InstanceRuns
 # import some common detectron2 utilities
 from detectron2 import model_zoo
 from detectron2.engine import DefaultPredictor, DefaultTrainer
 from detectron2.config import get_cfg
 from detectron2.utils.visualizer import Visualizer, ColorMode
-from detectron2.data import MetadataCatalog, DatasetCatalog
-from detectron2.data.datasets import register_coco_instances
+from detectron2.data import MetadataCatalog, DatasetCatalog, build_detection_train_loader
+from toolbox.data_box.dataset_dicts import register_coco_instances
 from detectron2.utils.logger import setup_logger
 from detectron2.evaluation.evaluator import DatasetEvaluator
 import albumentations as A
@@ -30,51 +34,49 @@ import glob
 
 SCORE_THRESHOLDS = [.15, .3, .55]
 MIN_PIXELS = [60, 120, 60]
+# 在 DataLoader worker 里现做 albumentations 增强 (AlbuDatasetMapper), 不再读入离线生成的 albu_bie 副本数据集
+ALBU_ON_THE_FLY = False
+# 整体 p=0.5: 一半样本保持原样, 与原图 + 一份增强副本混合训练的比例相同
+ALBU_TRANSFORM = A.Compose([
+    A.VerticalFlip(p=0.5),
+    A.HorizontalFlip(p=0.5),
+    A.ShiftScaleRotate(shift_limit=0.0625, scale_limit=0.1, rotate_limit=30, border_mode=cv2.BORDER_CONSTANT,
+                       value=0, mask_value=0, p=0.5),
+    A.OneOf([
+        A.RandomGamma(p=1),
+        A.GaussNoise(p=1)
+    ], p=0.20),
+    A.RandomBrightnessContrast(brightness_limit=0.4, p=0.20),
+], p=0.5)
 matrix = [[],[],[],[],[]]
 matrix_fold_id = 0
 
 ## 注册  评估流程
 
-# Taken from https://www.kaggle.com/theoviel/competition-metric-map-iou
-def precision_at(threshold, iou):
-    matches = iou > threshold
-    true_positives = np.sum(matches, axis=1) == 1  # Correct objects
-    false_positives = np.sum(matches, axis=0) == 0  # Missed objects
-    false_negatives = np.sum(matches, axis=1) == 0  # Extra objects
-    return np.sum(true_positives), np.sum(false_positives), np.sum(false_negatives)
-
 def score(pred, targ):
     # pred_masks = pred['instances'].pred_masks.cpu().numpy()
 
     pred_class = torch.mode(pred['instances'].pred_classes)[0]
     take = pred['instances'].scores >= SCORE_THRESHOLDS[pred_class]
     pred_masks = pred['instances'].pred_masks[take]
-    pred_masks = pred_masks.cpu().numpy()
-
-    masks_after_threshold = []
-    for mask in pred_masks:
-        if mask.sum() >= MIN_PIXELS[pred_class]: # skip predictions with small area
-            masks_after_threshold.append(mask)
+    # 在 mask 所在的设备上编码成游程, 面积直接由游程长度求和, 不再对每个稠密 mask 调用 mask.sum()
+    pred_runs = InstanceRuns.from_dense(pred_masks)
+    pred_runs = pred_runs.select(pred_runs.areas() >= MIN_PIXELS[pred_class]) # skip predictions with small area
     
-    if masks_after_threshold == []:
+    if len(pred_runs) == 0:
         return 0
     
-    enc_preds = [mask_util.encode(np.asarray(p, order='F')) for p in masks_after_threshold]
+    enc_preds = pred_runs.to_coco()
 
     # enc_preds = [mask_util.encode(np.asarray(p, order='F')) for p in pred_masks]
     enc_targs = list(map(lambda x:x['segmentation'], targ))
     ious = mask_util.iou(enc_preds, enc_targs, [0]*len(enc_targs))
-    prec = []
-    for t in np.arange(0.5, 1.0, 0.05):
-        tp, fp, fn = precision_at(t, ious)
-        p = tp / (tp + fp + fn)
-        prec.append(p)
-    return np.mean(prec)
+    return iou_map(ious, strict=True)
 
 class MAPIOUEvaluator(DatasetEvaluator):
     def __init__(self, dataset_name):
-        dataset_dicts = DatasetCatalog.get(dataset_name)
-        self.annotations_cache = {item['image_id']:item['annotations'] for item in dataset_dicts}
+        # GT 预先解码后按标注文件哈希缓存在磁盘上, 每个 EVAL_PERIOD 重建 evaluator 时只需 mmap
+        self.annotations_cache = GTCache.from_dataset(dataset_name)
             
     def reset(self):
         self.scores = []
@@ -95,6 +97,12 @@ class MAPIOUEvaluator(DatasetEvaluator):
         return {"MaP IoU": np.mean(self.scores)}
 
 class Trainer(DefaultTrainer):
+    @classmethod
+    def build_train_loader(cls, cfg):
+        if ALBU_ON_THE_FLY:
+            return build_detection_train_loader(cfg, mapper=AlbuDatasetMapper(cfg, ALBU_TRANSFORM, seed=max(cfg.SEED, 0)))
+        return super().build_train_loader(cfg)
+
     @classmethod
     def build_evaluator(cls, cfg, dataset_name, output_folder=None):
         return MAPIOUEvaluator(dataset_name)
@@ -135,10 +143,14 @@ def Train_Per_Fold(fold_id,args):
     cfg.OUTPUT_DIR  = './{}/{}'.format(current_ex_id,current_trail_id)
     cfg.INPUT.MASK_FORMAT='bitmask'
     register_coco_instances('sartorius_train{}'.format(fold_id),{}, '../data/starious_bie_annotations_train_fold{}.json'.format(fold_id), dataDir)
-    register_coco_instances('sartorius_albu{}'.format(fold_id),{},'../data/albu_bie_annotations_train_fold{}.json'.format(fold_id), dataDir)
+    if not ALBU_ON_THE_FLY:
+        register_coco_instances('sartorius_albu{}'.format(fold_id),{},'../data/albu_bie_annotations_train_fold{}.json'.format(fold_id), dataDir)
     register_coco_instances('sartorius_val{}'.format(fold_id),{},'../data/starious_bie_annotations_val_fold{}.json'.format(fold_id), dataDir)
 
-    cfg.DATASETS.TRAIN = ('sartorius_train{}'.format(fold_id),'sartorius_albu{}'.format(fold_id),)
+    if ALBU_ON_THE_FLY:
+        cfg.DATASETS.TRAIN = ('sartorius_train{}'.format(fold_id),)
+    else:
+        cfg.DATASETS.TRAIN = ('sartorius_train{}'.format(fold_id),'sartorius_albu{}'.format(fold_id),)
     cfg.DATASETS.TEST = ('sartorius_val{}'.format(fold_id),)
 
     cfg.DATALOADER.NUM_WORKERS = 2
@@ -150,7 +162,11 @@ def Train_Per_Fold(fold_id,args):
     cfg.SOLVER.CHECKPOINT_PERIOD = 1000 # Once per epoch
     cfg.MODEL.ROI_HEADS.BATCH_SIZE_PER_IMAGE = 256 
     cfg.MODEL.ROI_HEADS.NUM_CLASSES = 3  
-    cfg.TEST.EVAL_PERIOD = (len(DatasetCatalog.get('sartorius_train{}'.format(fold_id))) +len(DatasetCatalog.get('sartorius_albu{}'.format(fold_id))) ) // cfg.SOLVER.IMS_PER_BATCH  # Once per epoch
+    if ALBU_ON_THE_FLY:
+        # 与原来 原图 + 增强副本 的一个 epoch 步数相同
+        cfg.TEST.EVAL_PERIOD = 2 * len(DatasetCatalog.get('sartorius_train{}'.format(fold_id))) // cfg.SOLVER.IMS_PER_BATCH
+    else:
+        cfg.TEST.EVAL_PERIOD = (len(DatasetCatalog.get('sartorius_train{}'.format(fold_id))) +len(DatasetCatalog.get('sartorius_albu{}'.format(fold_id))) ) // cfg.SOLVER.IMS_PER_BATCH  # Once per epoch
     # 测试指标
 
     # os.makedirs(cfg.OUTPUT_DIR, exist_ok=True)
@@ -1,4 +1,5 @@
 import os
+import time
 
 os.environ['CUDA_VISIBLE_DEVICES'] = '2'
 from pathlib import Path
@@ -10,75 +11,20 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import pycocotools.mask as mask_util
+from toolbox.metric_box.competition_metric import iou_map
+from toolbox.metric_box.parallel_score import ScorePool
+from toolbox.metric_box.sparse_iou import InstanceCrops, sparse_mask_iou
+from toolbox.predict_box.batch_predictor import BatchPredictor, predict_batches
+from toolbox.predict_box.prediction_cache import PredictionCache
+from toolbox.rle_box.rle_ops import InstanceRuns
 import torch
 from detectron2 import model_zoo
 from detectron2.config import get_cfg
 from detectron2.data import DatasetCatalog
-from detectron2.data.datasets import register_coco_instances
+from toolbox.data_box.dataset_dicts import register_coco_instances
 from detectron2.engine import DefaultPredictor
 from PIL.ImageColor import getrgb
 
-def precision_at(threshold, iou):
-    """
-    Computes the precision at a given threshold.
-
-    Args:
-        threshold (float): Threshold.
-        iou (np array [n_truths x n_preds]): IoU matrix.
-
-    Returns:
-        int: Number of true positives,
-        int: Number of false positives,
-        int: Number of false negatives.
-    """
-    matches = iou > threshold
-    true_positives = np.sum(matches, axis=1) >= 1  # Correct objects
-    false_negatives = np.sum(matches, axis=1) == 0  # Missed objects
-    false_positives = np.sum(matches, axis=0) == 0  # Extra objects
-    tp, fp, fn = (
-        np.sum(true_positives),
-        np.sum(false_positives),
-        np.sum(false_negatives),
-    )
-    return tp, fp, fn
-
-
-def iou_map(ious,verbose=0):
-    """
-    Computes the metric for the competition.
-    Masks contain the segmented pixels where each object has one value associated,
-    and 0 is the background.
-
-    Args:
-        truths (list of masks): Ground truths.
-        preds (list of masks): Predictions.
-        verbose (int, optional): Whether to print infos. Defaults to 0.
-
-    Returns:
-        float: mAP.
-    """
-
-    if verbose:
-        print("Thresh\tTP\tFP\tFN\tPrec.")
-
-    prec = []
-    for t in np.arange(0.5, 1.0, 0.05):
-        tps, fps, fns = 0, 0, 0
-        tp, fp, fn = precision_at(t, ious)
-        tps += tp
-        fps += fp
-        fns += fn
-
-        p = tps / (tps + fps + fns)
-        prec.append(p)
-
-        if verbose:
-            print("{:1.3f}\t{}\t{}\t{}\t{:1.3f}".format(t, tps, fps, fns, p))
-
-    if verbose:
-        print("AP\t-\t-\t-\t{:1.3f}".format(np.mean(prec)))
-
-    return np.mean(prec)
 ######################################################################修改一下的参数#################################################################################
 # # Only For MR_RES50
 SCORE_THRESHOLDS =[0.15,0.30,0.55]
@@ -88,42 +34,43 @@ MIN_PIXELS = [60, 140, 75]
 # SCORE_THRESHOLDS =[0.25,0.45,0.65]
 # MIN_PIXELS = [60, 140, 75]
 
+# 评分用的线程数 0 表示串行
+NUM_WORKERS = 4
+# 每次送入模型的图片数, 下一组图片在后台线程读入并缩放; 预测转 RLE / 裁剪交给 NUM_WORKERS 个线程, 与下一组的前向重叠
+PREDICT_BATCH_SIZE = 4
 
-# 法1： 不论输出的是什么类别 只要有mask 一律添加到最终输出
-def score_method1(pred, targ):
-
-    # pred_masks = pred['instances'].pred_masks.cpu().numpy()
+# 原始预测的磁盘缓存 同一个 checkpoint + 验证集 + cfg 只推理一次
+PRED_CACHE_DIR = '../pred_cache'
+VAL_JSON = '../data/2021_new_split_val_fold1.json'
 
 
-    # pred_class_labels = pd.Series(pred['instances'].pred_classes.cpu().numpy()).value_counts()
-    # pred_class = pred_class_labels.sort_values().index[-1]
-    pred_class = torch.mode(pred['instances'].pred_classes)[0]
-    take = pred['instances'].scores >= SCORE_THRESHOLDS[pred_class]
-    pred_masks = pred['instances'].pred_masks[take]
-    pred_masks = pred_masks.cpu().numpy()
+# GT 的裁剪块按图片缓存 多个 checkpoint 之间复用
+gt_crops_cache = {}
+def get_gt_crops(targ):
+    if targ['file_name'] not in gt_crops_cache:
+        enc_targs = list(map(lambda x:x['segmentation'], targ['annotations']))
+        gt_crops_cache[targ['file_name']] = InstanceCrops.from_rles(enc_targs)
+    return gt_crops_cache[targ['file_name']]
 
+# 法1： 不论输出的是什么类别 只要有mask 一律添加到最终输出
+# pred 为 PredictionCache.get() 回放的原始预测, 换阈值 / MIN_PIXELS 不需要重新推理
+def score_method1(pred, targ, image_id):
 
-    # masks_after_threshold = []
-    # for mask in pred_masks:
-    #     masks_after_threshold.append(np.where(mask > MASK_THRESHOLDS[pred_class],1,0).astype(np.uint8))
-
-    # if masks_after_threshold == []:
-    #     return 0
+    if len(pred['classes']) == 0:
+        return 0
+    # 与 torch.mode 相同: 出现最多的类别, 并列时取较小的类别
+    pred_class = np.bincount(pred['classes']).argmax()
+    take = pred['scores'] >= SCORE_THRESHOLDS[pred_class]
 
-    masks_after_threshold = []
-    for mask in pred_masks:
-        if mask.sum() >= MIN_PIXELS[pred_class]: # skip predictions with small area
-            masks_after_threshold.append(mask)
+    keep = take & (pred['areas'] >= MIN_PIXELS[pred_class]) # skip predictions with small area
     
-    if masks_after_threshold == []:
+    if not keep.any():
         return 0
     
 
-    enc_preds = [mask_util.encode(np.asarray(p, order='F')) for p in masks_after_threshold]
-
-    # # enc_preds = [mask_util.encode(np.asarray(p, order='F')) for p in pred_masks]
-    enc_targs = list(map(lambda x:x['segmentation'], targ['annotations']))
-    ious = mask_util.iou(enc_preds, enc_targs, [0]*len(enc_targs))
+    # 只对 bbox 有重叠的 (pred, GT) 计算 IoU, 裁剪块直接从缓存解包, 不再对每个预测 mask 做 RLE 编码
+    pred_crops = pred_cache.crops(image_id, keep=keep)
+    ious = sparse_mask_iou(pred_crops, get_gt_crops(targ))
     # print(ious)
     # prec = []
     # for t in np.arange(0.5, 1.0, 0.05):
@@ -166,7 +113,6 @@ def score_method2(pred, targ):
 
     take = pred_scores >= SCORE_THRESHOLDS[pred_class]
     pred_masks = pred_masks[take]
-    pred_masks = pred_masks.cpu().numpy()
     pred_scores = pred_scores[take]
     pred_scores = pred_scores.cpu().numpy()
 
@@ -177,15 +123,14 @@ def score_method2(pred, targ):
     # if masks_after_threshold == []:
     #     return 0
 
-    masks_after_threshold = []
-    for mask in pred_masks:
-        if mask.sum() >= MIN_PIXELS[pred_class]: # skip predictions with small area
-            masks_after_threshold.append(mask)
+    # 在 mask 所在的设备上编码成游程, 面积直接由游程长度求和, 不再对每个稠密 mask 调用 mask.sum()
+    pred_runs = InstanceRuns.from_dense(pred_masks)
+    pred_runs = pred_runs.select(pred_runs.areas() >= MIN_PIXELS[pred_class]) # skip predictions with small area
     
-    if masks_after_threshold == []:
+    if len(pred_runs) == 0:
         return 0
 
-    enc_preds = [mask_util.encode(np.asarray(p, order='F')) for p in masks_after_threshold]
+    enc_preds = pred_runs.to_coco()
     
     # # enc_preds = [mask_util.encode(np.asarray(p, order='F')) for p in pred_masks]
     enc_targs = list(map(lambda x:x['segmentation'], targ['annotations']))
@@ -207,14 +152,14 @@ def score_method2(pred, targ):
     table.loc[targ['file_name'],"predic_cell"] = LookupTable[pred_class]
     table.loc[targ['file_name'],"truth_cell"] = LookupTable[targ['annotations'][0]['category_id']]
     table.loc[targ['file_name'],"predic_nums_before_clean"] = pred['instances'].pred_masks.shape[0]
-    table.loc[targ['file_name'],"predic_nums_after_all"] = len(masks_after_threshold)
+    table.loc[targ['file_name'],"predic_nums_after_all"] = len(pred_runs)
     table.loc[targ['file_name'],"truth_num"] = len(targ['annotations'])
 
     # 生成图片
     image = cv2.imread(targ['file_name'])
 
     
-    Predict_masks = np.stack(masks_after_threshold)
+    Predict_masks = pred_runs.to_dense()
     layer0 = np.zeros_like(image)
     for mask in Predict_masks: 
         cont, hier = cv2.findContours(mask.astype('uint8'),cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
@@ -235,17 +180,23 @@ def score_method2(pred, targ):
 
     return score_image
 
-def score_all():
-    scores = []
-    for idx,item in enumerate(val_ds):
-        im =  cv2.imread(item['file_name'])
-        pred = predictor(im)   
+def predict_all():
+    # 只有缓存不存在时才会构建模型并推理
+    predictor = BatchPredictor.from_cfg(cfg)
+    start = time.perf_counter()
+    for idx,(item, pred) in enumerate(predict_batches(predictor, val_ds, lambda item: cv2.imread(item['file_name']), PREDICT_BATCH_SIZE)):
         print("{}/{}".format(idx+1,len(val_ds)))    
-        
-        sc = score_method1(pred, item)
-        scores.append(sc)
-        
-        # break
+        yield item['image_id'], pred['instances']
+    print("{:.2f} images/s".format(len(val_ds) / (time.perf_counter() - start)))
+
+def score_all():
+    global pred_cache
+    # 原始预测按 (checkpoint 内容, 验证集, cfg) 缓存到磁盘, 之后的评分全部从磁盘回放
+    pred_cache = PredictionCache.load_or_predict(PRED_CACHE_DIR, cfg.MODEL.WEIGHTS, VAL_JSON, cfg.dump(), predict_all,
+                                                 num_workers=NUM_WORKERS)
+    jobs = ((pred_cache.get(item['image_id']), item, item['image_id']) for item in val_ds)
+    # 分数按 val_ds 的顺序返回
+    scores = ScorePool(NUM_WORKERS, pool_type='thread', chunk_size=1, max_pending=NUM_WORKERS).map(score_method1, jobs)
     return np.mean(scores)
 
 
@@ -255,7 +206,7 @@ import glob
 pth_names = glob.glob("/storage/Kaggle_Cell_Segmentation/model/MaskRNN/test34/model_best_fold1.pth")
 print(pth_names)
 pth_scroe_table = pd.DataFrame()
-register_coco_instances('sartorius_val',{},'../data/2021_new_split_val_fold1.json', 
+register_coco_instances('sartorius_val',{},VAL_JSON, 
                         '../data/')
 
 # Vis_Path = "./res101x_PreLiveCell_vis_fold5"
@@ -311,7 +262,6 @@ for idx,pth_name in enumerate(pth_names):
     # cfg.MODEL.WEIGHTS = '/storage/Kaggle_Cell_Segmentation/src/q6PT7AnE/HbYPx/fold5/model_best_fold5.pth'
     cfg.MODEL.WEIGHTS = pth_name
     # cfg.MODEL.ROI_HEADS.BATCH_SIZE_PER_IMAGE = 128  
-    predictor = DefaultPredictor(cfg)
 
     val_ds = DatasetCatalog.get('sartorius_val')
 
@@ -10,13 +10,15 @@ import random, cv2
 import matplotlib.pyplot as plt
 import numpy as np
 import pycocotools.mask as mask_util
+from toolbox.metric_box.competition_metric import iou_map
+from toolbox.metric_box.gt_cache import GTCache
 # import some common detectron2 utilities
 from detectron2 import model_zoo
 from detectron2.engine import DefaultPredictor, DefaultTrainer
 from detectron2.config import get_cfg
 from detectron2.utils.visualizer import Visualizer, ColorMode
 from detectron2.data import MetadataCatalog, DatasetCatalog
-from detectron2.data.datasets import register_coco_instances
+from toolbox.data_box.dataset_dicts import register_coco_instances
 from detectron2.utils.logger import setup_logger
 from detectron2.evaluation.evaluator import DatasetEvaluator
 import albumentations as A
@@ -39,7 +41,6 @@ from detectron2.checkpoint import DetectionCheckpointer
 from detectron2.config import get_cfg
 from detectron2.data import MetadataCatalog
 from detectron2.engine import DefaultTrainer, default_argument_parser, default_setup, hooks, launch
-from detectron2.structures import polygons_to_bitmask
 
 # from toolbox.starious_coco_evaluator.coco_evaluation import COCOEvaluator
 
@@ -47,38 +48,18 @@ matrix = [[],[],[],[],[]]
 matrix_fold_id = 0
 
 ## 注册  评估流程
-def polygon_to_rle(polygon, shape=(520, 704)):
-    #print(polygon)
-    mask = polygons_to_bitmask([np.asarray(polygon) + 0.25], shape[0], shape[1])
-
-    rle = mask_util.encode(np.asfortranarray(mask))
-    return rle
-
-# Taken from https://www.kaggle.com/theoviel/competition-metric-map-iou
-def precision_at(threshold, iou):
-    matches = iou > threshold
-    true_positives = np.sum(matches, axis=1) == 1  # Correct objects
-    false_positives = np.sum(matches, axis=0) == 0  # Missed objects
-    false_negatives = np.sum(matches, axis=1) == 0  # Extra objects
-    return np.sum(true_positives), np.sum(false_positives), np.sum(false_negatives)
-
 def score(pred, targ):
     pred_masks = pred['instances'].pred_masks.cpu().numpy()
     enc_preds = [mask_util.encode(np.asarray(p, order='F')) for p in pred_masks]
+    # GTCache 里的 segmentation 已经是压缩 RLE, 直接交给 mask_util.iou
     enc_targs = list(map(lambda x:x['segmentation'], targ))
-    enc_targs = [polygon_to_rle(enc_targ[0]) for enc_targ in enc_targs]
     ious = mask_util.iou(enc_preds, enc_targs, [0]*len(enc_targs))
-    prec = []
-    for t in np.arange(0.5, 1.0, 0.05):
-        tp, fp, fn = precision_at(t, ious)
-        p = tp / (tp + fp + fn)
-        prec.append(p)
-    return np.mean(prec)
+    return iou_map(ious, strict=True)
 
 class MAPIOUEvaluator(DatasetEvaluator):
     def __init__(self, dataset_name):
-        dataset_dicts = DatasetCatalog.get(dataset_name)
-        self.annotations_cache = {item['image_id']:item['annotations'] for item in dataset_dicts}
+        # GT 预先解码后按标注文件哈希缓存在磁盘上, 每个 EVAL_PERIOD 重建 evaluator 时只需 mmap
+        self.annotations_cache = GTCache.from_dataset(dataset_name)
             
     def reset(self):
         self.scores = []
@@ -16,13 +16,16 @@ import random, cv2
 import matplotlib.pyplot as plt
 import numpy as np
 import pycocotools.mask as mask_util
+from toolbox.metric_box.competition_metric import iou_map
+from toolbox.metric_box.gt_cache import GTCache
+from toolbox.rle_box.rle_ops import InstanceRuns
 # import some common detectron2 utilities
 from detectron2 import model_zoo
 from detectron2.engine import DefaultPredictor, DefaultTrainer
 from detectron2.config import get_cfg
 from detectron2.utils.visualizer import Visualizer, ColorMode
 from detectron2.data import MetadataCatalog, DatasetCatalog
-from detectron2.data.datasets import register_coco_instances
+from toolbox.data_box.dataset_dicts import register_coco_instances
 from detectron2.utils.logger import setup_logger
 from detectron2.evaluation.evaluator import DatasetEvaluator
 import albumentations as A
@@ -57,67 +60,6 @@ matrix = [[],[],[],[],[]]
 matrix_fold_id = 0
 
 ####################################################################################################################################################################
-def precision_at(threshold, iou):
-    """
-    Computes the precision at a given threshold.
-
-    Args:
-        threshold (float): Threshold.
-        iou (np array [n_truths x n_preds]): IoU matrix.
-
-    Returns:
-        int: Number of true positives,
-        int: Number of false positives,
-        int: Number of false negatives.
-    """
-    matches = iou > threshold
-    true_positives = np.sum(matches, axis=1) >= 1  # Correct objects
-    false_negatives = np.sum(matches, axis=1) == 0  # Missed objects
-    false_positives = np.sum(matches, axis=0) == 0  # Extra objects
-    tp, fp, fn = (
-        np.sum(true_positives),
-        np.sum(false_positives),
-        np.sum(false_negatives),
-    )
-    return tp, fp, fn
-
-
-def iou_map(ious,verbose=0):
-    """
-    Computes the metric for the competition.
-    Masks contain the segmented pixels where each object has one value associated,
-    and 0 is the background.
-
-    Args:
-        truths (list of masks): Ground truths.
-        preds (list of masks): Predictions.
-        verbose (int, optional): Whether to print infos. Defaults to 0.
-
-    Returns:
-        float: mAP.
-    """
-
-    if verbose:
-        print("Thresh\tTP\tFP\tFN\tPrec.")
-
-    prec = []
-    for t in np.arange(0.5, 1.0, 0.05):
-        tps, fps, fns = 0, 0, 0
-        tp, fp, fn = precision_at(t, ious)
-        tps += tp
-        fps += fp
-        fns += fn
-
-        p = tps / (tps + fps + fns)
-        prec.append(p)
-
-        if verbose:
-            print("{:1.3f}\t{}\t{}\t{}\t{:1.3f}".format(t, tps, fps, fns, p))
-
-    if verbose:
-        print("AP\t-\t-\t-\t{:1.3f}".format(np.mean(prec)))
-
-    return np.mean(prec)
 ######################################################################修改一下的参数#################################################################################
 ## 注册  评估流程
 def score(pred, targ):
@@ -131,17 +73,14 @@ def score(pred, targ):
     take = take_mojorities & take
 
     pred_masks = pred['instances'].pred_masks[take]
-    pred_masks = pred_masks.cpu().numpy()
-
-    masks_after_threshold = []
-    for mask in pred_masks:
-        if mask.sum() >= MIN_PIXELS[pred_class]: # skip predictions with small area
-            masks_after_threshold.append(mask)
+    # 在 mask 所在的设备上编码成游程, 面积直接由游程长度求和, 不再对每个稠密 mask 调用 mask.sum()
+    pred_runs = InstanceRuns.from_dense(pred_masks)
+    pred_runs = pred_runs.select(pred_runs.areas() >= MIN_PIXELS[pred_class]) # skip predictions with small area
     
-    if masks_after_threshold == []:
+    if len(pred_runs) == 0:
         return 0
     
-    enc_preds = [mask_util.encode(np.asarray(p, order='F')) for p in masks_after_threshold]
+    enc_preds = pred_runs.to_coco()
 
     # enc_preds = [mask_util.encode(np.asarray(p, order='F')) for p in pred_masks]
     enc_targs = list(map(lambda x:x['segmentation'], targ))
@@ -150,8 +89,8 @@ def score(pred, targ):
 
 class MAPIOUEvaluator(DatasetEvaluator):
     def __init__(self, dataset_name):
-        dataset_dicts = DatasetCatalog.get(dataset_name)
-        self.annotations_cache = {item['image_id']:item['annotations'] for item in dataset_dicts}
+        # GT 预先解码后按标注文件哈希缓存在磁盘上, 每个 EVAL_PERIOD 重建 evaluator 时只需 mmap
+        self.annotations_cache = GTCache.from_dataset(dataset_name)
             
     def reset(self):
         self.scores = []
@@ -0,0 +1,76 @@
+# 此文件用于生成 kaggle 提交的 submission.csv
+# 测试图逐张推理, 预测交给 SubmissionWriter 流式去重叠、编码并逐行写入, 内存只与在处理的几张图有关
+import os
+os.environ['CUDA_VISIBLE_DEVICES'] = '0'
+import glob
+
+import cv2
+from detectron2 import model_zoo
+from detectron2.config import get_cfg
+from toolbox.data_box.grayscale import to_grayscale_cfg
+from toolbox.predict_box.batch_predictor import BatchPredictor
+from toolbox.predict_box.submission_writer import SubmissionWriter
+
+######################################################################修改一下的参数#################################################################################
+PTH_NAME = "/storage/Kaggle_Cell_Segmentation/model/MaskRNN/test34/model_best_fold1.pth"
+TEST_DIR = '../data/test'
+SUBMISSION = './submission.csv'
+SCORE_THRESHOLDS = [0.15, 0.30, 0.55]
+MIN_PIXELS = [60, 140, 75]
+# 去重叠 + 编码的进程数 0 表示串行 (默认); 每张图要把整张的 mask 发给子进程, 实测比串行慢, 只在 CPU 多且推理是瓶颈时再打开
+NUM_WORKERS = 0
+# 单通道推理, RGB 训练的权重加载时折叠 stem, 结果与 3 通道相同
+GRAYSCALE = False
+
+
+cfg = get_cfg()
+cfg.merge_from_file(model_zoo.get_config_file("COCO-InstanceSegmentation/mask_rcnn_R_50_FPN_3x.yaml"))
+cfg.INPUT.MASK_FORMAT='bitmask'
+
+# MODEL
+######################################################################################################################################################
+cfg.MODEL.RESNETS.DEFORM_MODULATED = True
+cfg.MODEL.RESNETS.DEFORM_NUM_GROUPS = 2
+cfg.MODEL.RESNETS.DEFORM_ON_PER_STAGE = [False, True, True, True]
+
+cfg.MODEL.BACKBONE.FREEZE_AT = 0
+cfg.MODEL.RESNETS.NORM = "SyncBN"
+cfg.MODEL.RESNETS.STRIDE_IN_1X1 = False
+cfg.MODEL.FPN.NORM = "SyncBN"
+cfg.MODEL.ANCHOR_GENERATOR.SIZES = [[9], [17], [31], [64], [127]]
+cfg.MODEL.ANCHOR_GENERATOR.ASPECT_RATIOS = [[0.25, 0.5, 1.0, 2.0, 4.0]]
+cfg.MODEL.ROI_HEADS.BATCH_SIZE_PER_IMAGE = 512
+cfg.MODEL.ROI_HEADS.NAME = "CascadeROIHeads"
+cfg.MODEL.ROI_BOX_HEAD.NORM = "SyncBN"
+cfg.MODEL.ROI_BOX_HEAD.CLS_AGNOSTIC_BBOX_REG = True
+cfg.MODEL.ROI_BOX_HEAD.NUM_CONV = 4
+cfg.MODEL.ROI_BOX_HEAD.NUM_FC = 1
+cfg.MODEL.ROI_MASK_HEAD.NORM = "SyncBN"
+cfg.MODEL.ROI_MASK_HEAD.NUM_CONV= 8
+
+cfg.MODEL.RPN.BATCH_SIZE_PER_IMAGE = 256
+cfg.MODEL.PIXEL_MEAN = [128, 128, 128]
+cfg.MODEL.PIXEL_STD = [11.578, 11.578, 11.578]
+if GRAYSCALE:
+    to_grayscale_cfg(cfg)
+##########################################################################################################
+
+cfg.TEST.DETECTIONS_PER_IMAGE = 1000
+cfg.MODEL.ROI_HEADS.NUM_CLASSES = 3
+cfg.MODEL.WEIGHTS = PTH_NAME
+
+
+def predict_all(file_names):
+    # 生成器 每次只推理一张图; 预处理与 DefaultPredictor 相同, 但也接受单通道 ("L") 输入
+    predictor = BatchPredictor.from_cfg(cfg)
+    for idx, file_name in enumerate(file_names):
+        print("{}/{}".format(idx+1, len(file_names)))
+        image = cv2.imread(file_name, cv2.IMREAD_GRAYSCALE)[:, :, None] if GRAYSCALE else cv2.imread(file_name)
+        pred = predictor([image])[0]
+        yield os.path.splitext(os.path.basename(file_name))[0], pred['instances']
+
+
+test_files = sorted(glob.glob(os.path.join(TEST_DIR, '*.png')))
+writer = SubmissionWriter(SUBMISSION, SCORE_THRESHOLDS, MIN_PIXELS, num_workers=NUM_WORKERS)
+n_rows = writer.write(predict_all(test_files))
+print("{} rows of {} images written to {}".format(n_rows, len(test_files), SUBMISSION))
@@ -8,10 +8,13 @@ import torch
 from detectron2 import model_zoo
 from detectron2.engine import DefaultPredictor
 from detectron2.config import get_cfg
-from detectron2.data.datasets import register_coco_instances
+from toolbox.data_box.dataset_dicts import register_coco_instances
 from detectron2.data import DatasetCatalog
 import cv2
 import pycocotools.mask as mask_util
+from toolbox.metric_box.competition_metric import grid_iou_map, threshold_levels
+from toolbox.metric_box.sparse_iou import InstanceCrops, sparse_mask_iou
+from toolbox.predict_box.prediction_cache import PredictionCache
 import numpy as np
 from pathlib import Path
 from typing import Any, Iterator, List, Union
@@ -19,117 +22,46 @@ from tqdm.notebook import tqdm
 import json
 
 
-def precision_at(threshold, iou):
-    """
-    Computes the precision at a given threshold.
-
-    Args:
-        threshold (float): Threshold.
-        iou (np array [n_truths x n_preds]): IoU matrix.
-
-    Returns:
-        int: Number of true positives,
-        int: Number of false positives,
-        int: Number of false negatives.
-    """
-    matches = iou > threshold
-    true_positives = np.sum(matches, axis=1) >= 1  # Correct objects
-    false_negatives = np.sum(matches, axis=1) == 0  # Missed objects
-    false_positives = np.sum(matches, axis=0) == 0  # Extra objects
-    tp, fp, fn = (
-        np.sum(true_positives),
-        np.sum(false_positives),
-        np.sum(false_negatives),
-    )
-    return tp, fp, fn
-
-
-def iou_map(ious,verbose=0):
-    """
-    Computes the metric for the competition.
-    Masks contain the segmented pixels where each object has one value associated,
-    and 0 is the background.
-
-    Args:
-        truths (list of masks): Ground truths.
-        preds (list of masks): Predictions.
-        verbose (int, optional): Whether to print infos. Defaults to 0.
-
-    Returns:
-        float: mAP.
-    """
-
-    if verbose:
-        print("Thresh\tTP\tFP\tFN\tPrec.")
-
-    prec = []
-    for t in np.arange(0.5, 1.0, 0.05):
-        tps, fps, fns = 0, 0, 0
-        tp, fp, fn = precision_at(t, ious)
-        tps += tp
-        fps += fp
-        fns += fn
-
-        p = tps / (tps + fps + fns)
-        prec.append(p)
-
-        if verbose:
-            print("{:1.3f}\t{}\t{}\t{}\t{:1.3f}".format(t, tps, fps, fns, p))
-
-    if verbose:
-        print("AP\t-\t-\t-\t{:1.3f}".format(np.mean(prec)))
-
-    return np.mean(prec)
-
-def score(pred, targ):
-    # pred_masks = pred['instances'].pred_masks.cpu().numpy()
-    pred_masks = pred
-
-    enc_preds = [mask_util.encode(np.asarray(p, order='F')) for p in pred_masks]
-    enc_targs = list(map(lambda x:x['segmentation'], targ['annotations']))
-    # print(len(enc_targs)) For debug
-    ious = mask_util.iou(enc_preds, enc_targs, [0]*len(enc_targs))
-    # print(ious.shape)   For debug
-    return iou_map(ious)
+# GT 的裁剪块按图片缓存
+gt_crops_cache = {}
+def get_gt_crops(targ):
+    if targ['file_name'] not in gt_crops_cache:
+        enc_targs = list(map(lambda x:x['segmentation'], targ['annotations']))
+        gt_crops_cache[targ['file_name']] = InstanceCrops.from_rles(enc_targs)
+    return gt_crops_cache[targ['file_name']]
 
+# 网格: score 阈值 x 最小面积 (像素数)
+SCORE_GRID = np.arange(5,100,5)/100
+AREA_GRID = np.arange(5,100,5)
 
-def score_all():
+# 原始预测的磁盘缓存 同一个 checkpoint + 验证集 + cfg 只推理一次
+PRED_CACHE_DIR = '../pred_cache'
+VAL_JSON = '../data/2021_1cate_val_fold1.json'
+
+def predict_all():
+    # 只有缓存不存在时才会构建模型并推理
+    predictor = DefaultPredictor(cfg)
     for idx,item in enumerate(val_ds):
-        # check_list = []
-        # for elements in item["annotations"]:
-        #     check_list.append(elements["category_id"])
-        # print(len(np.unique(check_list)))
         print("{}/{}".format(idx+1,len(val_ds)))
 
         im =  cv2.imread(item['file_name'])
         pred = predictor(im)  
+        yield item['image_id'], pred['instances']
+
+def score_all():
+    # 网格搜索全部从磁盘回放, 不再调用模型
+    pred_cache = PredictionCache.load_or_predict(PRED_CACHE_DIR, cfg.MODEL.WEIGHTS, VAL_JSON, cfg.dump(), predict_all)
+    for idx,item in enumerate(val_ds):
+        print("{}/{}".format(idx+1,len(val_ds)))
+
+        pred = pred_cache.get(item['image_id'])
 
-        res_store_matrix = np.zeros(shape= [19,19])
-        for score_idx,score_threshold in enumerate(np.arange(5,100,5)):
-            SCORE_THRESHOLDS = score_threshold/100
-            take = pred['instances'].scores >= SCORE_THRESHOLDS
-            pred_masks = pred['instances'].pred_masks[take]
-            pred_masks = pred_masks.cpu().numpy()
-
-            # print(pred_masks.max())
-            # print(pred_masks.min())
-            # print(np.unique(pred_masks[0,::]))
-            for mask_idx,mask_threshold in enumerate(np.arange(5,100,5)):
-                MASK_THRESHOLDS = mask_threshold
-                masks_after_threshold = []
-                # 此时的 masks只剩 true 和 false 了
-                for mask in pred_masks:
-                    # print(np.unique(mask))
-                    # if mask >= MASK_THRESHOLDS[pred_class]: # skip predictions with small area
-                    if mask.sum() >= MASK_THRESHOLDS:
-                        masks_after_threshold.append(mask)
-                
-                if masks_after_threshold == []:
-                    sc = 0
-                else:
-                    mask_clean = np.stack(masks_after_threshold,axis = 0)
-                    sc = score(mask_clean, item)
-                res_store_matrix[score_idx,mask_idx] = sc
+        # 两个阈值都只是在取预测的子集: 每张图只算一次 IoU, 整个 19 x 19 网格由同一个 IoU 矩阵按行取子集一次性得到
+        ious = sparse_mask_iou(pred_cache.crops(item['image_id']), get_gt_crops(item))
+        res_store_matrix = grid_iou_map(ious,
+                                        threshold_levels(pred['scores'], SCORE_GRID),
+                                        threshold_levels(pred['areas'], AREA_GRID),
+                                        grid_shape=(len(SCORE_GRID),len(AREA_GRID)))
         
         scores.append(res_store_matrix.tolist())
         
@@ -178,10 +110,9 @@ cfg.MODEL.PIXEL_STD = [11.578, 11.578, 11.578]
 
 cfg.MODEL.ROI_HEADS.NUM_CLASSES = 3 
 cfg.MODEL.WEIGHTS = '/storage/Kaggle_Cell_Segmentation/model/MaskRNN/test29/model_best_fold1.pth'  
-predictor = DefaultPredictor(cfg)
 
 dataDir=Path('../data/')
-register_coco_instances('sartorius_val',{},'../data/2021_1cate_val_fold1.json', dataDir)
+register_coco_instances('sartorius_val',{},VAL_JSON, dataDir)
 
 val_ds = DatasetCatalog.get('sartorius_val')
 # 进行修正
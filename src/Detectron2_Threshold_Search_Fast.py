@@ -7,10 +7,13 @@ import torch
 from detectron2 import model_zoo
 from detectron2.engine import DefaultPredictor
 from detectron2.config import get_cfg
-from detectron2.data.datasets import register_coco_instances
+from toolbox.data_box.dataset_dicts import register_coco_instances
 from detectron2.data import DatasetCatalog
 import cv2
 import pycocotools.mask as mask_util
+from toolbox.metric_box.competition_metric import grid_iou_map, threshold_levels
+from toolbox.metric_box.sparse_iou import InstanceCrops, sparse_mask_iou
+from toolbox.predict_box.prediction_cache import PredictionCache
 import numpy as np
 from pathlib import Path
 from typing import Any, Iterator, List, Union
@@ -76,70 +79,53 @@ detectron2.layers.mask_ops.paste_masks_in_image.__code__ = paste_masks_in_image.
 
 
 
-def precision_at(threshold, iou):
-    matches = iou > threshold
-    true_positives = np.sum(matches, axis=1) >= 1  # Correct objects
-    false_positives = np.sum(matches, axis=0) == 0  # Missed objects
-    false_negatives = np.sum(matches, axis=1) == 0  # Extra objects
-    return np.sum(true_positives), np.sum(false_positives), np.sum(false_negatives)
+# GT 的裁剪块按图片缓存
+gt_crops_cache = {}
+def get_gt_crops(targ):
+    if targ['file_name'] not in gt_crops_cache:
+        enc_targs = list(map(lambda x:x['segmentation'], targ['annotations']))
+        gt_crops_cache[targ['file_name']] = InstanceCrops.from_rles(enc_targs)
+    return gt_crops_cache[targ['file_name']]
 
-def score(pred, targ):
-    # pred_masks = pred['instances'].pred_masks.cpu().numpy()
-    pred_masks = pred
+# 网格: score 阈值 x mask 二值化阈值
+SCORE_GRID = np.arange(5,100,5)/100
+MASK_GRID = np.arange(5,100,5)/100
 
-    enc_preds = [mask_util.encode(np.asarray(p, order='F')) for p in pred_masks]
-    enc_targs = list(map(lambda x:x['segmentation'], targ['annotations']))
-    # print(len(enc_targs)) For debug
-    ious = mask_util.iou(enc_preds, enc_targs, [0]*len(enc_targs))
-    # print(ious.shape)   For debug
-    prec = []
-    for t in np.arange(0.5, 1.0, 0.05):
-        tp, fp, fn = precision_at(t, ious)
-        p = tp / (tp + fp + fn)
-        prec.append(p)
-    return np.mean(prec)
+# 原始预测的磁盘缓存 同一个 checkpoint + 验证集 + cfg 只推理一次
+PRED_CACHE_DIR = '../pred_cache'
+VAL_JSON = '../data/starious_annotations_val_fold3.json'
 
-
-def score_all():
+def predict_all():
+    # 只有缓存不存在时才会构建模型并推理
+    predictor = DefaultPredictor(cfg)
     for idx,item in enumerate(val_ds):
-        # check_list = []
-        # for elements in item["annotations"]:
-        #     check_list.append(elements["category_id"])
-        # print(len(np.unique(check_list)))
         print("{}/{}".format(idx+1,len(val_ds)))
 
         im =  cv2.imread(item['file_name'])
         pred = predictor(im)  
-        pred_class_index = pred['instances'].pred_classes[0]
-        # print(pred_class_index)
-
-        pred_class = torch.mode(pred['instances'].pred_classes)[0]
-
-        res_store_matrix = np.zeros(shape= [19,19])
-        for score_idx,score_threshold in enumerate(np.arange(5,100,5)):
-            SCORE_THRESHOLDS = [score_threshold/100,score_threshold/100,score_threshold/100]
-            take = pred['instances'].scores >= SCORE_THRESHOLDS[pred_class]
-            pred_masks = pred['instances'].pred_masks[take]
-            pred_masks = pred_masks.cpu().numpy()
-
-            # print(pred_masks.max())
-            # print(pred_masks.min())
-            # print(np.unique(pred_masks[0,::]))
-            for mask_idx,mask_threshold in enumerate(np.arange(5,100,5)):
-                MASK_THRESHOLDS = [mask_threshold/100,mask_threshold/100,mask_threshold/100]
-                masks_after_threshold = []
-                # 此时的 masks只剩 true 和 false 了
-                for mask in pred_masks:
-                    # print(np.unique(mask))
-                    # if mask >= MASK_THRESHOLDS[pred_class]: # skip predictions with small area
-                    masks_after_threshold.append( np.where(mask > MASK_THRESHOLDS[pred_class],1,0).astype(np.uint8) )  
-                
-                if masks_after_threshold == []:
-                    sc = 0
-                else:
-                    mask_clean = np.stack(masks_after_threshold,axis = 0)
-                    sc = score(mask_clean, item)
-                res_store_matrix[score_idx,mask_idx] = sc
+        yield item['image_id'], pred['instances']
+
+def score_all():
+    # sigmoid mask 在每个二值化阈值下各存一份, 网格搜索全部从磁盘回放, 不再调用模型
+    pred_cache = PredictionCache.load_or_predict(PRED_CACHE_DIR, cfg.MODEL.WEIGHTS, VAL_JSON, cfg.dump(), predict_all,
+                                                 mask_thresholds=MASK_GRID)
+    for idx,item in enumerate(val_ds):
+        print("{}/{}".format(idx+1,len(val_ds)))
+
+        pred = pred_cache.get(item['image_id'])
+        if len(pred['classes']) == 0:
+            continue
+        pred_class_index = pred['classes'][0]
+
+        # score 阈值只是在取预测的子集: 每个二值化阈值只在最宽松的 score 下算一次 IoU,
+        # 19 个 score 阈值的结果由同一个 IoU 矩阵按行取子集一次性得到, 不再重新 encode
+        score_levels = threshold_levels(pred['scores'], SCORE_GRID)
+
+        res_store_matrix = np.zeros(shape= [len(SCORE_GRID),len(MASK_GRID)])
+        for mask_idx,mask_threshold in enumerate(MASK_GRID):
+            # 每个二值化阈值的 mask 裁剪块直接从缓存解包
+            ious = sparse_mask_iou(pred_cache.crops(item['image_id'], layer=mask_idx), get_gt_crops(item))
+            res_store_matrix[:,mask_idx] = grid_iou_map(ious, score_levels, grid_shape=(len(SCORE_GRID),1))[:,0]
         
         scores[pred_class_index].append(res_store_matrix.tolist())
         
@@ -189,9 +175,8 @@ cfg.INPUT.MASK_FORMAT='bitmask'
 cfg.MODEL.ROI_HEADS.NUM_CLASSES = 3 
 cfg.MODEL.WEIGHTS = '/storage/Kaggle_Cell_Segmentation/model/MaskRNN/test16/fold3/model_best_fold3.pth'  
 cfg.TEST.DETECTIONS_PER_IMAGE = 1000
-predictor = DefaultPredictor(cfg)
 dataDir=Path('../data/')
-register_coco_instances('sartorius_val',{},'../data/starious_annotations_val_fold3.json', dataDir)
+register_coco_instances('sartorius_val',{},VAL_JSON, dataDir)
 
 val_ds = DatasetCatalog.get('sartorius_val')
 # 进行修正
@@ -0,0 +1,94 @@
+# 此文件用于对detectron出来的模型进行  按类别的阈值搜索
+# 每个 fold 只推理一次 (原始预测存入 PredictionCache), 之后跨 fold 联合搜索每个类别的 SCORE_THRESHOLDS 与 MIN_PIXELS
+# 输出的表可以直接填入 Detectron2_LocalCV_Submit.py 等脚本
+import os
+os.environ['CUDA_VISIBLE_DEVICES'] = '0'
+import json
+
+import cv2
+from detectron2 import model_zoo
+from detectron2.config import get_cfg
+from detectron2.data import DatasetCatalog
+from toolbox.data_box.dataset_dicts import register_coco_instances
+from detectron2.engine import DefaultPredictor
+from toolbox.metric_box.gt_cache import GTCache
+from toolbox.predict_box.prediction_cache import PredictionCache
+from toolbox.predict_box.threshold_optimizer import optimize_thresholds
+
+######################################################################修改一下的参数#################################################################################
+FOLDS = [1, 2, 3, 4, 5]
+PTH_NAME = "/storage/Kaggle_Cell_Segmentation/model/MaskRNN/test34/model_best_fold{}.pth"
+VAL_JSON = '../data/2021_new_split_val_fold{}.json'
+# 原始预测的磁盘缓存 同一个 checkpoint + 验证集 + cfg 只推理一次
+PRED_CACHE_DIR = '../pred_cache'
+# IoU 计算的进程数 跨图片跨 fold 并行, 0 表示串行
+NUM_WORKERS = 4
+# 粗网格之后 在最优点附近细化的轮数
+REFINE_ROUNDS = 2
+
+
+def get_cfg_fold(pth_name):
+    cfg = get_cfg()
+    cfg.merge_from_file(model_zoo.get_config_file("COCO-InstanceSegmentation/mask_rcnn_R_50_FPN_3x.yaml"))
+    cfg.INPUT.MASK_FORMAT='bitmask'
+
+    # MODEL
+    ######################################################################################################################################################
+    cfg.MODEL.RESNETS.DEFORM_MODULATED = True
+    cfg.MODEL.RESNETS.DEFORM_NUM_GROUPS = 2
+    cfg.MODEL.RESNETS.DEFORM_ON_PER_STAGE = [False, True, True, True]
+
+    cfg.MODEL.BACKBONE.FREEZE_AT = 0
+    cfg.MODEL.RESNETS.NORM = "SyncBN"
+    cfg.MODEL.RESNETS.STRIDE_IN_1X1 = False
+    cfg.MODEL.FPN.NORM = "SyncBN"
+    cfg.MODEL.ANCHOR_GENERATOR.SIZES = [[9], [17], [31], [64], [127]]
+    cfg.MODEL.ANCHOR_GENERATOR.ASPECT_RATIOS = [[0.25, 0.5, 1.0, 2.0, 4.0]]
+    cfg.MODEL.ROI_HEADS.BATCH_SIZE_PER_IMAGE = 512
+    cfg.MODEL.ROI_HEADS.NAME = "CascadeROIHeads"
+    cfg.MODEL.ROI_BOX_HEAD.NORM = "SyncBN"
+    cfg.MODEL.ROI_BOX_HEAD.CLS_AGNOSTIC_BBOX_REG = True
+    cfg.MODEL.ROI_BOX_HEAD.NUM_CONV = 4
+    cfg.MODEL.ROI_BOX_HEAD.NUM_FC = 1
+    cfg.MODEL.ROI_MASK_HEAD.NORM = "SyncBN"
+    cfg.MODEL.ROI_MASK_HEAD.NUM_CONV= 8
+
+    cfg.MODEL.RPN.BATCH_SIZE_PER_IMAGE = 256
+    cfg.MODEL.PIXEL_MEAN = [128, 128, 128]
+    cfg.MODEL.PIXEL_STD = [11.578, 11.578, 11.578]
+    ##########################################################################################################
+
+    cfg.TEST.DETECTIONS_PER_IMAGE = 1000
+    cfg.MODEL.ROI_HEADS.NUM_CLASSES = 3
+    cfg.MODEL.WEIGHTS = pth_name
+    return cfg
+
+
+def predict_all(cfg, val_ds):
+    # 只有缓存不存在时才会构建模型并推理
+    predictor = DefaultPredictor(cfg)
+    for idx,item in enumerate(val_ds):
+        print("{}/{}".format(idx+1,len(val_ds)))
+        im =  cv2.imread(item['file_name'])
+        pred = predictor(im)
+        yield item['image_id'], pred['instances']
+
+
+folds = []
+for fold_id in FOLDS:
+    print("Now Processing fold{}".format(fold_id))
+    cfg = get_cfg_fold(PTH_NAME.format(fold_id))
+    dataset_name = 'sartorius_val{}'.format(fold_id)
+    register_coco_instances(dataset_name,{},VAL_JSON.format(fold_id), '../data/')
+    val_ds = DatasetCatalog.get(dataset_name)
+
+    pred_cache = PredictionCache.load_or_predict(PRED_CACHE_DIR, cfg.MODEL.WEIGHTS, VAL_JSON.format(fold_id), cfg.dump(),
+                                                 lambda: predict_all(cfg, val_ds))
+    folds.append((pred_cache, GTCache.load(VAL_JSON.format(fold_id))))
+
+best = optimize_thresholds(folds, rounds=REFINE_ROUNDS, num_workers=NUM_WORKERS)
+print("SCORE_THRESHOLDS = {}".format(best["SCORE_THRESHOLDS"]))
+print("MIN_PIXELS = {}".format(best["MIN_PIXELS"]))
+
+with open("./threshold_search_perclass.json",'w') as outfile:
+    json.dump(best,outfile,indent= 4)
@@ -32,6 +32,7 @@ from mmdet.datasets import build_dataset
 from mmdet.models import build_detector
 from mmdet.apis import train_detector
 from mmdet.apis import inference_detector, init_detector, show_result_pyplot, set_random_seed
+from toolbox.rle_box.kaggle_rle import encode_kaggle_rles
 import gc
 
 
@@ -56,16 +57,12 @@ def rle_decode(mask_rle, shape):
         img[lo:hi] = 1
     return img.reshape(shape)
 
-def rle_encode(img):
+def rle_encode(imgs):
     '''
-    img: numpy array, 1 - mask, 0 - background
-    Returns run length as string formated
+    imgs: numpy array (N, H, W), 1 - mask, 0 - background
+    Returns N run lengths as strings formated, the whole stack is encoded at once
     '''
-    pixels = img.flatten()
-    pixels = np.concatenate([[0], pixels, [0]])
-    runs = np.where(pixels[1:] != pixels[:-1])[0] + 1
-    runs[1::2] -= runs[::2]
-    return ' '.join(str(x) for x in runs)
+    return encode_kaggle_rles(np.asarray(imgs))
 
 
 
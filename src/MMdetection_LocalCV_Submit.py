@@ -32,12 +32,24 @@ from mmdet.apis import train_detector
 from mmdet.apis import inference_detector, init_detector, show_result_pyplot, set_random_seed
 from mmdet.apis import single_gpu_test
 import pycocotools.mask as mask_util
+from toolbox.data_box.image_cache import SharedImageCache, run_cache_name
+from toolbox.metric_box.competition_metric import iou_map
+from toolbox.metric_box.parallel_score import ScorePool, rle_score
+from toolbox.predict_box.prediction_cache import PredictionCache
+from toolbox.rle_box.kaggle_rle import encode_kaggle_rles
 
 
 IMG_WIDTH = 704
 IMG_HEIGHT = 520
 confidence_thresholds = {0: 0.15, 1: 0.55, 2: 0.35}
 MIN_PIXELS = [ 60, 60 ,120]
+# 评分用的进程数, 0 表示推理与评分串行
+NUM_WORKERS = 4
+# 原始预测的磁盘缓存 同一个 checkpoint + 验证集 + cfg 只推理一次
+PRED_CACHE_DIR = '../pred_cache'
+# 解码后图片的共享内存缓存 (MB), 多个 checkpoint / fold 推理同一批图时只解码一次, 0 表示不启用
+IMAGE_CACHE_MB = 0
+image_cache = SharedImageCache(run_cache_name("mmdet_images", "../data"), capacity=IMAGE_CACHE_MB << 20) if IMAGE_CACHE_MB > 0 else None
 
 def get_mask_from_result(result):
     d = {True : 1, False : 0}
@@ -46,68 +58,6 @@ def get_mask_from_result(result):
 #     print(mk.shape)
     return mk
 
-def precision_at(threshold, iou):
-    """
-    Computes the precision at a given threshold.
-
-    Args:
-        threshold (float): Threshold.
-        iou (np array [n_truths x n_preds]): IoU matrix.
-
-    Returns:
-        int: Number of true positives,
-        int: Number of false positives,
-        int: Number of false negatives.
-    """
-    matches = iou > threshold
-    true_positives = np.sum(matches, axis=1) >= 1  # Correct objects
-    false_negatives = np.sum(matches, axis=1) == 0  # Missed objects
-    false_positives = np.sum(matches, axis=0) == 0  # Extra objects
-    tp, fp, fn = (
-        np.sum(true_positives),
-        np.sum(false_positives),
-        np.sum(false_negatives),
-    )
-    return tp, fp, fn
-
-
-def iou_map(ious,verbose=0):
-    """
-    Computes the metric for the competition.
-    Masks contain the segmented pixels where each object has one value associated,
-    and 0 is the background.
-
-    Args:
-        truths (list of masks): Ground truths.
-        preds (list of masks): Predictions.
-        verbose (int, optional): Whether to print infos. Defaults to 0.
-
-    Returns:
-        float: mAP.
-    """
-
-    if verbose:
-        print("Thresh\tTP\tFP\tFN\tPrec.")
-
-    prec = []
-    for t in np.arange(0.5, 1.0, 0.05):
-        tps, fps, fns = 0, 0, 0
-        tp, fp, fn = precision_at(t, ious)
-        tps += tp
-        fps += fp
-        fns += fn
-
-        p = tps / (tps + fps + fns)
-        prec.append(p)
-
-        if verbose:
-            print("{:1.3f}\t{}\t{}\t{}\t{:1.3f}".format(t, tps, fps, fns, p))
-
-    if verbose:
-        print("AP\t-\t-\t-\t{:1.3f}".format(np.mean(prec)))
-
-    return np.mean(prec)
-
 def rle_decode(mask_rle, shape):
     '''
     mask_rle: run-length as string formated (start length)
@@ -124,16 +74,58 @@ def rle_decode(mask_rle, shape):
         img[lo:hi] = 1
     return img.reshape(shape)
 
-def rle_encode(img):
+def rle_encode(imgs):
+    '''
+    imgs: numpy array (N, H, W), 1 - mask, 0 - background
+    Returns N run lengths as strings formated, the whole stack is encoded at once
+    '''
+    return encode_kaggle_rles(np.asarray(imgs))
+
+def predict_raw(cfg, checkpoint, data_test):
     '''
-    img: numpy array, 1 - mask, 0 - background
-    Returns run length as string formated
+    Runs the model on every image of data_test one by one, only called when the prediction cache misses
+    Yields (image_id, scores, classes, boxes, masks) of every detection, before any threshold
     '''
-    pixels = img.flatten()
-    pixels = np.concatenate([[0], pixels, [0]])
-    runs = np.where(pixels[1:] != pixels[:-1])[0] + 1
-    runs[1::2] -= runs[::2]
-    return ' '.join(str(x) for x in runs)
+    model = init_detector(cfg,checkpoint)
+    for image in data_test['images']:
+        img_path = os.path.join("../data",image['file_name'])
+        # mmcv.imread 默认即 cv2 后端的 BGR 彩色图
+        img = image_cache.imread(img_path) if image_cache is not None else mmcv.imread(img_path)
+        result = inference_detector(model, img)
+
+        scores, classes, boxes, masks = [], [], [], []
+        # 表示各个类的seg  resluts【0】 是一个 [calsses——num, bbox] 的列表
+        for i, classe in enumerate(result[0]):
+            if classe.shape != (0, 5):
+                bbs = classe
+                sgs = result[1][i]
+                for bb, sg in zip(bbs,sgs):
+                    scores.append(bb[4])
+                    classes.append(i)
+                    boxes.append(bb[:4])
+                    masks.append(get_mask_from_result(sg).astype(np.uint8))
+        masks = np.stack(masks) if masks else np.zeros((0, image['height'], image['width']), dtype=np.uint8)
+        yield image['id'], np.asarray(scores), np.asarray(classes), np.asarray(boxes).reshape(-1, 4), masks
+
+def predict_jobs(pred_cache, data_test):
+    '''
+    Replays the cached predictions of every image of data_test
+    Yields (enc_preds, enc_targs) of every image, to be scored by ScorePool
+    '''
+    # 获取每张图片对应的  mask标签
+    enc_targs_per_image = {}
+    for element in data_test['annotations']:
+        enc_targs_per_image.setdefault(element["image_id"], []).append(element["segmentation"])
+
+    # 每个类别的阈值, 按预测类别一次性取出
+    thresholds = np.asarray([confidence_thresholds[i] for i in range(len(MIN_PIXELS))])
+    min_pixels = np.asarray(MIN_PIXELS)
+    for image in data_test['images']:
+        pred = pred_cache.get(image['id'])
+        keep = ((pred['scores'] >= thresholds[pred['classes']]) & 
+                (pred['areas'] >= min_pixels[pred['classes']])) # skip predictions with small area
+        enc_preds = [rle for rle, k in zip(pred['rles'], keep) if k]
+        yield enc_preds, enc_targs_per_image.get(image['id'], [])
 
 #####################################################################################################################################################################
 
@@ -337,51 +329,12 @@ for fold_id in range(1,6):
 
     for file in pth_files:
         print("EPOCH PTH {}".format(file))
-        model = init_detector(cfg,file)
+        # 原始预测按 (checkpoint 内容, 验证集, cfg) 缓存到磁盘, 只有缓存不存在时才会构建模型并推理
+        pred_cache = PredictionCache.load_or_predict(PRED_CACHE_DIR, file, cfg.data.test.ann_file, cfg.pretty_text,
+                                                     lambda: predict_raw(cfg, file, data_test))
         # 读入对应的 val fold .json 文件
-        res_map = []
-        for id,image in enumerate(data_test['images']):
-            img = mmcv.imread(os.path.join("../data",image['file_name']))
-            # 记录下当前图片的 id
-            img_id = image['id']
-            result = inference_detector(model, img)
-
-            previous_masks = []
-        #     print(result)
-        # 表示各个类的seg  resluts【0】 是一个 [calsses——num, bbox] 的列表
-            for i, classe in enumerate(result[0]):
-        #         print(classe.shape)
-                if classe.shape != (0, 5):
-                    bbs = classe
-        #             print(bbs)
-                    sgs = result[1][i]
-                    for bb, sg in zip(bbs,sgs):
-                        box = bb[:4]
-                        cnf = bb[4]
-                        if cnf >= confidence_thresholds[i]:
-                            mask = get_mask_from_result(sg).astype(np.uint8)
-
-                            if mask.sum() >= MIN_PIXELS[i]: # skip predictions with small area
-                                previous_masks.append(mask)
-            if previous_masks == []:
-                res_map.append(0)
-                continue
-            enc_preds = [mask_util.encode(np.asarray(p, order='F')) for p in previous_masks]
-
-            # 获取图片对应的  mask标签
-            enc_targs = []
-            for element in data_test['annotations']:
-                if element["image_id"] == img_id:
-                    enc_targs.append(element["segmentation"])
-            
-            ious = mask_util.iou(enc_preds, enc_targs, [0]*len(enc_targs))
-            # print(ious)
-            # prec = []
-            # for t in np.arange(0.5, 1.0, 0.05):
-            #     tp, fp, fn = precision_at(t, ious)
-            #     p = tp / (tp + fp + fn)
-            #     prec.append(p)
-            res_map.append(iou_map(ious))
+        # 从缓存回放的 RLE 交给进程池评分, 分数按图片顺序返回
+        res_map = ScorePool(NUM_WORKERS, pool_type='process').map(rle_score, predict_jobs(pred_cache, data_test))
 
         result_dic.loc[file,"score"] = np.mean(res_map)
 
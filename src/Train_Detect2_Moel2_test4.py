@@ -6,13 +6,16 @@ import random, cv2
 import matplotlib.pyplot as plt
 import numpy as np
 import pycocotools.mask as mask_util
+from toolbox.metric_box.competition_metric import iou_map
+from toolbox.data_box.instance_sampler import build_balanced_train_loader
+from toolbox.metric_box.gt_cache import GTCache
 # import some common detectron2 utilities
 from detectron2 import model_zoo
 from detectron2.engine import DefaultPredictor, DefaultTrainer
 from detectron2.config import get_cfg
 from detectron2.utils.visualizer import Visualizer, ColorMode
 from detectron2.data import MetadataCatalog, DatasetCatalog
-from detectron2.data.datasets import register_coco_instances
+from toolbox.data_box.dataset_dicts import register_coco_instances
 from detectron2.utils.logger import setup_logger
 from detectron2.evaluation.evaluator import DatasetEvaluator
 import albumentations as A
@@ -22,6 +25,9 @@ from detectron2.checkpoint import DetectionCheckpointer
 
 setup_logger()
 
+# 按每张图的实例数凑 batch, 各 batch / 各 rank 的总实例数接近 (显存峰值与每步耗时更平稳), False 时为原来的 TrainingSampler
+BALANCE_INSTANCES = False
+
 dataDir=Path('../data/')
 cfg = get_cfg()
 cfg.SEED = 3407
@@ -45,30 +51,17 @@ print(len(train_ds))
 
 ## 注册  评估流程
 
-# Taken from https://www.kaggle.com/theoviel/competition-metric-map-iou
-def precision_at(threshold, iou):
-    matches = iou > threshold
-    true_positives = np.sum(matches, axis=1) == 1  # Correct objects
-    false_positives = np.sum(matches, axis=0) == 0  # Missed objects
-    false_negatives = np.sum(matches, axis=1) == 0  # Extra objects
-    return np.sum(true_positives), np.sum(false_positives), np.sum(false_negatives)
-
 def score(pred, targ):
     pred_masks = pred['instances'].pred_masks.cpu().numpy()
     enc_preds = [mask_util.encode(np.asarray(p, order='F')) for p in pred_masks]
     enc_targs = list(map(lambda x:x['segmentation'], targ))
     ious = mask_util.iou(enc_preds, enc_targs, [0]*len(enc_targs))
-    prec = []
-    for t in np.arange(0.5, 1.0, 0.05):
-        tp, fp, fn = precision_at(t, ious)
-        p = tp / (tp + fp + fn)
-        prec.append(p)
-    return np.mean(prec)
+    return iou_map(ious, strict=True)
 
 class MAPIOUEvaluator(DatasetEvaluator):
     def __init__(self, dataset_name):
-        dataset_dicts = DatasetCatalog.get(dataset_name)
-        self.annotations_cache = {item['image_id']:item['annotations'] for item in dataset_dicts}
+        # GT 预先解码后按标注文件哈希缓存在磁盘上, 每个 EVAL_PERIOD 重建 evaluator 时只需 mmap
+        self.annotations_cache = GTCache.from_dataset(dataset_name)
             
     def reset(self):
         self.scores = []
@@ -123,6 +116,8 @@ class Trainer(DefaultTrainer):
 
 
         mapper = detectron2.data.dataset_mapper.DatasetMapper(**mapper_params)
+        if BALANCE_INSTANCES:
+            return build_balanced_train_loader(cfg, mapper, num_workers=16)
 
         dataset  = detectron2.data.build.get_detection_dataset_dicts(
                     cfg.DATASETS.TRAIN,
@@ -9,6 +9,15 @@ import os
 os.environ['CUDA_VISIBLE_DEVICES'] = '2'
 import cv2
 import numpy as np
+from toolbox.data_box.annotation_store import AnnotationStore
+from toolbox.data_box.image_cache import SharedImageCache, run_cache_name
+from toolbox.data_box.instance_sampler import InstanceBalancedBatchSampler
+from toolbox.data_box.grayscale import compose_normalize
+from toolbox.data_box.compact_masks import compact_target, expand_targets, flip_compact
+from toolbox.metric_box.competition_metric import batch_iou_map
+from toolbox.metric_box.label_iou import label_iou, batch_label_iou
+from toolbox.rle_box.kaggle_rle import encode_kaggle_rles
+from toolbox.rle_box.rle_ops import InstanceRuns
 import pandas as pd
 import random
 import torch
@@ -56,6 +65,9 @@ hyper_parameter_group ={
     "original_weight": 704,
     "PCT_IMAGES_VALIDATION": 0.1, # 此项为数据集划分比例   0.1 表示10%的数据作为 val
     "train_path": r"../data/train",
+    "image_cache_mb": 0,  # 解码后图片的共享内存缓存 (MB), 0 表示不启用
+    "grayscale": False,  # 单通道读图 / 缓存 / 拷贝, 归一化并入模型的 transform, 在 GPU 上广播成 3 通道
+    "balance_instances": False,  # 按每张图的实例数凑 batch, 各 batch 总实例数接近 (每个 epoch 仍是一次随机排列)
     "batch_size":12,
     "skf_fold" : 5,
 
@@ -165,15 +177,9 @@ def rle_decode(mask_rle, shape, color=1):
     return img.reshape(shape)
 
 
-def rle_encoding(x):
-    dots = np.where(x.flatten() == 1)[0]
-    run_lengths = []
-    prev = -2
-    for b in dots:
-        if (b>prev+1): run_lengths.extend((b + 1, 0))
-        run_lengths[-1] += 1
-        prev = b
-    return ' '.join(map(str, run_lengths))
+def rle_encoding(masks):
+    # 整组 mask (N, H, W) 一次编码, 返回 N 个字符串; 不要逐个 mask 调用
+    return encode_kaggle_rles(np.asarray(masks) == 1)
 
 
 def remove_overlapping_pixels(mask, other_masks):
@@ -186,7 +192,7 @@ def combine_masks(masks, mask_threshold):
     """
     combine masks into one image
     """
-    maskimg = np.zeros((hyper_parameter_group["original_height"], hyper_parameter_group["original_weight"]))
+    maskimg = np.zeros((hyper_parameter_group["original_height"], hyper_parameter_group["original_weight"]), dtype=np.uint16)
     # print(len(masks.shape), masks.shape)
     for m, mask in enumerate(masks,1):
         maskimg[mask>mask_threshold] = m
@@ -197,22 +203,23 @@ def get_filtered_masks(pred):
     """
     filter masks using MIN_SCORE for mask and MAX_THRESHOLD for pixels
     """
-    use_masks = []
-    for i, mask in enumerate(pred["masks"]):
-
-        # Filter-out low-scoring results. Not tried yet.
-        scr = pred["scores"][i].cpu().item()
-        label = pred["labels"][i].cpu().item()
-        if scr > hyper_parameter_group["min_score_dict"][label]:
-            mask = mask.cpu().numpy().squeeze()
-            # Keep only highly likely pixels
-            binary_mask = mask > hyper_parameter_group["mask_threshold_dict"][label]
-            binary_mask = remove_overlapping_pixels(binary_mask, use_masks)
-            use_masks.append(binary_mask)
-
-    return use_masks
+    # Filter-out low-scoring results. Not tried yet.
+    scores = pred["scores"].cpu().tolist()
+    labels = pred["labels"].cpu().tolist()
+    keep = [i for i, (scr, label) in enumerate(zip(scores, labels)) if scr > hyper_parameter_group["min_score_dict"][label]]
+    if len(keep) == 0:
+        return []
+
+    # Keep only highly likely pixels  阈值化留在 mask 所在的设备上, 只有前景像素的下标拷回 CPU
+    masks = pred["masks"][torch.as_tensor(keep, device=pred["masks"].device)][:, 0]
+    thresholds = torch.as_tensor([hyper_parameter_group["mask_threshold_dict"][labels[i]] for i in keep],
+                                 dtype=masks.dtype, device=masks.device)
+    binary_masks = masks > thresholds[:, None, None]
+    # 与之前所有 mask 的重叠在游程上一次去除, 结果与逐个调用 remove_overlapping_pixels 相同
+    return list(InstanceRuns.from_dense(binary_masks, order='C').remove_overlaps().to_dense())
 
 # 用于 计算 平均精度   copy 自 https://www.kaggle.com/theoviel/competition-metric-map-iou
+# 原实现用 np.histogram2d 对 float 标签图分箱, 改为 toolbox 中按整数标签做一次 np.bincount
 def compute_iou(labels, y_pred, verbose=0):
     """
     Computes the IoU for instance labels and predictions.
@@ -224,60 +231,15 @@ def compute_iou(labels, y_pred, verbose=0):
     Returns:
         np array: IoU matrix, of size true_objects x pred_objects.
     """
-
-    true_objects = len(np.unique(labels))
-    pred_objects = len(np.unique(y_pred))
+    iou = label_iou(labels, y_pred)
 
     if verbose:
-        print("Number of true objects: {}".format(true_objects))
-        print("Number of predicted objects: {}".format(pred_objects))
-
-    # Compute intersection between all objects
-    intersection = np.histogram2d(
-        labels.flatten(), y_pred.flatten(), bins=(true_objects, pred_objects)
-    )[0]
-
-    # Compute areas (needed for finding the union between all objects)
-    area_true = np.histogram(labels, bins=true_objects)[0]
-    area_pred = np.histogram(y_pred, bins=pred_objects)[0]
-    area_true = np.expand_dims(area_true, -1)
-    area_pred = np.expand_dims(area_pred, 0)
-
-    # Compute union
-    union = area_true + area_pred - intersection
-    intersection = intersection[1:, 1:]  # exclude background
-    union = union[1:, 1:]
-    union[union == 0] = 1e-9
-    iou = intersection / union
+        print("Number of true objects: {}".format(iou.shape[0] + 1))
+        print("Number of predicted objects: {}".format(iou.shape[1] + 1))
 
     return iou
 
 
-def precision_at(threshold, iou):
-    """
-    Computes the precision at a given threshold.
-
-    Args:
-        threshold (float): Threshold.
-        iou (np array): IoU matrix.
-
-    Returns:
-        int: Number of true positives,
-        int: Number of false positives,
-        int: Number of false negatives.
-    """
-    matches = iou > threshold
-    true_positives = np.sum(matches, axis=1) == 1  # Correct objects
-    false_positives = np.sum(matches, axis=0) == 0  # Missed objects
-    false_negatives = np.sum(matches, axis=1) == 0  # Extra objects
-    tp, fp, fn = (
-        np.sum(true_positives),
-        np.sum(false_positives),
-        np.sum(false_negatives),
-    )
-    return tp, fp, fn
-
-
 def iou_map(truths, preds, verbose=0):
     """
     Computes the metric for the competition.
@@ -292,30 +254,12 @@ def iou_map(truths, preds, verbose=0):
     Returns:
         float: mAP.
     """
-    ious = [compute_iou(truth, pred, verbose) for truth, pred in zip(truths, preds)]
-
     if verbose:
-        print("Thresh\tTP\tFP\tFN\tPrec.")
-
-    prec = []
-    for t in np.arange(0.5, 1.0, 0.05):
-        tps, fps, fns = 0, 0, 0
-        for iou in ious:
-            tp, fp, fn = precision_at(t, iou)
-            tps += tp
-            fps += fp
-            fns += fn
-
-        p = tps / (tps + fps + fns)
-        prec.append(p)
-
-        if verbose:
-            print("{:1.3f}\t{}\t{}\t{}\t{:1.3f}".format(t, tps, fps, fns, p))
-
-    if verbose:
-        print("AP\t-\t-\t-\t{:1.3f}".format(np.mean(prec)))
-
-    return np.mean(prec)
+        ious = [compute_iou(truth, pred, verbose) for truth, pred in zip(truths, preds)]
+    else:
+        ious = batch_label_iou(truths, preds)
+    # TP FP FN 在所有图片上累加后再求 precision
+    return batch_iou_map(ious, strict=True, reduce='pool', verbose=verbose)
 
 
 def get_score(ds, mdl):
@@ -329,7 +273,8 @@ def get_score(ds, mdl):
         with torch.no_grad():
             result = mdl([img.to(device)])[0]
 
-        masks = combine_masks(targets['masks'], 0.5)
+        # 标签图就是 combine_masks 的结果 (后出现的实例覆盖先出现的)
+        masks = targets['label_map'].numpy().astype(np.uint16)
         labels = pd.Series(result['labels'].cpu().numpy()).value_counts()
 
         mask_threshold = hyper_parameter_group["mask_threshold_dict"][labels.sort_values().index[-1]]
@@ -430,7 +375,8 @@ class VerticalFlip:
             bbox = target["boxes"]
             bbox[:, [1, 3]] = height - bbox[:, [3, 1]]
             target["boxes"] = bbox
-            target["masks"] = target["masks"].flip(-2)
+            # 只翻转紧凑的标签图与重叠表, 不再翻转 N x H x W 的堆叠
+            target["label_map"], target["overlaps"] = flip_compact(target["label_map"], target["overlaps"], -2)
         return image, target
 
 
@@ -445,13 +391,16 @@ class HorizontalFlip:
             bbox = target["boxes"]
             bbox[:, [0, 2]] = width - bbox[:, [2, 0]]
             target["boxes"] = bbox
-            target["masks"] = target["masks"].flip(-1)
+            target["label_map"], target["overlaps"] = flip_compact(target["label_map"], target["overlaps"], -1)
         return image, target
 
 
+IMAGENET_MEAN, IMAGENET_STD = [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
+
+
 class Normalize:
     def __call__(self, image, target):
-        image = F.normalize(image, mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+        image = F.normalize(image, mean=IMAGENET_MEAN, std=IMAGENET_STD)
         return image, target
 
 
@@ -463,7 +412,9 @@ class ToTensor:
 
 def get_transform(train):
     transforms = [ToTensor()]
-    transforms.append(Normalize())
+    # 灰度模式下 Normalize 由模型的 transform 完成
+    if not hyper_parameter_group["grayscale"]:
+        transforms.append(Normalize())
 
     # Data augmentation for train
     if train:
@@ -511,14 +462,20 @@ class CellDataset(Dataset):
         self.height = hyper_parameter_group["original_height"]
         self.width = hyper_parameter_group["original_weight"]
 
+        # 标注只在第一次见到这份 df 时解码, 之后所有 DataLoader worker / NNI trial 共用磁盘上的内存映射
+        self.store = AnnotationStore.from_frame(self.df, (self.height, self.width),
+                                                cache_dir=os.path.join(os.path.dirname(os.path.abspath(image_dir)), ".ann_store"))
+        # 解码后的图片放进共享内存, train / val 与所有 DataLoader worker 按名字共用, 每张图只解码一次
+        self.image_cache = None
+        if hyper_parameter_group["image_cache_mb"] > 0:
+            self.image_cache = SharedImageCache(run_cache_name("cell_images", image_dir),
+                                                capacity=hyper_parameter_group["image_cache_mb"] << 20)
         self.image_info = collections.defaultdict(dict)
-        temp_df = self.df.groupby(["id", "cell_type"])['annotation'].agg(lambda x: list(x)).reset_index()
-        for index, row in temp_df.iterrows():
+        for index, image_id in enumerate(self.store.image_ids):
             self.image_info[index] = {
-                'image_id': row['id'],
-                'image_path': os.path.join(self.image_dir, row['id'] + '.png'),
-                'annotations': list(row["annotation"]),
-                'cell_type': hyper_parameter_group["cell_type_dict"][row["cell_type"]]
+                'image_id': image_id,
+                'image_path': os.path.join(self.image_dir, image_id + '.png'),
+                'cell_type': hyper_parameter_group["cell_type_dict"][self.store.cell_type(image_id)]
             }
 
     def get_box(self, a_mask):
@@ -534,25 +491,28 @@ class CellDataset(Dataset):
         ''' Get the image and the target'''
 
         img_path = self.image_info[idx]["image_path"]
-        img = cv2.imread(img_path)
-        # print(img.shape)
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        if hyper_parameter_group["grayscale"]:
+            # 灰度图只读一个通道 [H x W], ToTensor 之后为 1 x H x W
+            if self.image_cache is not None:
+                img = self.image_cache.imread(img_path, flags=cv2.IMREAD_GRAYSCALE)
+            else:
+                img = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)
+        elif self.image_cache is not None:
+            img = self.image_cache.imread(img_path, cv2.COLOR_BGR2RGB)
+        else:
+            img = cv2.imread(img_path)
+            # print(img.shape)
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
         info = self.image_info[idx]
 
-        n_objects = len(info['annotations'])
+        n_objects = self.store.num_instances(info['image_id'])
         # 修正： 为了便于  albumentation进行数据增强  修改维度
-        masks = np.zeros((len(info['annotations']), self.height, self.width), dtype=np.uint8)
         # masks = np.zeros( shape = (self.height, self.width , len(info['annotations'])), dtype=np.uint8)
-        boxes = []
-        for i, annotation in enumerate(info['annotations']):
-            a_mask = rle_decode(annotation, (hyper_parameter_group["original_height"], hyper_parameter_group["original_weight"]))
-
-            a_mask = np.array(a_mask) > 0
-            masks[i, :, :] = a_mask
-            # masks[:, :, i] = a_mask
-
-            boxes.append(self.get_box(a_mask))
+        # 标注从 AnnotationStore 的内存映射中切片得到, 不再每次解析 RLE; bbox 与 get_box 相同
+        # mask 保持为标签图 + 重叠表, 训练循环里在 GPU 上由 expand_targets 展开
+        label_map, overlaps = compact_target(self.store, info['image_id'])
+        boxes = np.asarray(self.store.boxes_of(info['image_id']))
 
         # print(masks.shape)
         # labels
@@ -563,7 +523,6 @@ class CellDataset(Dataset):
         # print(boxes.shape)
         labels = torch.as_tensor(labels, dtype=torch.int64)
         # masks = np.array(masks, dtype=np.uint8)
-        masks = torch.as_tensor(masks, dtype=torch.uint8)
 
         image_id = torch.tensor([idx])
         area = (boxes[:, 3] - boxes[:, 1]) * (boxes[:, 2] - boxes[:, 0])
@@ -573,7 +532,8 @@ class CellDataset(Dataset):
         target = {
             'boxes': boxes,
             'labels': labels,
-            'masks': masks,
+            'label_map': label_map,
+            'overlaps': overlaps,
             'image_id': image_id,
             'area': area,
             'iscrowd': iscrowd
@@ -621,8 +581,14 @@ stdout(f"Annotations in validation set: {len(df_val)}")
 
 # 导入数据集
 ds_train = CellDataset(hyper_parameter_group["train_path"], df_train, transforms=get_transform(train=True))
-dl_train = DataLoader(ds_train, batch_size=hyper_parameter_group["batch_size"], shuffle=True, pin_memory=True,
-                      num_workers=2, collate_fn=lambda x: tuple(zip(*x)))
+if hyper_parameter_group["balance_instances"]:
+    dl_train = DataLoader(ds_train, pin_memory=True, num_workers=2, collate_fn=lambda x: tuple(zip(*x)),
+                          batch_sampler=InstanceBalancedBatchSampler(
+                              [ds_train.store.num_instances(info['image_id']) for info in ds_train.image_info.values()],
+                              hyper_parameter_group["batch_size"], seed=hyper_parameter_group["seed"]))
+else:
+    dl_train = DataLoader(ds_train, batch_size=hyper_parameter_group["batch_size"], shuffle=True, pin_memory=True,
+                          num_workers=2, collate_fn=lambda x: tuple(zip(*x)))
 
 ds_val = CellDataset(hyper_parameter_group["train_path"], df_val, transforms=get_transform(train=False))
 dl_val = DataLoader(ds_val, batch_size=hyper_parameter_group["batch_size"], shuffle=False, pin_memory=True,
@@ -688,6 +654,11 @@ def get_model(num_classes, model_chkpt=None):
     # and replace the mask predictor with a new one
     model.roi_heads.mask_predictor = MaskRCNNPredictor(in_features_mask, hidden_layer, num_classes + 1)
 
+    if hyper_parameter_group["grayscale"]:
+        # Normalize + 模型自身的归一化合成一次, 1 x H x W 的图减去 3 个通道的均值时广播成 3 通道, 输出与 RGB 输入相同
+        model.transform.image_mean, model.transform.image_std = compose_normalize(
+            (IMAGENET_MEAN, IMAGENET_STD), (model.transform.image_mean, model.transform.image_std))
+
     if model_chkpt:
         model.load_state_dict(torch.load(model_chkpt, map_location=device))
     return model
@@ -788,7 +759,8 @@ for epoch in range(1, hyper_parameter_group["total_epoch"] + 1):
         model.train()
         # Predict
         images = list(image.to(device) for image in images)
-        targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
+        # 紧凑的 mask 目标拷到 GPU 之后再展开成 N x H x W
+        targets = expand_targets([{k: v.to(device) for k, v in t.items()} for t in targets])
 
         loss_dict = model(images, targets)
         print(loss_dict)
@@ -824,7 +796,7 @@ for epoch in range(1, hyper_parameter_group["total_epoch"] + 1):
     with torch.no_grad():
         for batch_idx, (images, targets) in enumerate(dl_val, 1):
             images = list(image.to(device) for image in images)
-            targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
+            targets = expand_targets([{k: v.to(device) for k, v in t.items()} for t in targets])
 
             val_loss_dict = model(images, targets)
             val_batch_loss = sum(loss for loss in val_loss_dict.values())
@@ -8,14 +8,20 @@ import random, cv2
 import matplotlib.pyplot as plt
 import numpy as np
 import pycocotools.mask as mask_util
+from toolbox.data_box.image_cache import SharedImageCache, patch_detectron2_read_image, run_cache_name
+from toolbox.data_box.instance_sampler import build_balanced_train_loader
+from toolbox.metric_box.competition_metric import iou_map
+from toolbox.metric_box.gt_cache import GTCache
+from toolbox.rle_box.rle_ops import InstanceRuns
 # import some common detectron2 utilities
 from detectron2 import model_zoo
 from detectron2.engine import DefaultPredictor, DefaultTrainer
 from detectron2.config import get_cfg
 from detectron2.utils.visualizer import Visualizer, ColorMode
 from detectron2.data import MetadataCatalog, DatasetCatalog
-from detectron2.data.datasets import register_coco_instances
+from toolbox.data_box.dataset_dicts import register_coco_instances
 from detectron2.utils.logger import setup_logger
+import detectron2.utils.comm as comm
 from detectron2.evaluation.evaluator import DatasetEvaluator
 import albumentations as A
 import detectron2.data.transforms as T
@@ -30,51 +36,39 @@ import glob
 
 SCORE_THRESHOLDS = [.15, .3, .55]
 MIN_PIXELS = [60, 120, 60]
+# 解码后图片的共享内存缓存 (MB), 0 表示不启用
+IMAGE_CACHE_MB = 0
+# 按每张图的实例数凑 batch, 各 batch / 各 rank 的总实例数接近 (显存峰值与每步耗时更平稳), False 时为原来的 TrainingSampler
+BALANCE_INSTANCES = False
 matrix = [[],[],[],[],[]]
 matrix_fold_id = 0
 
 ## 注册  评估流程
 
-# Taken from https://www.kaggle.com/theoviel/competition-metric-map-iou
-def precision_at(threshold, iou):
-    matches = iou > threshold
-    true_positives = np.sum(matches, axis=1) == 1  # Correct objects
-    false_positives = np.sum(matches, axis=0) == 0  # Missed objects
-    false_negatives = np.sum(matches, axis=1) == 0  # Extra objects
-    return np.sum(true_positives), np.sum(false_positives), np.sum(false_negatives)
-
 def score(pred, targ):
     # pred_masks = pred['instances'].pred_masks.cpu().numpy()
 
     pred_class = torch.mode(pred['instances'].pred_classes)[0]
     take = pred['instances'].scores >= SCORE_THRESHOLDS[pred_class]
     pred_masks = pred['instances'].pred_masks[take]
-    pred_masks = pred_masks.cpu().numpy()
-
-    masks_after_threshold = []
-    for mask in pred_masks:
-        if mask.sum() >= MIN_PIXELS[pred_class]: # skip predictions with small area
-            masks_after_threshold.append(mask)
+    # 在 mask 所在的设备上编码成游程, 面积直接由游程长度求和, 不再对每个稠密 mask 调用 mask.sum()
+    pred_runs = InstanceRuns.from_dense(pred_masks)
+    pred_runs = pred_runs.select(pred_runs.areas() >= MIN_PIXELS[pred_class]) # skip predictions with small area
     
-    if masks_after_threshold == []:
+    if len(pred_runs) == 0:
         return 0
     
-    enc_preds = [mask_util.encode(np.asarray(p, order='F')) for p in masks_after_threshold]
+    enc_preds = pred_runs.to_coco()
 
     # enc_preds = [mask_util.encode(np.asarray(p, order='F')) for p in pred_masks]
     enc_targs = list(map(lambda x:x['segmentation'], targ))
     ious = mask_util.iou(enc_preds, enc_targs, [0]*len(enc_targs))
-    prec = []
-    for t in np.arange(0.5, 1.0, 0.05):
-        tp, fp, fn = precision_at(t, ious)
-        p = tp / (tp + fp + fn)
-        prec.append(p)
-    return np.mean(prec)
+    return iou_map(ious, strict=True)
 
 class MAPIOUEvaluator(DatasetEvaluator):
     def __init__(self, dataset_name):
-        dataset_dicts = DatasetCatalog.get(dataset_name)
-        self.annotations_cache = {item['image_id']:item['annotations'] for item in dataset_dicts}
+        # GT 预先解码后按标注文件哈希缓存在磁盘上, 每个 EVAL_PERIOD 重建 evaluator 时只需 mmap
+        self.annotations_cache = GTCache.from_dataset(dataset_name)
             
     def reset(self):
         self.scores = []
@@ -95,6 +89,17 @@ class MAPIOUEvaluator(DatasetEvaluator):
         return {"MaP IoU": np.mean(self.scores)}
 
 class Trainer(DefaultTrainer):
+    @classmethod
+    def build_train_loader(cls, cfg):
+        # DatasetMapper 的 read_image 走共享内存缓存, 所有 worker、每个 epoch 和之后的 fold 每张图只解码一次
+        if IMAGE_CACHE_MB > 0:
+            # 名字由 OUTPUT_DIR 决定, 所有 rank 挂载同一块内存, 由主 rank 在退出时释放
+            patch_detectron2_read_image(SharedImageCache(run_cache_name("d2_images", cfg.OUTPUT_DIR), capacity=IMAGE_CACHE_MB << 20,
+                                                         unlink=comm.is_main_process()))
+        if BALANCE_INSTANCES:
+            return build_balanced_train_loader(cfg)
+        return super().build_train_loader(cfg)
+
     @classmethod
     def build_evaluator(cls, cfg, dataset_name, output_folder=None):
         return MAPIOUEvaluator(dataset_name)
@@ -11,6 +11,7 @@ import numpy as np
 import os
 from tqdm.notebook import tqdm
 import cv2
+from toolbox.rle_box.kaggle_rle import decode_kaggle_rles
 
 ## 1. 关于train.csv的数据
 # 相关内容可以在竞赛网站的 data 选项卡中观察得到
@@ -87,17 +88,7 @@ def decode_rle_mask(rle_mask, shape):
     mask [numpy.ndarray of shape (height, width)]: Decoded 2d segmentation mask
     """
 
-    rle_mask = rle_mask.split()
-    starts, lengths = [np.asarray(x, dtype=int) for x in (rle_mask[0:][::2], rle_mask[1:][::2])]
-    starts -= 1
-    ends = starts + lengths
-
-    mask = np.zeros((shape[0] * shape[1]), dtype=np.uint8)
-    for start, end in zip(starts, ends):
-        mask[start:end] = 1
-
-    mask = mask.reshape(shape[0], shape[1])
-    return mask
+    return decode_kaggle_rles([rle_mask], shape)[0]
 
 # 注释： 可以使用如下的方式提取出 纯粹的 train 和 纯粹的 semi 部分
 for image_id in tqdm(df_train.loc[~df_train['annotation'].isnull(), 'id'].unique()):
@@ -108,8 +99,9 @@ for image_id in tqdm(df_train.loc[~df_train['annotation'].isnull(), 'id'].unique
     df_train.loc[df_train['id'] == image_id, 'image_mean'] = np.mean(image)
     df_train.loc[df_train['id'] == image_id, 'image_std'] = np.std(image)
 
-    for rle_mask in df_train.loc[df_train['id'] == image_id, 'annotation']:
-        mask = decode_rle_mask(rle_mask, (520, 704))
+    rle_masks = list(df_train.loc[df_train['id'] == image_id, 'annotation'])
+    # 一张图的全部标注一次解码
+    for rle_mask, mask in zip(rle_masks, decode_kaggle_rles(rle_masks, (520, 704))):
         df_train.loc[(df_train['id'] == image_id) & (df_train['annotation'] == rle_mask), 'mask_area'] = np.sum(mask) # mask_area指的是当前这个实例
         # 有多少个标记像素
 
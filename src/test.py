@@ -16,7 +16,7 @@ from detectron2.engine import DefaultPredictor, DefaultTrainer
 from detectron2.config import get_cfg
 from detectron2.utils.visualizer import Visualizer, ColorMode
 from detectron2.data import MetadataCatalog, DatasetCatalog
-from detectron2.data.datasets import register_coco_instances
+from toolbox.data_box.dataset_dicts import register_coco_instances
 from detectron2.utils.logger import setup_logger
 from detectron2.evaluation.evaluator import DatasetEvaluator
 import albumentations as A
@@ -29,6 +29,7 @@ import json
 import logging
 import glob
 import gc
+from toolbox.data_box.coco_stream import iter_coco, write_coco
 
 ###########################################################################################################################################################
 # 2021年12月17日更新： 实现 1toCat 函数 将json文件中的  0 - 7分类修正为 1分类问题 以便于训练
@@ -40,25 +41,27 @@ def to1Cat(json_pth_lists):
         'livecell_1cat_annotations_test.json'
     ]
     for idx,pth in enumerate(json_pth_lists):
-        # 读入对应的 json文件
+        # 流式读入对应的 json文件, 逐个元素改写后写出, 不把几百 MB 的标注整个读进内存
         try:
-            with open(pth) as f:
-                data_json = json.loads(f.read())
-                # 展示一下 data_json 字典中的键值
-                print(data_json.keys())
-                # 修改 cate_id 一共对应 两个部分  
-                # 1. 字典键值中的  categories 字段
-                data_json['categories'] = [{'name':'cell', 'id':1}]
-                # 2. 修改 annotations 中 所有的 segmentations 字段
-                for element_dic in data_json['annotations']:
-                    element_dic['category_id'] = 1
-                # 将改写完的文件转存
-                with open(pth_out_name[idx], 'w', encoding='utf-8') as f:
-                    json.dump(data_json, f, ensure_ascii=True, indent=4)
-                del data_json
-                gc.collect()
+            write_coco(pth_out_name[idx], _one_category(iter_coco(pth)))
         except:
             raise("Open Json file failed")
+
+
+def _one_category(items):
+    # 修改 cate_id 一共对应 两个部分
+    for key, index, obj, _, _ in items:
+        if key == 'categories':
+            # 1. 字典键值中的  categories 字段
+            if index in (None, 0):
+                yield key, None, [{'name':'cell', 'id':1}]
+        elif key == 'annotations':
+            # 2. 修改 annotations 中 所有的 segmentations 字段
+            obj['category_id'] = 1
+            yield key, index, obj
+        else:
+            yield key, index, obj
+
 ###########################################################################################################################################################
 # 2021年12月20日更新： https://www.kaggle.com/c/sartorius-cell-instance-segmentation/discussion/295603 
 # 根据上面链接的描述，这个discussion指出压缩过的 RLE编码可能存在某些bug 导致漏检，为了检查这个问题，将
@@ -118,6 +121,20 @@ def SplitBie(bie_json_pth,Standard_json_pth,fold_id):
     except:
         raise("Error: Fail to open json files!!")
 
+###########################################################################################################################################################
+# 2021年12月31日更新： 压缩 / 未压缩 RLE 之间的差异不再需要训练一遍模型来确认
+# 先对两个文件各自做往返校验 (area / bbox 对不上通常说明未压缩 RLE 是按行写出的), 再逐个实例比较 mask 是否一致
+def CheckBie(bie_json_pth,Standard_json_pth,num_workers=4):
+    '''
+    bie_json_pth: 传入 bie 未压缩划分的地址
+    Standard_json_pth： 传入 标准 经过压缩的 划分地址
+    Return: 返回 mask 不一致的 annotation id 列表
+    '''
+    from toolbox.rle_box.rle_codec import compare_json, verify_json
+    verify_json(bie_json_pth, num_workers=num_workers)
+    verify_json(Standard_json_pth, num_workers=num_workers)
+    return compare_json(bie_json_pth, Standard_json_pth, num_workers=num_workers)
+
 
 
 
@@ -198,13 +198,20 @@ import nni
 import numpy as np
 import pandas as pd
 import pycocotools.mask as mask_util
+from toolbox.data_box.grayscale import to_grayscale_cfg
+from toolbox.data_box.image_cache import SharedImageCache, patch_detectron2_read_image, run_cache_name
+from toolbox.data_box.instance_sampler import build_balanced_train_loader
+from toolbox.data_box.shard_store import ShardStore, register_shard_dataset
+from toolbox.metric_box.competition_metric import iou_map
+from toolbox.metric_box.gt_cache import GTCache
+from toolbox.rle_box.rle_ops import InstanceRuns
 import torch
 # import some common detectron2 utilities
 from detectron2 import model_zoo
 from detectron2.checkpoint import DetectionCheckpointer
 from detectron2.config import get_cfg
 from detectron2.data import DatasetCatalog, MetadataCatalog
-from detectron2.data.datasets import register_coco_instances
+from toolbox.data_box.dataset_dicts import register_coco_instances
 from detectron2.engine import (BestCheckpointer, DefaultPredictor,
                                DefaultTrainer, default_argument_parser,
                                default_setup, hooks, launch)
@@ -217,71 +224,18 @@ from detectron2.utils.visualizer import ColorMode, Visualizer
 
 SCORE_THRESHOLDS = [.25, .45, .65]
 MIN_PIXELS = [60, 140, 75]
+# 解码后图片的共享内存缓存 (MB), 0 表示不启用
+IMAGE_CACHE_MB = 0
+# 单通道输入: 读图 / 缓存 / 拷贝到 GPU 只有 1 个通道, stem 的 RGB 预训练权重加载时折叠成单通道
+GRAYSCALE = False
+# 从打包好的分片读取图片与标注 (所有 fold 共用一份, 第一次运行时打包到 ../data/.shards), False 时按原来的 json + PNG 读取
+SHARD_STORE = False
+# 按每张图的实例数凑 batch, 各 batch / 各 rank 的总实例数接近 (显存峰值与每步耗时更平稳), False 时为原来的 TrainingSampler
+BALANCE_INSTANCES = False
 matrix = [[],[],[],[],[]]
 matrix_fold_id = 0
 
 ####################################################################################################################################################################
-def precision_at(threshold, iou):
-    """
-    Computes the precision at a given threshold.
-
-    Args:
-        threshold (float): Threshold.
-        iou (np array [n_truths x n_preds]): IoU matrix.
-
-    Returns:
-        int: Number of true positives,
-        int: Number of false positives,
-        int: Number of false negatives.
-    """
-    matches = iou > threshold
-    true_positives = np.sum(matches, axis=1) >= 1  # Correct objects
-    false_negatives = np.sum(matches, axis=1) == 0  # Missed objects
-    false_positives = np.sum(matches, axis=0) == 0  # Extra objects
-    tp, fp, fn = (
-        np.sum(true_positives),
-        np.sum(false_positives),
-        np.sum(false_negatives),
-    )
-    return tp, fp, fn
-
-
-def iou_map(ious,verbose=0):
-    """
-    Computes the metric for the competition.
-    Masks contain the segmented pixels where each object has one value associated,
-    and 0 is the background.
-
-    Args:
-        truths (list of masks): Ground truths.
-        preds (list of masks): Predictions.
-        verbose (int, optional): Whether to print infos. Defaults to 0.
-
-    Returns:
-        float: mAP.
-    """
-
-    if verbose:
-        print("Thresh\tTP\tFP\tFN\tPrec.")
-
-    prec = []
-    for t in np.arange(0.5, 1.0, 0.05):
-        tps, fps, fns = 0, 0, 0
-        tp, fp, fn = precision_at(t, ious)
-        tps += tp
-        fps += fp
-        fns += fn
-
-        p = tps / (tps + fps + fns)
-        prec.append(p)
-
-        if verbose:
-            print("{:1.3f}\t{}\t{}\t{}\t{:1.3f}".format(t, tps, fps, fns, p))
-
-    if verbose:
-        print("AP\t-\t-\t-\t{:1.3f}".format(np.mean(prec)))
-
-    return np.mean(prec)
 ######################################################################修改一下的参数#################################################################################
 ## 注册  评估流程
 def score(pred, targ):
@@ -295,17 +249,14 @@ def score(pred, targ):
     take = take_mojorities & take
 
     pred_masks = pred['instances'].pred_masks[take]
-    pred_masks = pred_masks.cpu().numpy()
-
-    masks_after_threshold = []
-    for mask in pred_masks:
-        if mask.sum() >= MIN_PIXELS[pred_class]: # skip predictions with small area
-            masks_after_threshold.append(mask)
+    # 在 mask 所在的设备上编码成游程, 面积直接由游程长度求和, 不再对每个稠密 mask 调用 mask.sum()
+    pred_runs = InstanceRuns.from_dense(pred_masks)
+    pred_runs = pred_runs.select(pred_runs.areas() >= MIN_PIXELS[pred_class]) # skip predictions with small area
     
-    if masks_after_threshold == []:
+    if len(pred_runs) == 0:
         return 0
     
-    enc_preds = [mask_util.encode(np.asarray(p, order='F')) for p in masks_after_threshold]
+    enc_preds = pred_runs.to_coco()
 
     # enc_preds = [mask_util.encode(np.asarray(p, order='F')) for p in pred_masks]
     enc_targs = list(map(lambda x:x['segmentation'], targ))
@@ -314,8 +265,8 @@ def score(pred, targ):
 
 class MAPIOUEvaluator(DatasetEvaluator):
     def __init__(self, dataset_name):
-        dataset_dicts = DatasetCatalog.get(dataset_name)
-        self.annotations_cache = {item['image_id']:item['annotations'] for item in dataset_dicts}
+        # GT 预先解码后按标注文件哈希缓存在磁盘上, 每个 EVAL_PERIOD 重建 evaluator 时只需 mmap
+        self.annotations_cache = GTCache.from_dataset(dataset_name)
             
     def reset(self):
         self.scores = []
@@ -335,6 +286,17 @@ class MAPIOUEvaluator(DatasetEvaluator):
         return {"MaP IoU": np.mean(self.scores)}
 
 class Trainer(DefaultTrainer):
+    @classmethod
+    def build_train_loader(cls, cfg):
+        # DatasetMapper 的 read_image 走共享内存缓存, 所有 worker、每个 epoch 和之后的 fold 每张图只解码一次
+        if IMAGE_CACHE_MB > 0:
+            # 名字由 OUTPUT_DIR 决定, 所有 rank 挂载同一块内存, 由主 rank 在退出时释放
+            patch_detectron2_read_image(SharedImageCache(run_cache_name("d2_images", cfg.OUTPUT_DIR), capacity=IMAGE_CACHE_MB << 20,
+                                                         unlink=comm.is_main_process()))
+        if BALANCE_INSTANCES:
+            return build_balanced_train_loader(cfg)
+        return super().build_train_loader(cfg)
+
     @classmethod
     def build_evaluator(cls, cfg, dataset_name, output_folder=None):
         return COCOEvaluator(dataset_name, cfg = cfg, distributed = True, output_dir = output_folder,TOPK_TYPE= 'livecell')
@@ -369,8 +331,18 @@ def setup(args,fold_id):
     cfg.OUTPUT_DIR  ="/storage/Kaggle_Cell_Segmentation/model/MaskRNN/test46"
     os.makedirs(cfg.OUTPUT_DIR, exist_ok=True)
     cfg.INPUT.MASK_FORMAT='bitmask'
-    register_coco_instances('sartorius_train{}'.format(fold_id),{}, '../data/1997_split_train_fold{}.json'.format(fold_id), dataDir)
-    register_coco_instances('sartorius_val{}'.format(fold_id),{},'../data/1997_split_val_fold{}.json'.format(fold_id), dataDir)
+    if SHARD_STORE:
+        shard_jsons = ['../data/1997_split_{}_fold{}.json'.format(split, k) for k in range(1, 6) for split in ('train', 'val')]
+        # 只由主进程打包, 其他 rank 等打包完成后再打开
+        if comm.is_main_process():
+            ShardStore.load(shard_jsons, dataDir)
+        comm.synchronize()
+        store = ShardStore.load(shard_jsons, dataDir)
+        register_shard_dataset('sartorius_train{}'.format(fold_id), store, '1997_split_train_fold{}'.format(fold_id), dataDir)
+        register_shard_dataset('sartorius_val{}'.format(fold_id), store, '1997_split_val_fold{}'.format(fold_id), dataDir)
+    else:
+        register_coco_instances('sartorius_train{}'.format(fold_id),{}, '../data/1997_split_train_fold{}.json'.format(fold_id), dataDir)
+        register_coco_instances('sartorius_val{}'.format(fold_id),{},'../data/1997_split_val_fold{}.json'.format(fold_id), dataDir)
 
     cfg.DATASETS.TRAIN = ('sartorius_train{}'.format(fold_id), )
     cfg.DATASETS.TEST = ('sartorius_val{}'.format(fold_id),)
@@ -406,6 +378,8 @@ def setup(args,fold_id):
     cfg.MODEL.RPN.BATCH_SIZE_PER_IMAGE = 256
     cfg.MODEL.PIXEL_MEAN = [128, 128, 128]
     cfg.MODEL.PIXEL_STD = [11.578, 11.578, 11.578]
+    if GRAYSCALE:
+        to_grayscale_cfg(cfg)
 
     cfg.MODEL.RETINANET.NUM_CLASSES = 8
     cfg.MODEL.RETINANET.TOPK_CANDIDATES_TEST = 3000
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-#
+# -------------------------------------------------------------------------------
+# Name:         albu_mapper
+# Description:  在 DataLoader worker 里现做 albumentations 增强的 detectron2 DatasetMapper
+#               Baup_Detecron2_rex101_NNI_Albu_PreLive.py 训练时把事先离线生成的 albu_bie_annotations_train_fold*.json
+#               (增强后的图片副本 + 标注) 当作第二个数据集读入: 每个 fold 一份副本占磁盘, 生成要单独跑一遍,
+#               每个 epoch 看到的也永远是同一份增强结果。
+#               AlbuDatasetMapper 读原图, 把实例 mask 压成几张不重叠的标签图 (同一层内实例不重叠, 只有重叠的细胞才进入下一层),
+#               albumentations 的空间变换对每层按最近邻做, 与对每个 mask 单独做完全相同, 之后再走 cfg 里的
+#               ResizeShortestEdge / RandomFlip, 最后才展开成 BitMasks。
+#               每次增强的随机数由 (seed, image_id, 这张图在本 worker 中第几次被取到) 决定, 同样的 seed / num_workers 可以复现
+# Author:       Administrator
+# Date:         2021/12/31
+# -------------------------------------------------------------------------------
+import collections
+import copy
+import hashlib
+import random
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from toolbox.rle_box.rle_codec import coco_counts, counts_to_runs, to_compressed
+
+
+def layer_masks(segmentations, height, width):
+    """
+    Compact masks of possibly overlapping instances.
+
+    Args:
+        segmentations (list): COCO segmentations (polygons or RLE) of the instances.
+
+    Returns:
+        tuple: layers (uint16 np array [K x H x W], instance i is i + 1 in layers[layer_of[i]], K >= 1),
+            layer_of (int64 np array [N]); instances of one layer do not overlap, so K stays small.
+    """
+    # 按列优先 (与 COCO RLE 相同) 的一维数组绘制, 游程直接展开成下标, 不解码稠密 mask
+    layers = [np.zeros(height * width, dtype=np.uint16)]
+    layer_of = np.zeros(len(segmentations), dtype=np.int64)
+    for i, segm in enumerate(segmentations):
+        starts, lengths = counts_to_runs(coco_counts(to_compressed(segm, height, width)))
+        offsets = np.cumsum(lengths) - lengths
+        pixels = np.arange(int(lengths.sum())) - np.repeat(offsets, lengths) + np.repeat(starts, lengths)
+        for k, layer in enumerate(layers):
+            if not layer[pixels].any():
+                break
+        else:
+            layers.append(np.zeros(height * width, dtype=np.uint16))
+            k = len(layers) - 1
+        layers[k][pixels] = i + 1
+        layer_of[i] = k
+    return np.stack([layer.reshape(width, height).T for layer in layers]), layer_of
+
+
+def expand_layers(layers, layer_of):
+    """
+    Dense bool masks [N x H x W] of layer_masks' output, after it went through the transforms.
+    """
+    masks = np.zeros((len(layer_of),) + layers.shape[1:], dtype=bool)
+    flat = masks.reshape(len(layer_of), -1)
+    # 只写前景像素, 不对每个实例比较整张图
+    for layer in layers.reshape(len(layers), -1):
+        pixels = np.flatnonzero(layer)
+        flat[layer[pixels].astype(np.int64) - 1, pixels] = True
+    return masks
+
+
+def apply_uint8(apply, layers):
+    """
+    Applies apply (e.g. detectron2's transforms.apply_segmentation) to the uint16 layers as uint8 planes
+    (low and high byte), so it takes the same uint8 path (PIL nearest, center aligned) as the image and as
+    DatasetMapper's per-instance masks; a nearest resampler picks the same source pixel for both planes.
+    """
+    out = []
+    for layer in np.asarray(layers, dtype=np.uint16):
+        low = apply(np.ascontiguousarray(layer & 0xFF).astype(np.uint8))
+        if layer.max() > 0xFF:
+            high = apply(np.ascontiguousarray(layer >> 8).astype(np.uint8))
+        else:
+            high = np.zeros_like(low)
+        out.append(low.astype(np.uint16) | (high.astype(np.uint16) << 8))
+    return np.stack(out)
+
+
+def sample_seed(seed, key, draw):
+    """ Seed of the draw-th augmentation of the sample key (e.g. its image_id). """
+    digest = hashlib.sha1("{}|{}|{}".format(seed, key, draw).encode("utf-8")).digest()
+    return int.from_bytes(digest[:4], "little")
+
+
+@contextmanager
+def seeded(seed):
+    """
+    Seeds random and np.random (albumentations draws from both) and restores them afterwards,
+    the rest of the worker (detectron2 augmentations) keeps its own random stream.
+    """
+    state, np_state = random.getstate(), np.random.get_state()
+    random.seed(seed)
+    np.random.seed(seed)
+    try:
+        yield
+    finally:
+        random.setstate(state)
+        np.random.set_state(np_state)
+
+
+def albu_compact(transform, image, layers, seed):
+    """
+    Applies the albumentations transform to the image and, as masks, to the compact layers with the given seed.
+    """
+    with seeded(seed):
+        out = transform(image=image, masks=list(layers))
+    return out["image"], np.stack(out["masks"])
+
+
+class AlbuDatasetMapper:
+    """
+    detectron2 DatasetMapper (training, instance masks) that first applies an albumentations transform.
+
+    Args:
+        cfg: detectron2 cfg; image format and the cfg augmentations (ResizeShortestEdge, RandomFlip, crop)
+            are the same as DatasetMapper(cfg, True).
+        transform (callable): albumentations transform called as transform(image=..., masks=[...]),
+            e.g. A.Compose([...], p=0.5) keeps half of the samples unchanged, like mixing the originals with one copy.
+        seed (int): base seed of the per-sample seeds.
+    """
+
+    def __init__(self, cfg, transform, seed=0, is_train=True):
+        import detectron2.data.transforms as T
+        from detectron2.data import detection_utils
+
+        self.transform = transform
+        self.seed = seed
+        self.image_format = cfg.INPUT.FORMAT
+        self.augmentations = detection_utils.build_augmentation(cfg, is_train)
+        if cfg.INPUT.CROP.ENABLED and is_train:
+            self.augmentations.insert(0, T.RandomCrop(cfg.INPUT.CROP.TYPE, cfg.INPUT.CROP.SIZE))
+        self._draws = collections.Counter()
+
+    def __call__(self, dataset_dict):
+        import torch
+        import detectron2.data.transforms as T
+        from detectron2.data import detection_utils
+        from detectron2.structures import BitMasks, Instances
+
+        dataset_dict = copy.deepcopy(dataset_dict)
+        image = detection_utils.read_image(dataset_dict["file_name"], format=self.image_format)
+        annotations = [ann for ann in dataset_dict.pop("annotations") if ann.get("iscrowd", 0) == 0]
+        layers, layer_of = layer_masks([ann["segmentation"] for ann in annotations], *image.shape[:2])
+
+        key = dataset_dict.get("image_id", dataset_dict["file_name"])
+        self._draws[key] += 1
+        image, layers = albu_compact(self.transform, image, layers, sample_seed(self.seed, key, self._draws[key]))
+
+        aug_input = T.AugInput(image)
+        transforms = T.AugmentationList(self.augmentations)(aug_input)
+        image = aug_input.image
+        # detectron2 对非 uint8 的分割图改用 F.interpolate(nearest, 向下取整对齐), 与图片的 PIL 缩放差最多 1 像素,
+        # 所以按字节拆成 uint8 平面缩放
+        layers = apply_uint8(transforms.apply_segmentation, layers)
+        masks = expand_layers(layers, layer_of)
+
+        dataset_dict["image"] = torch.as_tensor(np.ascontiguousarray(image.transpose(2, 0, 1)))
+        instances = Instances(image.shape[:2])
+        instances.gt_classes = torch.tensor([ann["category_id"] for ann in annotations], dtype=torch.int64)
+        instances.gt_masks = BitMasks(torch.from_numpy(masks))
+        # 增强之后 box 由 mask 重新计算, 移出图片的实例被去掉
+        instances.gt_boxes = instances.gt_masks.get_bounding_boxes()
+        dataset_dict["instances"] = detection_utils.filter_empty_instances(instances)
+        return dataset_dict
+
+
+###########################################################################################################################################################
+# 基准测试: 与离线生成增强副本 (图片 + RLE 标注写盘, 训练时和原图一起读入) 对比  python -m toolbox.data_box.albu_mapper
+def _flip_rotate(image, masks):
+    # 与 albumentations 的调用方式相同的空间变换: 随机翻转 + ShiftScaleRotate 式的旋转 (mask 用最近邻), 随机数来自 np.random
+    import cv2
+
+    if np.random.rand() < 0.5:
+        image, masks = image[:, ::-1], [m[:, ::-1] for m in masks]
+    if np.random.rand() < 0.5:
+        image, masks = image[::-1], [m[::-1] for m in masks]
+    height, width = image.shape[:2]
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), np.random.uniform(-30, 30), 1.0)
+    image = cv2.warpAffine(np.ascontiguousarray(image), matrix, (width, height), flags=cv2.INTER_LINEAR)
+    masks = [cv2.warpAffine(np.ascontiguousarray(m), matrix, (width, height), flags=cv2.INTER_NEAREST) for m in masks]
+    return {"image": image, "masks": masks}
+
+
+def benchmark(n_images=6, n_truths=400, seed=3407):
+    import json
+    import os
+    import shutil
+    import tempfile
+
+    import cv2
+    import pycocotools.mask as mask_util
+
+    from toolbox.metric_box.sparse_iou import _random_cells
+
+    tmp = tempfile.mkdtemp()
+    rng = np.random.RandomState(seed)
+    samples = []
+    for k in range(n_images):
+        masks = _random_cells(n_truths, seed=seed + k)
+        # 平移一部分实例, 制造重叠的细胞
+        masks[::9] = np.roll(masks[::9], 5, axis=2)
+        gray = np.clip(128 + rng.normal(0, 8, masks.shape[1:]) + 40 * masks.any(axis=0), 0, 255).astype(np.uint8)
+        path = os.path.join(tmp, "img{}.png".format(k))
+        cv2.imwrite(path, np.repeat(gray[:, :, None], 3, axis=2))
+        rles = mask_util.encode(np.asfortranarray(masks.transpose(1, 2, 0).astype(np.uint8)))
+        samples.append((k, path, rles))
+
+    # 分层的紧凑 mask 与稠密 mask 相同
+    layers, layer_of = layer_masks(samples[0][2], 520, 704)
+    dense = mask_util.decode(samples[0][2]).transpose(2, 0, 1).astype(bool)
+    assert np.array_equal(expand_layers(layers, layer_of), dense)
+    # 对分层做变换 == 对每个 mask 单独做同样的变换
+    image = cv2.imread(samples[0][1])
+    _, out_layers = albu_compact(_flip_rotate, image, layers, sample_seed(seed, 0, 1))
+    with seeded(sample_seed(seed, 0, 1)):
+        out_dense = np.stack(_flip_rotate(image, list(dense.astype(np.uint8)))["masks"])
+    assert np.array_equal(expand_layers(out_layers, layer_of), out_dense.astype(bool))
+    # 非整数倍缩放: 按字节拆开的 uint8 平面 == 每个 mask 单独走 uint8 最近邻 (与 PIL NEAREST 相同的中心对齐)
+    # 标签超过 255 时高字节平面也参与
+    def resize(m):
+        return cv2.resize(m, (965, 713), interpolation=cv2.INTER_NEAREST_EXACT)
+
+    assert layers.max() > 0xFF
+    resized = expand_layers(apply_uint8(resize, layers), layer_of)
+    assert np.array_equal(resized, np.stack([resize(m.astype(np.uint8)) for m in dense]).astype(bool))
+    # 同一个 (seed, image_id, 次数) 结果相同, 下一次取到时不同
+    again = albu_compact(_flip_rotate, image, layers, sample_seed(seed, 0, 1))[1]
+    assert np.array_equal(again, out_layers)
+    assert not np.array_equal(albu_compact(_flip_rotate, image, layers, sample_seed(seed, 0, 2))[1], out_layers)
+
+    # 离线生成副本: 增强、写 PNG、重新编码 RLE、写 json
+    start = time.perf_counter()
+    copies = []
+    for k, path, rles in samples:
+        with seeded(sample_seed(seed, k, 0)):
+            out = _flip_rotate(cv2.imread(path), list(mask_util.decode(rles).transpose(2, 0, 1)))
+        copy_path = os.path.join(tmp, "albu_img{}.png".format(k))
+        cv2.imwrite(copy_path, out["image"])
+        copy_rles = mask_util.encode(np.asfortranarray(np.stack(out["masks"], axis=2)))
+        copies.append((k, copy_path, copy_rles))
+    with open(os.path.join(tmp, "albu_annotations.json"), "w") as f:
+        json.dump([[k, p, [dict(r, counts=r["counts"].decode("ascii")) for r in rles]] for k, p, rles in copies], f)
+    t_prep = time.perf_counter() - start
+    disk = sum(os.path.getsize(os.path.join(tmp, f)) for f in os.listdir(tmp) if f.startswith("albu_"))
+
+    # 一个 epoch = 原图 + 副本, 与 DatasetMapper 的 bitmask 路径相同: 每个标注解码成稠密 mask, 再逐个做 flip
+    start = time.perf_counter()
+    for k, path, rles in samples + copies:
+        image = cv2.imread(path)[:, ::-1]
+        masks = [m[:, ::-1] for m in mask_util.decode(rles).transpose(2, 0, 1)]
+        static = np.stack(masks).astype(bool)
+    t_static = time.perf_counter() - start
+
+    # 现做: 每张原图取两次 (一次原样、一次增强), 增强和 flip 都在分层上完成
+    start = time.perf_counter()
+    for draw in (1, 2):
+        for k, path, rles in samples:
+            image = cv2.imread(path)
+            layers, layer_of = layer_masks(rles, 520, 704)
+            if draw == 2:
+                image, layers = albu_compact(_flip_rotate, image, layers, sample_seed(seed, k, draw))
+            image, layers = image[:, ::-1], layers[:, :, ::-1]
+            fly = expand_layers(layers, layer_of)
+    t_fly = time.perf_counter() - start
+
+    shutil.rmtree(tmp, ignore_errors=True)
+    print("{} images x {} instances, {} layers for the first image".format(n_images, n_truths, len(layers)))
+    print("static copies, prep (once per fold) : {:8.2f} ms  {:6.2f} MB on disk".format(t_prep * 1e3, disk / 2 ** 20))
+    print("static copies, epoch                : {:8.2f} ms  {:.1f} samples/s".format(
+        t_static * 1e3, 2 * n_images / t_static))
+    print("on the fly, epoch                   : {:8.2f} ms  {:.1f} samples/s  (x{:.1f})".format(
+        t_fly * 1e3, 2 * n_images / t_fly, t_static / t_fly))
+
+
+if __name__ == '__main__':
+    benchmark()
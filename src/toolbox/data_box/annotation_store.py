@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-#
+# -------------------------------------------------------------------------------
+# Name:         annotation_store
+# Description:  训练集标注的一次性解码 + 内存映射存储
+#               CellDataset.__init__ 每次都用 pandas groupby 聚合 train.csv, __getitem__ 每个 epoch、每个 DataLoader worker
+#               都要重新解析每张图的全部 RLE 字符串并重新计算 bbox; NNI 的每个 trial 又把同样的解码重复一遍。
+#               这里把每张图解码成一张 uint16 标签图 (后出现的实例覆盖先出现的) + 重叠像素的边表 (被覆盖的 (实例, 像素)),
+#               连同 bbox / 面积 / 类别按偏移量索引写入磁盘, 目录名为标注内容的哈希;
+#               之后所有 worker / trial 只读地 np.load(mmap_mode='r'), 取一张图的标注只是切片, 不复制数据
+# Author:       Administrator
+# Date:         2021/12/31
+# -------------------------------------------------------------------------------
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from toolbox.metric_box.gt_cache import file_hash
+from toolbox.metric_box.parallel_score import ScorePool
+from toolbox.rle_box.kaggle_rle import _boxes, _pixels, parse_kaggle_rles
+
+# 存储格式变化时修改, 旧的存储自动失效
+STORE_VERSION = 1
+
+_ARRAYS = ("label_offsets", "labels", "ann_offsets", "boxes", "areas", "classes",
+           "overlap_offsets", "overlap_ids", "overlap_pixels")
+
+
+def decode_image(rles, shape):
+    """
+    Decodes the Kaggle RLEs of one image, module level so it can be sent to a process pool.
+
+    Returns:
+        tuple: labels (uint16 [H*W], instance i is i + 1, the later instance wins),
+            overlap_ids / overlap_pixels (int32 [K]) the pixels of every instance hidden by a later one,
+            boxes (int32 [N x 4] inclusive, like get_box), areas (int32 [N]).
+    """
+    height, width = shape
+    starts, lengths, n_runs = parse_kaggle_rles(rles)
+    assert len(n_runs) < np.iinfo(np.uint16).max, "too many instances for a uint16 label image"
+    ids, pixels = _pixels(starts, lengths, n_runs)
+    labels = np.zeros(height * width, dtype=np.uint16)
+    np.maximum.at(labels, pixels, (ids + 1).astype(np.uint16))
+    hidden = labels[pixels] != ids + 1
+    return (labels, ids[hidden].astype(np.int32), pixels[hidden].astype(np.int32),
+            _boxes(ids, pixels, len(n_runs), width).astype(np.int32),
+            np.bincount(ids, minlength=len(n_runs)).astype(np.int32))
+
+
+def frame_hash(df, columns=("id", "annotation", "cell_type")):
+    """
+    sha1 of the annotation columns of a DataFrame, so the same split maps to the same store in every trial.
+    """
+    import pandas as pd
+
+    values = pd.util.hash_pandas_object(df[list(columns)], index=False).values
+    return hashlib.sha1(values.tobytes()).hexdigest()
+
+
+class AnnotationStore:
+    """
+    Read-only, memory-mapped decoded annotations of a train.csv style table (one row per instance).
+
+    Image k has the (H x W) label image labels[label_offsets[k]:label_offsets[k + 1]] and the instances
+    ann_offsets[k]:ann_offsets[k + 1] in boxes / areas / classes; overlap_ids (local instance index) and
+    overlap_pixels (flat pixel index) of image k are overlap_offsets[k]:overlap_offsets[k + 1].
+    Every accessor returns a view of the memory map, nothing is copied.
+
+    Pickling keeps only the path, each DataLoader worker maps the files again instead of copying them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        self.image_ids = meta["image_ids"]
+        self.image_sizes = [tuple(size) for size in meta["image_sizes"]]
+        self.cell_types = meta["cell_types"]
+        self.class_names = meta["class_names"]
+        self._index = {image_id: k for k, image_id in enumerate(self.image_ids)}
+        for name in _ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, name + ".npy"), mmap_mode="r"))
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def __contains__(self, image_id):
+        return image_id in self._index
+
+    def image_size(self, image_id):
+        return self.image_sizes[self._index[image_id]]
+
+    def cell_type(self, image_id):
+        return self.cell_types[self._index[image_id]]
+
+    def num_instances(self, image_id):
+        k = self._index[image_id]
+        return int(self.ann_offsets[k + 1] - self.ann_offsets[k])
+
+    def labels_of(self, image_id):
+        """ uint16 [H x W] label image, 0 is background. """
+        k = self._index[image_id]
+        return self.labels[self.label_offsets[k]:self.label_offsets[k + 1]].reshape(self.image_sizes[k])
+
+    def overlaps_of(self, image_id):
+        """ (instance, flat pixel) pairs hidden in the label image by a later instance. """
+        k = self._index[image_id]
+        a, b = self.overlap_offsets[k], self.overlap_offsets[k + 1]
+        return self.overlap_ids[a:b], self.overlap_pixels[a:b]
+
+    def boxes_of(self, image_id):
+        """ int [N x 4] [xmin, ymin, xmax, ymax] boxes, inclusive like get_box. """
+        k = self._index[image_id]
+        return self.boxes[self.ann_offsets[k]:self.ann_offsets[k + 1]]
+
+    def areas_of(self, image_id):
+        k = self._index[image_id]
+        return self.areas[self.ann_offsets[k]:self.ann_offsets[k + 1]]
+
+    def classes_of(self, image_id):
+        """ Index into class_names of every instance. """
+        k = self._index[image_id]
+        return self.classes[self.ann_offsets[k]:self.ann_offsets[k + 1]]
+
+    def masks(self, image_id, dtype=np.uint8):
+        """
+        Dense masks of the image, same as decode_kaggle_rles, rebuilt from the label image and the overlaps.
+
+        Returns:
+            np array [N x H x W]
+        """
+        height, width = self.image_size(image_id)
+        labels = self.labels_of(image_id).ravel()
+        fg = np.flatnonzero(labels)
+        masks = np.zeros((self.num_instances(image_id), height * width), dtype=dtype)
+        masks[labels[fg].astype(np.int64) - 1, fg] = 1
+        overlap_ids, overlap_pixels = self.overlaps_of(image_id)
+        masks[overlap_ids, overlap_pixels] = 1
+        return masks.reshape(-1, height, width)
+
+    ###########################################################################################################################################################
+    @classmethod
+    def load(cls, csv_file, shape=(520, 704), cache_dir=None, num_workers=0):
+        """
+        Opens the store of csv_file, builds it first if it does not exist yet.
+
+        Args:
+            csv_file (str): train.csv style table with id, annotation and cell_type columns.
+            shape (tuple): (height, width) of the images.
+            cache_dir (str, optional): where stores are kept, defaults to .ann_store next to csv_file.
+            num_workers (int): processes decoding the images when building.
+        """
+        import pandas as pd
+
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(os.path.abspath(csv_file)), ".ann_store")
+        path = os.path.join(cache_dir, "v{}_{}_{}x{}".format(STORE_VERSION, file_hash(csv_file), *shape))
+        if not os.path.exists(os.path.join(path, "meta.json")):
+            cls.build(pd.read_csv(csv_file), shape, path, num_workers=num_workers)
+        return cls(path)
+
+    @classmethod
+    def from_frame(cls, df, shape=(520, 704), cache_dir=".ann_store", num_workers=0):
+        """
+        Store of an already loaded DataFrame (e.g. one fold of the csv), keyed by the content of its annotations.
+        """
+        path = os.path.join(cache_dir, "v{}_{}_{}x{}".format(STORE_VERSION, frame_hash(df), *shape))
+        if not os.path.exists(os.path.join(path, "meta.json")):
+            cls.build(df, shape, path, num_workers=num_workers)
+        return cls(path)
+
+    @staticmethod
+    def build(df, shape, path, num_workers=0):
+        """
+        Decodes every image of df once and writes the store to path.
+        The store is written to a temporary directory and renamed, so trials building it at the same time are safe.
+        """
+        image_ids, cell_types, jobs = [], [], []
+        # groupby 保持每张图内标注的原始顺序
+        for image_id, rows in df.groupby("id", sort=True):
+            image_ids.append(image_id)
+            cell_types.append(str(rows["cell_type"].iloc[0]))
+            jobs.append((rows["annotation"].tolist(), shape))
+        type_names = sorted(set(cell_types))
+
+        arrays = {name: [] for name in _ARRAYS if not name.endswith("offsets")}
+        label_offsets, ann_offsets, overlap_offsets = [0], [0], [0]
+        for k, (labels, overlap_ids, overlap_pixels, boxes, areas) in enumerate(
+                ScorePool(num_workers, chunk_size=8).imap(decode_image, jobs)):
+            arrays["labels"].append(labels)
+            arrays["overlap_ids"].append(overlap_ids)
+            arrays["overlap_pixels"].append(overlap_pixels)
+            arrays["boxes"].append(boxes)
+            arrays["areas"].append(areas)
+            arrays["classes"].append(np.full(len(areas), type_names.index(cell_types[k]), dtype=np.int16))
+            label_offsets.append(label_offsets[-1] + len(labels))
+            ann_offsets.append(ann_offsets[-1] + len(areas))
+            overlap_offsets.append(overlap_offsets[-1] + len(overlap_ids))
+
+        empty = {"labels": np.uint16, "overlap_ids": np.int32, "overlap_pixels": np.int32,
+                 "areas": np.int32, "classes": np.int16}
+        for name, blobs in arrays.items():
+            if name == "boxes":
+                arrays[name] = np.concatenate(blobs) if blobs else np.zeros((0, 4), dtype=np.int32)
+            else:
+                arrays[name] = np.concatenate(blobs) if blobs else np.zeros(0, dtype=empty[name])
+        arrays["label_offsets"] = np.asarray(label_offsets, dtype=np.int64)
+        arrays["ann_offsets"] = np.asarray(ann_offsets, dtype=np.int64)
+        arrays["overlap_offsets"] = np.asarray(overlap_offsets, dtype=np.int64)
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)))
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, name + ".npy"), array)
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump({"image_ids": image_ids, "image_sizes": [list(shape)] * len(image_ids),
+                       "cell_types": cell_types, "class_names": type_names}, f)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # 其他 trial 已经先写好了
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+###########################################################################################################################################################
+# 基准测试: 与 CellDataset 原来的 groupby + 每次访问解码 RLE + get_box 对比  python -m toolbox.data_box.annotation_store
+def benchmark(n_images=12, n_cells=337, seed=3407):
+    import pandas as pd
+
+    from toolbox.metric_box.sparse_iou import _random_cells
+    from toolbox.rle_box.kaggle_rle import decode_kaggle_rles, encode_kaggle_rles
+
+    rows = []
+    for k in range(n_images):
+        masks = _random_cells(n_cells, seed=seed + k)
+        for rle in encode_kaggle_rles(masks):
+            rows.append({"id": "img{:02d}".format(k), "annotation": rle, "cell_type": ("shsy5y", "astro", "cort")[k % 3]})
+    df = pd.DataFrame(rows)
+    tmp = tempfile.mkdtemp()
+    csv_file = os.path.join(tmp, "train.csv")
+    df.to_csv(csv_file, index=False)
+
+    start = time.perf_counter()
+    grouped = df.groupby(["id", "cell_type"])['annotation'].agg(lambda x: list(x)).reset_index()
+    legacy = {row["id"]: decode_kaggle_rles(row["annotation"], (520, 704), return_boxes=True)
+              for _, row in grouped.iterrows()}
+    t_legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    AnnotationStore.load(csv_file)
+    t_build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    store = AnnotationStore.load(csv_file)
+    views = {image_id: (store.labels_of(image_id), store.boxes_of(image_id)) for image_id in store.image_ids}
+    t_views = time.perf_counter() - start
+
+    start = time.perf_counter()
+    dense = {image_id: store.masks(image_id) for image_id in store.image_ids}
+    t_dense = time.perf_counter() - start
+
+    import pickle
+    assert pickle.loads(pickle.dumps(store)).path == store.path and len(pickle.dumps(store)) < 1024
+    for image_id, (masks, boxes) in legacy.items():
+        assert np.array_equal(dense[image_id], masks) and np.array_equal(views[image_id][1], boxes)
+        assert np.array_equal(store.areas_of(image_id), masks.reshape(len(masks), -1).sum(axis=1))
+        labels = np.zeros((520, 704), dtype=np.uint16)
+        for m, mask in enumerate(masks, 1):
+            labels[mask > 0] = m
+        assert np.array_equal(views[image_id][0], labels)
+    assert store.from_frame(df, cache_dir=os.path.join(tmp, "frames")).image_ids == store.image_ids
+    shutil.rmtree(tmp, ignore_errors=True)
+    print("{} images x {} instances".format(n_images, n_cells))
+    print("groupby + decode every access  : {:8.2f} ms".format(t_legacy * 1e3))
+    print("build store (once)             : {:8.2f} ms".format(t_build * 1e3))
+    print("open store + label/box views   : {:8.2f} ms  (x{:.1f})".format(t_views * 1e3, t_legacy / t_views))
+    print("dense masks from the store     : {:8.2f} ms  (x{:.1f})".format(t_dense * 1e3, t_legacy / t_dense))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-#
+# -------------------------------------------------------------------------------
+# Name:         coco_stream
+# Description:  LIVECell 规模 COCO json 的流式读取与按图片的偏移量索引
+#               LIVECell 预训练脚本、test.py:to1Cat 等都是 json.loads(f.read()) 把几百 MB 的标注整个读进来,
+#               每个进程都保留整棵树。这里按块读文件, 用 json 的 raw_decode 逐个解析顶层数组里的元素, 内存只与一个元素有关;
+#               一遍扫描记下每个标注在文件中的字节范围, 按图片分组写成磁盘索引 (目录名为文件内容的哈希),
+#               之后 loader / evaluator / 转换脚本按 image_id 随机读取一张图的标注, 不必再解析整个文件
+# Author:       Administrator
+# Date:         2021/12/31
+# -------------------------------------------------------------------------------
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from toolbox.data_box.dataset_dicts import _memo_file_hash
+
+# 索引格式变化时修改, 旧索引自动失效
+INDEX_VERSION = 1
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+
+class _Reader:
+    # 文件按 latin-1 解码, 字符下标与字节偏移一一对应; json 的结构字符都是 ASCII
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.base = 0
+        self.pos = 0
+
+    def _fill(self):
+        data = self.f.read(self.chunk_size)
+        if not data:
+            return False
+        self.base += self.pos
+        self.buf = self.buf[self.pos:] + data.decode("latin-1")
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf) or not self._fill():
+                return self.buf[self.pos:self.pos + 1]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("expected {!r} at byte {}".format(char, self.base + self.pos))
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = _DECODER.raw_decode(self.buf, self.pos)
+                # 恰好在缓冲区末尾结束的值 (例如数字) 可能被截断, 读入更多后重新解析
+                if end < len(self.buf) or not self._fill():
+                    break
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+        text = self.buf[self.pos:end]
+        if not text.isascii():
+            # 含非 ASCII 字符时按 utf-8 重新解析, 保证字符串正确
+            obj = json.loads(text.encode("latin-1").decode("utf-8"))
+        start = self.base + self.pos
+        self.pos = end
+        return obj, start, self.base + end
+
+
+def _iter_array(reader, key):
+    index = 0
+    while True:
+        yield (key, index) + reader.value()
+        index += 1
+        char = reader.peek()
+        reader.pos += 1
+        if char == "]":
+            return
+        if char != ",":
+            raise ValueError("expected ',' or ']' at byte {}".format(reader.base + reader.pos - 1))
+
+
+def iter_coco(json_file, chunk_size=1 << 22):
+    """
+    Streams the top level of a COCO json file, one array element at a time.
+
+    Yields:
+        tuple: (key, index, obj, start, end) for every element of the top level arrays ("images", "annotations", ...),
+            (key, None, value, start, end) for the other top level values and empty arrays,
+            start / end are the byte range of obj in the file.
+    """
+    with open(json_file, "rb") as f:
+        reader = _Reader(f, chunk_size)
+        reader.expect("{")
+        if reader.peek() == "}":
+            return
+        while True:
+            key, _, _ = reader.value()
+            reader.expect(":")
+            if reader.peek() != "[":
+                yield (key, None) + reader.value()
+            else:
+                start = reader.base + reader.pos
+                reader.pos += 1
+                if reader.peek() == "]":
+                    reader.pos += 1
+                    yield key, None, [], start, reader.base + reader.pos
+                else:
+                    yield from _iter_array(reader, key)
+            char = reader.peek()
+            reader.pos += 1
+            if char == "}":
+                break
+            if char != ",":
+                raise ValueError("expected ',' or '}}' at byte {}".format(reader.base + reader.pos - 1))
+
+
+def write_coco(path, items):
+    """
+    Writes a COCO json file from the (key, index, obj) items of iter_coco (possibly modified),
+    one element at a time, through a temporary file replaced at the end.
+    """
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write("{")
+        current, first = None, True
+        for key, index, obj in items:
+            if index is not None and index > 0 and key == current:
+                f.write(",\n" + json.dumps(obj))
+                continue
+            if current is not None:
+                f.write("\n]")
+                current = None
+            f.write(("\n" if first else ",\n") + json.dumps(key) + ": ")
+            first = False
+            if index is None:
+                f.write(json.dumps(obj))
+            else:
+                f.write("[\n" + json.dumps(obj))
+                current = key
+        if current is not None:
+            f.write("\n]")
+        f.write("\n}\n")
+    os.replace(tmp, path)
+
+
+class CocoIndex:
+    """
+    On-disk index of a COCO json file: the image and category records, and the byte range of every annotation,
+    grouped by image (ann_ranges[ann_offsets[k]:ann_offsets[k + 1]] belong to images[k], in file order).
+
+    Annotations are read and parsed on demand, only the index is kept in memory.
+    Pickling keeps only the path, every process opens its own file handle.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.json_file = meta["json_file"]
+        self.images = meta["images"]
+        self.categories = meta["categories"]
+        self.image_ids = [img["id"] for img in self.images]
+        self._index = {image_id: k for k, image_id in enumerate(self.image_ids)}
+        self.ann_offsets = np.load(os.path.join(path, "ann_offsets.npy"), mmap_mode="r")
+        self.ann_ranges = np.load(os.path.join(path, "ann_ranges.npy"), mmap_mode="r")
+        self._fd = None
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def __del__(self):
+        if getattr(self, "_fd", None) is not None:
+            os.close(self._fd)
+
+    def __len__(self):
+        return len(self.images)
+
+    def __contains__(self, image_id):
+        return image_id in self._index
+
+    @property
+    def num_annotations(self):
+        return int(self.ann_offsets[-1])
+
+    def image(self, image_id):
+        return self.images[self._index[image_id]]
+
+    def _read(self, start, end):
+        if self._fd is None:
+            self._fd = os.open(self.json_file, os.O_RDONLY)
+        return os.pread(self._fd, end - start, start)
+
+    def annotations(self, image_id):
+        """
+        Returns:
+            list of dict: the annotations of image_id, in file order, as json.load would give them.
+        """
+        k = self._index[image_id]
+        ranges = self.ann_ranges[self.ann_offsets[k]:self.ann_offsets[k + 1]]
+        if len(ranges) == 0:
+            return []
+        # 同一张图的标注通常在文件中是连续的, 间隔不大时一次读出整段, 否则逐个读
+        lo, hi = int(ranges[0, 0]), int(ranges[-1, 1])
+        if hi - lo <= 2 * int(np.sum(ranges[:, 1] - ranges[:, 0])):
+            block = self._read(lo, hi)
+            return [json.loads(block[s - lo:e - lo]) for s, e in ranges.tolist()]
+        return [json.loads(self._read(s, e)) for s, e in ranges.tolist()]
+
+    def __iter__(self):
+        for image in self.images:
+            yield image, self.annotations(image["id"])
+
+    ###########################################################################################################################################################
+    @classmethod
+    def load(cls, json_file, cache_dir=None):
+        """
+        Opens the index of json_file, builds it first (one streaming pass) if it does not exist yet.
+
+        Args:
+            cache_dir (str, optional): where indexes are kept, defaults to .coco_index next to json_file.
+        """
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(os.path.abspath(json_file)), ".coco_index")
+        path = os.path.join(cache_dir, "v{}_{}".format(INDEX_VERSION, _memo_file_hash(json_file)))
+        if not os.path.exists(os.path.join(path, "meta.json")):
+            cls.build(json_file, path)
+        return cls(path)
+
+    @staticmethod
+    def build(json_file, path, chunk_size=1 << 22):
+        images, categories = [], []
+        ann_image_ids, ann_ranges = [], []
+        for key, index, obj, start, end in iter_coco(json_file, chunk_size=chunk_size):
+            if key == "images" and index is not None:
+                images.append(obj)
+            elif key == "categories" and index is not None:
+                categories.append(obj)
+            elif key == "annotations" and index is not None:
+                ann_image_ids.append(obj["image_id"])
+                ann_ranges.append((start, end))
+
+        # 标注也可能写在 images 之前, 扫描完再按图片分组; 找不到图片的标注与 pycocotools 一样不属于任何图
+        image_index = {img["id"]: k for k, img in enumerate(images)}
+        owner = np.asarray([image_index.get(image_id, -1) for image_id in ann_image_ids], dtype=np.int64)
+        ranges = np.asarray(ann_ranges, dtype=np.int64).reshape(-1, 2)
+        keep = owner >= 0
+        owner, ranges = owner[keep], ranges[keep]
+        order = np.argsort(owner, kind="stable")
+        ann_offsets = np.zeros(len(images) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(owner, minlength=len(images)), out=ann_offsets[1:])
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(path))
+        np.save(os.path.join(tmp, "ann_offsets.npy"), ann_offsets)
+        np.save(os.path.join(tmp, "ann_ranges.npy"), ranges[order])
+        with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"json_file": os.path.abspath(json_file), "images": images, "categories": categories}, f)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # 其他进程已经先写好了
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+###########################################################################################################################################################
+# 基准测试: 与 json.loads(f.read()) 后按图片分组对比  python -m toolbox.data_box.coco_stream
+def benchmark(n_images=100, n_truths=300, n_vertices=40, seed=3407):
+    import gc
+    import tracemalloc
+
+    tmp = tempfile.mkdtemp()
+    json_file = os.path.join(tmp, "livecell.json")
+    rng = np.random.RandomState(seed)
+    angles = np.linspace(0, 2 * np.pi, n_vertices, endpoint=False)
+    images, annotations = [], []
+    for k in range(n_images):
+        images.append({"id": k + 1, "file_name": "img{}.tif".format(k), "height": 520, "width": 704})
+        for _ in range(n_truths):
+            cx, cy, r = rng.uniform(20, 684), rng.uniform(20, 500), rng.uniform(5, 20, n_vertices)
+            xs, ys = np.round(cx + r * np.cos(angles), 2), np.round(cy + r * np.sin(angles), 2)
+            annotations.append({"id": len(annotations) + 1, "image_id": int(rng.randint(1, n_images + 1)),
+                                "segmentation": [np.stack([xs, ys], axis=1).ravel().tolist()],
+                                "category_id": 1 + len(annotations) % 8, "iscrowd": 0})
+    images[3]["file_name"] = "细胞_3.tif"
+    with open(json_file, "w", encoding="utf-8") as f:
+        # LIVECell 一样 annotations 写在 images 前面, 且同一张图的标注不连续
+        json.dump({"info": {"year": 2021}, "annotations": annotations, "images": images, "licenses": [],
+                   "categories": [{"id": i + 1, "name": "type{}".format(i)} for i in range(8)]}, f, ensure_ascii=False)
+
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    with open(json_file, "r", encoding="utf-8") as f:
+        dataset = json.loads(f.read())
+    legacy = {img["id"]: [] for img in dataset["images"]}
+    for ann in dataset["annotations"]:
+        legacy[ann["image_id"]].append(ann)
+    t_legacy = time.perf_counter() - start
+    peak_legacy = tracemalloc.get_traced_memory()[1] - base
+    del dataset
+    # legacy 留作对照, 不让它的几百万个对象拖慢后面计时里的垃圾回收
+    gc.freeze()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+
+    start = time.perf_counter()
+    CocoIndex.load(json_file)
+    t_build = time.perf_counter() - start
+    peak_build = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+
+    t_one = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        index = CocoIndex.load(json_file)
+        one = index.annotations(7)
+        t_one = min(t_one, time.perf_counter() - start)
+
+    assert index.images == images and one == legacy[7]
+    assert all(index.annotations(image_id) == anns for image_id, anns in legacy.items())
+    assert index.num_annotations == len(annotations)
+
+    # to1Cat: 流式改写类别, 结果与整体读入再写出相同
+    def one_category(items):
+        for key, i, obj, _, _ in items:
+            if key == "categories":
+                if i in (None, 0):
+                    yield key, None, [{"name": "cell", "id": 1}]
+            elif key == "annotations":
+                yield key, i, dict(obj, category_id=1)
+            else:
+                yield key, i, obj
+
+    out_file = os.path.join(tmp, "1cat.json")
+    write_coco(out_file, one_category(iter_coco(json_file, chunk_size=1 << 16)))
+    with open(json_file, "r", encoding="utf-8") as f:
+        expected = json.load(f)
+    expected["categories"] = [{"name": "cell", "id": 1}]
+    for ann in expected["annotations"]:
+        ann["category_id"] = 1
+    with open(out_file, "r", encoding="utf-8") as f:
+        written = json.load(f)
+    assert written == expected
+    gc.unfreeze()
+    size = os.path.getsize(json_file)
+    shutil.rmtree(tmp, ignore_errors=True)
+    print("{} images x {} polygons, {:.1f} MB json".format(n_images, n_truths, size / 2 ** 20))
+    print("json.loads + group by image   : {:8.2f} ms  peak {:8.1f} MB".format(t_legacy * 1e3, peak_legacy / 2 ** 20))
+    print("streaming index build (once)  : {:8.2f} ms  peak {:8.1f} MB".format(t_build * 1e3, peak_build / 2 ** 20))
+    print("open index + one image        : {:8.2f} ms  (x{:.1f})".format(t_one * 1e3, t_legacy / t_one))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-#
+# -------------------------------------------------------------------------------
+# Name:         compact_masks
+# Description:  紧凑的实例 mask 目标: 一张标签图 + 重叠像素表, 代替 N x H x W 的 uint8 堆叠
+#               CellDataset.__getitem__ 原来每张图分配 np.zeros((n_instances, 520, 704), uint8),
+#               790 个细胞的 shsy5y 图就是约 290 MB, 再转成 tensor、整个堆叠做 VerticalFlip / HorizontalFlip,
+#               然后经 collate、pin_memory 拷到 GPU。
+#               这里 worker 里只处理标签图 (int16 [H x W], 0 为背景, 实例 i 为 i + 1) 和被后面实例覆盖的 (实例, y, x) 表,
+#               翻转 / 缩放都在紧凑格式上完成; 只在送入模型计算 loss 之前, 在 GPU 上一次展开成 N x H x W
+# Author:       Administrator
+# Date:         2021/12/31
+# -------------------------------------------------------------------------------
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def compact_target(store, image_id):
+    """
+    Compact masks of one image of an AnnotationStore.
+
+    Returns:
+        tuple: label_map (int16 tensor [H x W], int32 beyond 32767 instances),
+            overlaps (int64 tensor [K x 3]) (instance, y, x) of the pixels hidden in label_map by a later instance.
+    """
+    height, width = store.image_size(image_id)
+    dtype = np.int16 if store.num_instances(image_id) <= np.iinfo(np.int16).max else np.int32
+    label_map = torch.from_numpy(store.labels_of(image_id).astype(dtype))
+    overlap_ids, overlap_pixels = store.overlaps_of(image_id)
+    overlap_pixels = np.asarray(overlap_pixels, dtype=np.int64)
+    overlaps = np.stack([np.asarray(overlap_ids, dtype=np.int64), overlap_pixels // width, overlap_pixels % width], axis=1)
+    return label_map, torch.from_numpy(overlaps)
+
+
+def flip_compact(label_map, overlaps, dim):
+    """
+    Flips the compact masks, dim -2 is VerticalFlip and -1 HorizontalFlip of the dense stack.
+    """
+    size = label_map.shape[dim]
+    overlaps = overlaps.clone()
+    column = 1 if dim in (-2, 0) else 2
+    overlaps[:, column] = size - 1 - overlaps[:, column]
+    return label_map.flip(dim), overlaps
+
+
+def _nearest_source(size_in, size_out):
+    # 与 F.interpolate(mode='nearest') 相同的源下标
+    return torch.floor(torch.arange(size_out, dtype=torch.float32) * (size_in / size_out)).long().clamp_(max=size_in - 1)
+
+
+def resize_compact(label_map, overlaps, size):
+    """
+    Nearest resize of the compact masks to size (height, width), same as resizing every dense mask
+    with F.interpolate(mode='nearest').
+    """
+    height, width = label_map.shape
+    out_h, out_w = size
+    src_y, src_x = _nearest_source(height, out_h), _nearest_source(width, out_w)
+    label_map = label_map[src_y][:, src_x]
+    if len(overlaps) == 0:
+        return label_map, overlaps
+    # 每个重叠像素对应输出中的一个矩形 (src 单调不减, 用 searchsorted 求范围)
+    y0 = torch.searchsorted(src_y, overlaps[:, 1].contiguous())
+    y1 = torch.searchsorted(src_y, overlaps[:, 1].contiguous(), right=True)
+    x0 = torch.searchsorted(src_x, overlaps[:, 2].contiguous())
+    x1 = torch.searchsorted(src_x, overlaps[:, 2].contiguous(), right=True)
+    ny, nx = y1 - y0, x1 - x0
+    count = ny * nx
+    keep = count > 0
+    overlaps, y0, x0, ny, nx, count = overlaps[keep], y0[keep], x0[keep], ny[keep], nx[keep], count[keep]
+    rank = torch.arange(int(count.sum())) - torch.repeat_interleave(torch.cumsum(count, 0) - count, count)
+    ys = torch.repeat_interleave(y0, count) + rank // torch.repeat_interleave(nx, count)
+    xs = torch.repeat_interleave(x0, count) + rank % torch.repeat_interleave(nx, count)
+    return label_map, torch.stack([torch.repeat_interleave(overlaps[:, 0], count), ys, xs], dim=1)
+
+
+def expand_masks(label_map, overlaps, n_instances):
+    """
+    Dense uint8 masks [N x H x W] on the device of label_map, only called right before the loss needs them.
+    """
+    ids = torch.arange(1, n_instances + 1, device=label_map.device, dtype=label_map.dtype)
+    masks = (label_map[None] == ids[:, None, None]).to(torch.uint8)
+    if len(overlaps):
+        masks[overlaps[:, 0], overlaps[:, 1], overlaps[:, 2]] = 1
+    return masks
+
+
+def expand_targets(targets):
+    """
+    Replaces "label_map" / "overlaps" of every target dict by the "masks" torchvision's Mask R-CNN expects.
+    """
+    expanded = []
+    for t in targets:
+        t = dict(t)
+        t["masks"] = expand_masks(t.pop("label_map"), t.pop("overlaps"), len(t["labels"]))
+        expanded.append(t)
+    return expanded
+
+
+###########################################################################################################################################################
+# 基准测试: 与 N x H x W 堆叠 + 整体翻转 + collate 拷贝对比  python -m toolbox.data_box.compact_masks
+def benchmark(n_cells=790, seed=3407, repeat=3):
+    import shutil
+    import tempfile
+
+    import pandas as pd
+
+    from toolbox.data_box.annotation_store import AnnotationStore
+    from toolbox.metric_box.sparse_iou import _random_cells
+    from toolbox.rle_box.kaggle_rle import decode_kaggle_rles, encode_kaggle_rles
+
+    masks = _random_cells(n_cells, seed=seed)
+    # 平移一部分实例, 制造重叠像素
+    masks[::7] = np.roll(masks[::7], 4, axis=2)
+    rles = encode_kaggle_rles(masks)
+    tmp = tempfile.mkdtemp()
+    store = AnnotationStore.from_frame(pd.DataFrame({"id": "img0", "annotation": rles, "cell_type": "shsy5y"}),
+                                       cache_dir=tmp)
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        dense = torch.as_tensor(decode_kaggle_rles(rles, (520, 704)), dtype=torch.uint8)
+        dense = dense.flip(-2).flip(-1)
+        batch = torch.stack([dense])
+    t_dense = (time.perf_counter() - start) / repeat
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        label_map, overlaps = compact_target(store, "img0")
+        label_map, overlaps = flip_compact(label_map, overlaps, -2)
+        label_map, overlaps = flip_compact(label_map, overlaps, -1)
+        batch = torch.stack([label_map])
+    t_compact = (time.perf_counter() - start) / repeat
+
+    start = time.perf_counter()
+    expanded = expand_masks(label_map, overlaps, n_cells)
+    t_expand = time.perf_counter() - start
+
+    assert torch.equal(expanded, dense)
+    # 缩放只用前 100 个实例检查, 控制参考结果的内存
+    few = AnnotationStore.from_frame(pd.DataFrame({"id": "img1", "annotation": rles[:100], "cell_type": "shsy5y"}),
+                                     cache_dir=tmp)
+    for size in ((260, 352), (1040, 1408)):
+        lm, ov = resize_compact(*compact_target(few, "img1"), size)
+        reference = F.interpolate(torch.as_tensor(masks[None, :100], dtype=torch.float32), size=size, mode='nearest')[0]
+        assert torch.equal(expand_masks(lm, ov, 100), reference.to(torch.uint8))
+    shutil.rmtree(tmp, ignore_errors=True)
+    print("{} instances, {} overlapped pixels".format(n_cells, len(overlaps)))
+    print("dense stack + flips + stack  : {:8.2f} ms  {:8.1f} MB".format(t_dense * 1e3, dense.numel() / 2 ** 20))
+    print("compact + flips + stack      : {:8.2f} ms  {:8.1f} MB  (x{:.1f})".format(
+        t_compact * 1e3, (label_map.numel() * 2 + overlaps.numel() * 8) / 2 ** 20, t_dense / t_compact))
+    print("expand before the loss (cpu) : {:8.2f} ms".format(t_expand * 1e3))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-#
+# -------------------------------------------------------------------------------
+# Name:         dataset_dicts
+# Description:  register_coco_instances 的缓存版本
+#               detectron2 的 register_coco_instances 只登记一个 lambda, 之后 EVAL_PERIOD、evaluator、build_train_loader
+#               每次 DatasetCatalog.get() 都要经 pycocotools 重新解析整个 COCO json, 每个 fold、每个 rank 各来一遍,
+#               LIVECell 这种几百 MB 的标注文件启动时间大部分都花在这里。
+#               这里 load_coco_json 的结果只在第一次见到某个标注文件时生成, 每个 dataset dict 单独 pickle 后拼成一个 uint8 数组 + 偏移量,
+#               与 detectron2 DatasetFromList(serialize=True) 的做法相同; 目录名为标注文件内容的哈希,
+#               之后的 get()、其他 rank、fold 与 worker 只需 np.load(mmap_mode='r')
+# Author:       Administrator
+# Date:         2021/12/31
+# -------------------------------------------------------------------------------
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from toolbox.metric_box.gt_cache import file_hash
+
+# 缓存格式变化时修改, 旧缓存自动失效
+DICTS_VERSION = 1
+
+# load_coco_json 在 MetadataCatalog 里设置的字段, 命中缓存时由这里恢复
+_METADATA_KEYS = ("thing_classes", "thing_dataset_id_to_contiguous_id")
+
+# 同一进程里 get() 会被调用很多次, 文件没变 (大小, 修改时间) 时不再重新计算几百 MB 的哈希
+_hash_memo = {}
+
+
+def _memo_file_hash(path):
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _hash_memo:
+        _hash_memo[key] = file_hash(path)
+    return _hash_memo[key]
+
+
+def _pack(record):
+    # LIVECell 的 polygon 是很长的 float 列表, 每个 float 单独 pickle / unpickle 很慢,
+    # 一张图所有 polygon 的坐标拼成一个 float64 数组 (数值不变), 每个标注只记 polygon 个数和长度
+    record = dict(record)
+    annotations, coords, n_polys, lengths = [], [], [], []
+    for ann in record.get("annotations", []):
+        segm = ann.get("segmentation")
+        if isinstance(segm, list):
+            ann = dict(ann)
+            polys = [np.asarray(poly, dtype=np.float64).ravel() for poly in ann.pop("segmentation")]
+            coords.extend(polys)
+            lengths.extend(len(poly) for poly in polys)
+            n_polys.append(len(polys))
+        else:
+            n_polys.append(-1)
+        annotations.append(ann)
+    if "annotations" in record:
+        record["annotations"] = annotations
+    return (record, np.concatenate(coords) if coords else np.zeros(0, dtype=np.float64),
+            np.asarray(n_polys, dtype=np.int64), np.asarray(lengths, dtype=np.int64))
+
+
+def _unpack(record, coords, n_polys, lengths):
+    polys = np.split(coords, np.cumsum(lengths)[:-1]) if len(lengths) else []
+    k = 0
+    for ann, n in zip(record.get("annotations", []), n_polys.tolist()):
+        if n >= 0:
+            ann["segmentation"] = polys[k:k + n]
+            k += n
+    return record
+
+
+class DatasetDicts:
+    """
+    Read-only, memory-mapped dataset dicts of one COCO annotation file, dict i is
+    pickle.loads(blob[offsets[i]:offsets[i + 1]]).
+
+    Args:
+        path (str): directory written by build.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        self.metadata = {}
+        if meta["thing_classes"] is not None:
+            self.metadata["thing_classes"] = meta["thing_classes"]
+        if meta["id_map"] is not None:
+            self.metadata["thing_dataset_id_to_contiguous_id"] = {int(k): int(v) for k, v in meta["id_map"]}
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.blob = np.load(os.path.join(path, "blob.npy"), mmap_mode="r")
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        start, end = int(self.offsets[idx]), int(self.offsets[idx + 1])
+        return _unpack(*pickle.loads(self.blob[start:end].tobytes()))
+
+    def to_list(self):
+        """
+        Returns:
+            list of dict: what load_coco_json returned, a fresh copy on every call.
+                Polygons are float64 arrays (views of one array per image) instead of lists of float,
+                detectron2 converts them with np.asarray anyway.
+        """
+        return [self[i] for i in range(len(self))]
+
+    ###########################################################################################################################################################
+    @classmethod
+    def load(cls, json_file, image_root, loader, cache_dir=None):
+        """
+        Opens the dicts of (json_file, image_root), builds them with loader() first if they do not exist yet.
+
+        Args:
+            loader (callable): returns (list of dataset dicts, metadata dict), only called on a cache miss.
+            cache_dir (str, optional): where caches are kept, defaults to .dataset_dicts next to json_file.
+        """
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(os.path.abspath(json_file)), ".dataset_dicts")
+        # file_name 里包含 image_root, 所以它也是 key 的一部分
+        root_hash = hashlib.sha1(os.path.abspath(str(image_root)).encode("utf-8")).hexdigest()[:8]
+        path = os.path.join(cache_dir, "v{}_{}_{}".format(DICTS_VERSION, _memo_file_hash(json_file), root_hash))
+        if not os.path.exists(os.path.join(path, "meta.json")):
+            cls.build(*loader(), path)
+        return cls(path)
+
+    @staticmethod
+    def build(dicts, metadata, path):
+        """
+        Serializes dicts and writes them to path, through a temporary directory renamed at the end
+        so ranks building the same file at the same time are safe.
+        """
+        blobs = [np.frombuffer(pickle.dumps(_pack(d), protocol=pickle.HIGHEST_PROTOCOL), dtype=np.uint8) for d in dicts]
+        offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in blobs], out=offsets[1:])
+        id_map = metadata.get("thing_dataset_id_to_contiguous_id")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(path))
+        np.save(os.path.join(tmp, "offsets.npy"), offsets)
+        np.save(os.path.join(tmp, "blob.npy"), np.concatenate(blobs) if blobs else np.zeros(0, dtype=np.uint8))
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump({"thing_classes": metadata.get("thing_classes"),
+                       "id_map": None if id_map is None else sorted((int(k), int(v)) for k, v in id_map.items())}, f)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # 其他进程已经先写好了
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+def register_coco_instances(name, metadata, json_file, image_root, cache_dir=None):
+    """
+    Same as detectron2.data.datasets.register_coco_instances, but load_coco_json runs only once per annotation file
+    (and image_root), every later DatasetCatalog.get(name) in any process unpickles the cached dicts.
+    """
+    from detectron2.data import DatasetCatalog, MetadataCatalog
+    from detectron2.data.datasets import load_coco_json
+
+    assert isinstance(name, str), name
+    assert isinstance(json_file, (str, os.PathLike)), json_file
+    assert isinstance(image_root, (str, os.PathLike)), image_root
+
+    def loader():
+        dicts = load_coco_json(json_file, image_root, name)
+        meta = MetadataCatalog.get(name)
+        return dicts, {key: meta.get(key) for key in _METADATA_KEYS if meta.get(key) is not None}
+
+    def get():
+        cached = DatasetDicts.load(json_file, image_root, loader, cache_dir=cache_dir)
+        # 命中缓存时 load_coco_json 没有运行, 类别信息由缓存写回 MetadataCatalog
+        MetadataCatalog.get(name).set(**cached.metadata)
+        return cached.to_list()
+
+    DatasetCatalog.register(name, get)
+    MetadataCatalog.get(name).set(json_file=json_file, image_root=image_root, evaluator_type="coco", **metadata)
+
+
+###########################################################################################################################################################
+# 基准测试: 与每次 get() 都经 pycocotools 解析 json 对比  python -m toolbox.data_box.dataset_dicts
+def _coco_dicts(json_file, image_root):
+    # load_coco_json 的主要部分 (不含 detectron2 的 BoxMode), 作为每次 get() 的旧做法
+    from pycocotools.coco import COCO
+
+    coco = COCO(json_file)
+    cat_ids = sorted(coco.getCatIds())
+    id_map = {v: i for i, v in enumerate(cat_ids)}
+    dicts = []
+    for img_id in sorted(coco.imgs.keys()):
+        img = coco.imgs[img_id]
+        record = {"file_name": os.path.join(image_root, img["file_name"]), "height": img["height"],
+                  "width": img["width"], "image_id": img_id, "annotations": []}
+        for ann in coco.imgToAnns[img_id]:
+            record["annotations"].append({"iscrowd": ann.get("iscrowd", 0), "bbox": ann["bbox"], "bbox_mode": 1,
+                                          "segmentation": ann["segmentation"],
+                                          "category_id": id_map[ann["category_id"]]})
+        dicts.append(record)
+    metadata = {"thing_classes": [c["name"] for c in coco.loadCats(cat_ids)], "thing_dataset_id_to_contiguous_id": id_map}
+    return dicts, metadata
+
+
+def benchmark(n_images=100, n_truths=300, n_vertices=40, n_gets=4, seed=3407):
+    import contextlib
+    import io
+
+    tmp = tempfile.mkdtemp()
+    json_file = os.path.join(tmp, "train.json")
+    rng = np.random.RandomState(seed)
+    images, annotations = [], []
+    angles = np.linspace(0, 2 * np.pi, n_vertices, endpoint=False)
+    for k in range(n_images):
+        images.append({"id": k + 1, "file_name": "img{}.png".format(k), "height": 520, "width": 704})
+        # 与 LIVECell 一样的 polygon 标注, 每个细胞 n_vertices 个顶点
+        for _ in range(n_truths):
+            cx, cy, r = rng.uniform(20, 684), rng.uniform(20, 500), rng.uniform(5, 20, n_vertices)
+            xs, ys = np.round(cx + r * np.cos(angles), 2), np.round(cy + r * np.sin(angles), 2)
+            annotations.append({"id": len(annotations) + 1, "image_id": k + 1,
+                                "segmentation": [np.stack([xs, ys], axis=1).ravel().tolist()],
+                                "bbox": [xs.min(), ys.min(), xs.max() - xs.min(), ys.max() - ys.min()],
+                                "area": float(np.pi * np.mean(r) ** 2), "category_id": 1 + len(annotations) % 3,
+                                "iscrowd": 0})
+    with open(json_file, "w") as f:
+        json.dump({"images": images, "annotations": annotations,
+                   "categories": [{"id": i + 1, "name": n} for i, n in enumerate(("shsy5y", "astro", "cort"))]}, f)
+
+    # 旧做法: EVAL_PERIOD、evaluator、build_train_loader 每次 get() 都重新解析
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(n_gets):
+            legacy, legacy_meta = _coco_dicts(json_file, "../data")
+    t_legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        DatasetDicts.load(json_file, "../data", lambda: _coco_dicts(json_file, "../data"))
+    t_build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(n_gets):
+        cached = DatasetDicts.load(json_file, "../data", None)
+        dicts = cached.to_list()
+    t_cached = time.perf_counter() - start
+
+    assert len(dicts) == len(legacy) and cached.metadata == legacy_meta
+    for record, reference in zip(dicts, legacy):
+        for ann, ref in zip(record.pop("annotations"), reference.pop("annotations")):
+            segm, ref_segm = ann.pop("segmentation"), ref.pop("segmentation")
+            assert ann == ref and all(np.array_equal(a, b) for a, b in zip(segm, ref_segm))
+        assert record == reference
+    # 多次 load 只生成一份缓存
+    assert len(os.listdir(os.path.join(tmp, ".dataset_dicts"))) == 1
+    shutil.rmtree(tmp, ignore_errors=True)
+    print("{} images x {} instances, {} get() calls".format(n_images, n_truths, n_gets))
+    print("pycocotools parse every get() : {:8.2f} ms".format(t_legacy * 1e3))
+    print("build cache (once)            : {:8.2f} ms".format(t_build * 1e3))
+    print("cached get()                  : {:8.2f} ms  (x{:.1f})".format(t_cached * 1e3, t_legacy / t_cached))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-#
+# -------------------------------------------------------------------------------
+# Name:         grayscale
+# Description:  单通道灰度输入
+#               显微镜图片都是灰度图 (R = G = B), 但 CellDataset 的 COLOR_BGR2RGB、detectron2 的 BGR 格式、mmdet 的 to_rgb
+#               都把它复制成 3 通道, 解码、缓存、拷贝到 GPU 和第一层卷积都多做了 3 倍。
+#               detectron2: 三个通道的 PIXEL_MEAN 相同时, 第一层卷积对 3 个相同通道的求和可以事先折叠进权重,
+#               INPUT.FORMAT 改为 "L"、PIXEL_MEAN / PIXEL_STD 只留一个, ResNet 的 stem 按 len(PIXEL_MEAN) 建成单通道,
+#               加载预训练 / 已训练好的 RGB 权重时把 stem 的 [O x 3 x k x k] 按通道 (乘 std 比例) 求和成 [O x 1 x k x k], 输出与 RGB 相同。
+#               torchvision: 两次 ImageNet 归一化的各通道均值不同, 无法折叠进卷积 (边缘补零处不等价),
+#               这里只把 worker 里的 Normalize 与模型 transform 的归一化合成一次, 单通道图在 GPU 上广播成 3 通道
+# Author:       Administrator
+# Date:         2021/12/31
+# -------------------------------------------------------------------------------
+import time
+
+import numpy as np
+import torch
+
+
+def gray_pixel_stats(pixel_mean, pixel_std):
+    """
+    Single channel PIXEL_MEAN / PIXEL_STD of an RGB config.
+
+    Raises:
+        ValueError: the channels have different means, the first conv can not be folded exactly.
+    """
+    if len(set(float(m) for m in pixel_mean)) != 1:
+        raise ValueError("PIXEL_MEAN {} differs between channels, the first conv can not be folded".format(list(pixel_mean)))
+    return [pixel_mean[0]], [pixel_std[0]]
+
+
+def fold_rgb_weight(weight, rgb_std=None, gray_std=None):
+    """
+    Folds the weight [O x C x k x k] of a conv fed with (pixel - mean) / rgb_std[c] into [O x 1 x k x k]
+    fed with (pixel - mean) / gray_std, for images whose C channels are identical.
+    """
+    weight = torch.as_tensor(weight)
+    if rgb_std is None:
+        return weight.sum(dim=1, keepdim=True)
+    scale = torch.as_tensor(gray_std / np.asarray(rgb_std, dtype=np.float64), dtype=weight.dtype)
+    return (weight * scale[None, :, None, None]).sum(dim=1, keepdim=True)
+
+
+def fold_rgb_state_dict(model_state, state_dict, rgb_std=None, gray_std=None):
+    """
+    Folds in place every 3 channel weight of state_dict that the single channel model expects with 1 input channel.
+    Weights are matched by shape, detectron2 renames the keys of c2 checkpoints only after this.
+
+    Returns:
+        list: folded keys.
+    """
+    targets = {tuple(v.shape) for v in model_state.values() if v.dim() == 4 and v.shape[1] == 1}
+    folded = []
+    for key, value in state_dict.items():
+        shape = tuple(np.shape(value))
+        if len(shape) == 4 and shape[1] == 3 and (shape[0], 1) + shape[2:] in targets:
+            state_dict[key] = fold_rgb_weight(value, rgb_std, gray_std)
+            folded.append(key)
+    return folded
+
+
+def to_grayscale_cfg(cfg):
+    """
+    Switches a detectron2 cfg to single channel input and makes every DetectionCheckpointer fold RGB weights on load,
+    pretrained ImageNet / COCO weights and models trained in RGB give the same outputs.
+    Call it before the model is built, images are then read as H x W x 1. DefaultPredictor only accepts RGB / BGR,
+    predict with batch_predictor.BatchPredictor.from_cfg(cfg) instead.
+    """
+    from detectron2.checkpoint import DetectionCheckpointer
+
+    rgb_std = list(cfg.MODEL.PIXEL_STD)
+    cfg.MODEL.PIXEL_MEAN, cfg.MODEL.PIXEL_STD = gray_pixel_stats(cfg.MODEL.PIXEL_MEAN, rgb_std)
+    cfg.INPUT.FORMAT = "L"
+    gray_std = cfg.MODEL.PIXEL_STD[0]
+
+    load_model = DetectionCheckpointer._load_model
+    if getattr(load_model, "load_model", None) is not None:
+        load_model = load_model.load_model
+
+    def _load_model(self, checkpoint):
+        folded = fold_rgb_state_dict(self.model.state_dict(), checkpoint["model"], rgb_std, gray_std)
+        if folded:
+            self.logger.info("Folded RGB weights into single channel: {}".format(", ".join(folded)))
+        return load_model(self, checkpoint)
+
+    _load_model.load_model = load_model
+    DetectionCheckpointer._load_model = _load_model
+    return cfg
+
+
+def compose_normalize(first, second):
+    """
+    (mean, std) of one normalization equal to normalizing with first and then with second,
+    e.g. the Normalize of get_transform followed by the transform of torchvision's Mask R-CNN.
+    """
+    m1, s1 = np.asarray(first[0], dtype=np.float64), np.asarray(first[1], dtype=np.float64)
+    m2, s2 = np.asarray(second[0], dtype=np.float64), np.asarray(second[1], dtype=np.float64)
+    return list(m1 + s1 * m2), list(s1 * s2)
+
+
+###########################################################################################################################################################
+# 基准测试: 与 3 通道输入的 stem 对比  python -m toolbox.data_box.grayscale
+def benchmark(repeat=5, seed=3407):
+    import torch.nn.functional as F
+
+    rng = np.random.RandomState(seed)
+    # 与 detectron2 R50 的 stem 相同: 7x7 / 2, padding 3, 无 bias; 输入先归一化再在 ImageList 里补零到 32 的倍数
+    weight = torch.as_tensor(rng.normal(0, 0.05, (64, 3, 7, 7)), dtype=torch.float32)
+    gray = torch.as_tensor(rng.randint(0, 256, (2, 1, 520, 704)), dtype=torch.float32)
+    pixel_mean, pixel_std = [128, 128, 128], [11.578, 11.578, 11.578]
+
+    def stem(images, mean, std, w):
+        mean = torch.as_tensor(mean, dtype=torch.float32)[None, :, None, None]
+        std = torch.as_tensor(std, dtype=torch.float32)[None, :, None, None]
+        x = F.pad((images - mean) / std, (0, 0, 0, 544 - 520))
+        return F.conv2d(x, w, stride=2, padding=3)
+
+    rgb = gray.expand(-1, 3, -1, -1).contiguous()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        out_rgb = stem(rgb, pixel_mean, pixel_std, weight)
+    t_rgb = (time.perf_counter() - start) / repeat
+
+    gray_mean, gray_std = gray_pixel_stats(pixel_mean, pixel_std)
+    model_state = {"stem.conv1.weight": torch.zeros(64, 1, 7, 7), "res2.0.conv1.weight": torch.zeros(64, 64, 1, 1)}
+    state_dict = {"conv1_w": weight.numpy(), "res2_0_branch2a_w": np.zeros((64, 64, 1, 1), dtype=np.float32)}
+    assert fold_rgb_state_dict(model_state, state_dict, pixel_std, gray_std[0]) == ["conv1_w"]
+    start = time.perf_counter()
+    for _ in range(repeat):
+        out_gray = stem(gray, gray_mean, gray_std, state_dict["conv1_w"])
+    t_gray = (time.perf_counter() - start) / repeat
+    assert torch.allclose(out_rgb, out_gray, rtol=1e-5, atol=1e-4)
+
+    # 各通道 std 不同时按比例折叠
+    rgb_std = [57.375, 57.12, 58.395]
+    out = stem(rgb, [128] * 3, rgb_std, weight)
+    assert torch.allclose(out, stem(gray, [128], [50.], fold_rgb_weight(weight, rgb_std, 50.)), rtol=1e-5, atol=1e-4)
+    try:
+        gray_pixel_stats([103.53, 116.28, 123.675], [1., 1., 1.])
+        raise AssertionError("different channel means must not be folded")
+    except ValueError:
+        pass
+
+    # torchvision: worker 里的 Normalize + 模型 transform 合成一次, 单通道广播成 3 通道
+    imagenet = ([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+    mean, std = compose_normalize(imagenet, imagenet)
+    g = gray[0] / 255.
+    m1, s1 = [torch.as_tensor(v)[:, None, None] for v in imagenet]
+    reference = ((g.expand(3, -1, -1) - m1) / s1 - m1) / s1
+    composed = (g - torch.as_tensor(mean, dtype=torch.float32)[:, None, None]) / torch.as_tensor(std, dtype=torch.float32)[:, None, None]
+    assert torch.allclose(reference, composed, rtol=1e-5, atol=1e-4)
+
+    print("stem input 2 x 520 x 704, {} -> {} channels".format(3, 1))
+    print("3 channel stem : {:8.2f} ms  {:6.1f} MB input".format(t_rgb * 1e3, rgb.numel() * rgb.element_size() / 2 ** 20))
+    print("folded stem    : {:8.2f} ms  {:6.1f} MB input  (x{:.1f})".format(t_gray * 1e3, gray.numel() * gray.element_size() / 2 ** 20,
+                                                                            t_rgb / t_gray))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-#
+# -------------------------------------------------------------------------------
+# Name:         image_cache
+# Description:  解码后图片的共享内存缓存 (LRU)
+#               torchvision 的 CellDataset、detectron2 Trainer 里的 DatasetMapper、MMdetection_LocalCV_Submit
+#               每个 epoch、每个 DataLoader worker 都要对同样的 ~606 张 train PNG 重新 cv2.imread / cvtColor,
+#               图片很小, PNG 解码占了 data time 的很大一部分。
+#               这里开一块命名的共享内存, 按固定大小的槽位存放解码后的 uint8 图片, 槽位表 (key, 最近使用时间, 形状) 也在共享内存里,
+#               同一个 run 的所有 worker / 进程按名字挂载同一块内存, 每张图只解码一次;
+#               LIVECell 与半监督数据集放不下时按 LRU 淘汰。写槽位表时用文件锁, 跨进程 (包括 DDP 的多个 rank) 都有效。
+#               名字按 run 生成 (run_cache_name: 例如 cfg.OUTPUT_DIR 或图片目录的哈希), 各 rank / 进程才会挂载同一块内存;
+#               只由一个进程 (主 rank, 或没有指定时的创建者) 在退出时释放。
+#               默认不启用, 由各脚本的 IMAGE_CACHE_MB 打开
+# Author:       Administrator
+# Date:         2021/12/31
+# -------------------------------------------------------------------------------
+import atexit
+import fcntl
+import hashlib
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+# 本次比赛的图片 520 x 704 x 3
+SLOT_BYTES = 520 * 704 * 3
+# 槽位表每行: key, 最近使用时间, 维数, 形状 (最多 3 维), 字节数
+_ROW = 7
+
+
+def run_cache_name(prefix, run):
+    """
+    Name of the block of one run, the same in every rank / process of it, e.g. run is cfg.OUTPUT_DIR or the image folder.
+    """
+    return "{}_{}".format(prefix, hashlib.sha1(os.path.abspath(str(run)).encode("utf-8")).hexdigest()[:12])
+
+
+def _key(path, tag):
+    digest = hashlib.sha1("{}|{}".format(os.path.abspath(path), tag).encode("utf-8")).digest()
+    # 0 表示空槽位
+    return int.from_bytes(digest[:8], "little", signed=True) or 1
+
+
+class SharedImageCache:
+    """
+    LRU cache of decoded uint8 images in one named shared memory block, shared by every process that opens the same name.
+
+    Args:
+        name (str): name of the block, e.g. one per run.
+        capacity (int): bytes of image data, rounded down to whole slots.
+        slot_bytes (int): largest image that is cached, bigger ones are decoded every time.
+        unlink (bool, optional): whether this process frees the block at exit, e.g. comm.is_main_process() under DDP;
+            None leaves it to the process that created the block.
+
+    Pickling keeps only the arguments, a DataLoader worker attaches to the block instead of copying it (and never frees it).
+    """
+
+    def __init__(self, name, capacity=1 << 30, slot_bytes=SLOT_BYTES, unlink=None):
+        self.name = name
+        self.capacity = capacity
+        self.slot_bytes = slot_bytes
+        self.n_slots = max(capacity // slot_bytes, 1)
+        self.hits, self.misses = 0, 0
+        table_bytes = (self.n_slots + 1) * _ROW * 8
+        size = table_bytes + self.n_slots * slot_bytes
+        self._lock_file = os.path.join(tempfile.gettempdir(), "{}.image_cache.lock".format(name))
+        self._owner = False
+        with self._locked():
+            created = False
+            try:
+                self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+                created = True
+            except FileExistsError:
+                self._shm = shared_memory.SharedMemory(name=name)
+            # 只有 owner 在 unlink 时负责释放; fork 出来的 worker 与创建者共用一个 resource_tracker,
+            # 所以谁都不留在 tracker 里, 否则挂载的进程退出 / 注销时会把共享内存删掉或报 KeyError
+            resource_tracker.unregister(self._shm._name, "shared_memory")
+            if self._shm.size < size:
+                self._shm.close()
+                raise ValueError("shared memory {} has {} bytes, {} needed; it was created with another capacity".format(
+                    name, self._shm.size, size))
+            if created:
+                np.ndarray(((self.n_slots + 1), _ROW), dtype=np.int64, buffer=self._shm.buf)[:] = 0
+        self._owner = created if unlink is None else bool(unlink)
+        self._table = np.ndarray((self.n_slots + 1, _ROW), dtype=np.int64, buffer=self._shm.buf)
+        self._data = np.ndarray((self.n_slots, slot_bytes), dtype=np.uint8, buffer=self._shm.buf, offset=table_bytes)
+        if self._owner:
+            atexit.register(self.unlink)
+
+    def __getstate__(self):
+        return {"name": self.name, "capacity": self.capacity, "slot_bytes": self.slot_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state["name"], state["capacity"], state["slot_bytes"], unlink=False)
+
+    @contextmanager
+    def _locked(self):
+        with open(self._lock_file, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _tick(self):
+        self._table[0, 0] += 1
+        return self._table[0, 0]
+
+    def get(self, key):
+        """
+        Returns:
+            np array: a private copy of the cached image (augmentations may modify it), None on a miss.
+        """
+        with self._locked():
+            slots = np.flatnonzero(self._table[1:, 0] == key)
+            if len(slots) == 0:
+                return None
+            row = self._table[slots[0] + 1]
+            row[1] = self._tick()
+            shape = tuple(int(x) for x in row[3:3 + row[2]])
+            return self._data[slots[0], :row[6]].reshape(shape).copy()
+
+    def put(self, key, image):
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        if image.nbytes > self.slot_bytes or image.ndim > 3:
+            return
+        with self._locked():
+            keys = self._table[1:, 0]
+            if np.any(keys == key):
+                return
+            # 先用空槽位, 没有空槽位时淘汰最久未使用的
+            empty = np.flatnonzero(keys == 0)
+            slot = empty[0] if len(empty) else int(np.argmin(self._table[1:, 1]))
+            row = self._table[slot + 1]
+            row[0] = 0
+            self._data[slot, :image.nbytes] = image.ravel()
+            row[1:] = 0
+            row[1] = self._tick()
+            row[2] = image.ndim
+            row[3:3 + image.ndim] = image.shape
+            row[6] = image.nbytes
+            row[0] = key
+
+    def load(self, path, loader, tag=""):
+        """
+        Cached loader(), keyed by (path, tag), e.g. tag is the color conversion or the detectron2 image format.
+        """
+        key = _key(path, tag)
+        image = self.get(key)
+        if image is not None:
+            self.hits += 1
+            return image
+        self.misses += 1
+        image = loader()
+        self.put(key, image)
+        return image
+
+    def imread(self, path, code=None, flags=None):
+        """
+        Cached cv2.imread(path, flags), followed by cv2.cvtColor(image, code) when code is given,
+        e.g. flags cv2.IMREAD_GRAYSCALE caches a single channel.
+        """
+        import cv2
+
+        def loader():
+            image = cv2.imread(path) if flags is None else cv2.imread(path, flags)
+            return image if code is None else cv2.cvtColor(image, code)
+
+        return self.load(path, loader, tag="cv2:{}:{}".format(flags, code))
+
+    def __len__(self):
+        return int(np.count_nonzero(self._table[1:, 0]))
+
+    def close(self):
+        self._shm.close()
+
+    def unlink(self):
+        """ Frees the block, only the owning process does it (at exit by default). """
+        if self._owner:
+            self._owner = False
+            resource_tracker.register(self._shm._name, "shared_memory")
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                # 已经被释放 (例如同一个 run 里之前的实例), 不留在 tracker 里
+                resource_tracker.unregister(self._shm._name, "shared_memory")
+
+
+def patch_detectron2_read_image(cache):
+    """
+    Makes detectron2's DatasetMapper (and everything else calling detection_utils.read_image) read through cache.
+    Call it before the train loader is built, forked DataLoader workers inherit it.
+    """
+    from detectron2.data import detection_utils
+
+    read_image = detection_utils.read_image
+    if getattr(read_image, "image_cache", None) is not None:
+        read_image = read_image.read_image
+
+    def cached_read_image(file_name, format=None):
+        return cache.load(file_name, lambda: read_image(file_name, format=format), tag="d2:{}".format(format))
+
+    cached_read_image.image_cache = cache
+    cached_read_image.read_image = read_image
+    detection_utils.read_image = cached_read_image
+    return cache
+
+
+###########################################################################################################################################################
+# 基准测试: 与每个 epoch 重新 cv2.imread + cvtColor 对比  python -m toolbox.data_box.image_cache
+def _worker_read(cache, paths):
+    import cv2
+
+    for path in paths:
+        cache.imread(path, cv2.COLOR_BGR2RGB)
+    return cache.hits, cache.misses
+
+
+def benchmark(n_images=40, epochs=3, seed=3407):
+    import multiprocessing
+    import shutil
+
+    import cv2
+
+    from toolbox.metric_box.sparse_iou import _random_cells
+
+    tmp = tempfile.mkdtemp()
+    rng = np.random.RandomState(seed)
+    paths = []
+    for k in range(n_images):
+        # 细胞图: 灰色背景 + 噪声 + 亮一些的细胞
+        cells = _random_cells(300, seed=seed + k).any(axis=0)
+        gray = np.clip(128 + rng.normal(0, 8, cells.shape) + 40 * cells, 0, 255).astype(np.uint8)
+        paths.append(os.path.join(tmp, "img{}.png".format(k)))
+        cv2.imwrite(paths[-1], np.repeat(gray[:, :, None], 3, axis=2))
+
+    start = time.perf_counter()
+    for _ in range(epochs):
+        legacy = [cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB) for path in paths]
+    t_legacy = (time.perf_counter() - start) / epochs
+
+    name = run_cache_name("image_cache_benchmark", tmp)
+    cache = SharedImageCache(name, capacity=n_images * SLOT_BYTES)
+    times = []
+    for _ in range(epochs):
+        start = time.perf_counter()
+        cached = [cache.imread(path, cv2.COLOR_BGR2RGB) for path in paths]
+        times.append(time.perf_counter() - start)
+    assert all(np.array_equal(a, b) for a, b in zip(legacy, cached))
+    assert cache.misses == n_images and cache.hits == n_images * (epochs - 1)
+
+    # fork 出来的 worker 按名字挂载同一块内存, 全部命中
+    with multiprocessing.get_context("fork").Pool(2) as pool:
+        worker_stats = pool.starmap(_worker_read, [(cache, paths[:n_images // 2]), (cache, paths[n_images // 2:])])
+    assert all(misses == 0 for _, misses in worker_stats)
+
+    # 同一个 run (另一个 rank) 得到同样的名字, 挂载已有的内存, 不是 owner 时不释放
+    assert run_cache_name("image_cache_benchmark", tmp + os.sep) == name
+    rank1 = SharedImageCache(name, capacity=n_images * SLOT_BYTES, unlink=False)
+    rank1.imread(paths[0], cv2.COLOR_BGR2RGB)
+    assert rank1.hits == 1 and rank1.misses == 0
+    rank1.unlink()
+    assert len(SharedImageCache(name, capacity=n_images * SLOT_BYTES, unlink=False)) == n_images
+    try:
+        SharedImageCache(name, capacity=2 * n_images * SLOT_BYTES, unlink=False)
+        raise AssertionError("a bigger capacity must not attach to the smaller block")
+    except ValueError:
+        pass
+    assert run_cache_name("image_cache_benchmark", tmp + "_other") != name
+
+    # 容量只有一半时按 LRU 淘汰
+    small = SharedImageCache(run_cache_name("image_cache_benchmark_small", tmp), capacity=n_images // 2 * SLOT_BYTES)
+    for path in paths:
+        small.imread(path, cv2.COLOR_BGR2RGB)
+    assert len(small) == n_images // 2
+    small.imread(paths[-1], cv2.COLOR_BGR2RGB)
+    assert small.hits == 1
+    small.imread(paths[0], cv2.COLOR_BGR2RGB)
+    assert small.misses == n_images + 1
+    small.unlink()
+    cache.unlink()
+    shutil.rmtree(tmp, ignore_errors=True)
+    print("{} PNG images, {} epochs".format(n_images, epochs))
+    print("cv2.imread + cvtColor per epoch : {:8.2f} ms".format(t_legacy * 1e3))
+    print("cache, first epoch (decode)     : {:8.2f} ms".format(times[0] * 1e3))
+    print("cache, later epochs (copy)      : {:8.2f} ms  (x{:.1f})".format(
+        np.mean(times[1:]) * 1e3, t_legacy / np.mean(times[1:])))
+
+
+if __name__ == '__main__':
+    benchmark()
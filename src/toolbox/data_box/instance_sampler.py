@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-#
+# -------------------------------------------------------------------------------
+# Name:         instance_sampler
+# Description:  按实例数平衡的 batch sampler
+#               每张图的细胞数从 cort 的几个到 shsy5y 的 790 个不等, IMS_PER_BATCH = 6、aspect_ratio_grouping = False 时
+#               随机凑到几张 shsy5y 的 batch 决定了显存峰值, DDP 下每一步又要等实例最多的那个 rank。
+#               这里每个 epoch 仍然是一次随机排列 (每张图恰好出现一次, 与 shuffle=True 的采样分布相同),
+#               只是把排列切成若干窗口, 窗口内按实例数从大到小把图片放进当前总实例数最少的 batch (LPT),
+#               每个 batch 的总实例数不超过 窗口平均值 + 单张图的最大值; 窗口内 batch 的顺序再打乱,
+#               每 world_size 个 batch 组成一步分给各个 rank, 各 rank 的负载也因此接近。
+#               torchvision 的 DataLoader 用 batch_sampler=, detectron2 的 build_train_loader 用 build_balanced_train_loader
+# Author:       Administrator
+# Date:         2021/12/31
+# -------------------------------------------------------------------------------
+import heapq
+import time
+
+import numpy as np
+from torch.utils.data import Sampler
+
+
+def balance_batches(counts, batch_size):
+    """
+    Splits images into ceil(len(counts) / batch_size) batches of at most batch_size images with close total counts,
+    largest image first into the batch with the smallest total (LPT).
+
+    Args:
+        counts (np array): instance count of every image.
+        batch_size (int): images per batch.
+
+    Returns:
+        list of list: positions in counts of every batch.
+    """
+    counts = np.asarray(counts)
+    n_batches = -(-len(counts) // batch_size)
+    # 同样的实例数保持原来的 (随机) 顺序
+    order = np.argsort(-counts, kind="stable")
+    heap = [(0, b) for b in range(n_batches)]
+    batches = [[] for _ in range(n_batches)]
+    for i in order.tolist():
+        load, b = heapq.heappop(heap)
+        batches[b].append(i)
+        if len(batches[b]) < batch_size:
+            heapq.heappush(heap, (load + int(counts[i]), b))
+    return batches
+
+
+class InstanceBalancedBatchSampler(Sampler):
+    """
+    Batch sampler whose batches have balanced total instance counts, within a rank and across ranks.
+
+    Args:
+        counts (list): instance (annotation) count of every image of the dataset.
+        batch_size (int): images per batch on one rank.
+        window (int): steps balanced together, larger windows balance better but keep similar images closer in time.
+        seed (int): same on every rank, all ranks draw the same permutation and take their own batches of it.
+        rank (int), world_size (int): DDP rank, world_size 1 without DDP.
+        infinite (bool): iterate over epochs forever, as detectron2's TrainingSampler.
+        drop_last (bool): drop the images of an incomplete last step; otherwise it is filled with images from the
+            start of the permutation when world_size > 1 (as DistributedSampler), or left smaller.
+    """
+
+    def __init__(self, counts, batch_size, window=8, seed=0, rank=0, world_size=1, infinite=False, drop_last=False):
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.batch_size = batch_size
+        self.window = window
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.infinite = infinite
+        self.drop_last = drop_last
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _steps(self):
+        step = self.batch_size * self.world_size
+        return len(self.counts) // step if self.drop_last else -(-len(self.counts) // step)
+
+    def __len__(self):
+        return self._steps()
+
+    def epoch_batches(self, epoch):
+        """
+        Returns:
+            list of list: batches of every rank for epoch, step s of rank r is element s * world_size + r.
+        """
+        rng = np.random.RandomState(self.seed + epoch)
+        order = rng.permutation(len(self.counts))
+        step = self.batch_size * self.world_size
+        total = self._steps() * step
+        if total > len(order) and self.world_size > 1:
+            order = np.concatenate([order, order[:total - len(order)]])
+        order = order[:total]
+        batches = []
+        for start in range(0, len(order), step * self.window):
+            chunk = order[start:start + step * self.window]
+            window = [[int(chunk[i]) for i in batch] for batch in balance_batches(self.counts[chunk], self.batch_size)]
+            # 窗口内 batch 的顺序打乱, 大图不总在窗口的开头
+            batches.extend(window[i] for i in rng.permutation(len(window)))
+        return batches
+
+    def __iter__(self):
+        while True:
+            batches = self.epoch_batches(self.epoch)
+            self.epoch += 1
+            yield from batches[self.rank::self.world_size]
+            if not self.infinite:
+                return
+
+
+def build_balanced_train_loader(cfg, mapper=None, num_workers=None, window=8):
+    """
+    detectron2 train loader (like build_detection_train_loader with aspect_ratio_grouping=False) whose batches
+    are drawn by InstanceBalancedBatchSampler over cfg.DATASETS.TRAIN.
+    """
+    import torch
+    from detectron2.data.build import get_detection_dataset_dicts, trivial_batch_collator, worker_init_reset_seed
+    from detectron2.data.common import DatasetFromList, MapDataset
+    from detectron2.data.dataset_mapper import DatasetMapper
+    from detectron2.utils import comm
+
+    dicts = get_detection_dataset_dicts(cfg.DATASETS.TRAIN, filter_empty=cfg.DATALOADER.FILTER_EMPTY_ANNOTATIONS)
+    dataset = MapDataset(DatasetFromList(dicts, copy=False), mapper if mapper is not None else DatasetMapper(cfg, True))
+    world_size = comm.get_world_size()
+    batch_sampler = InstanceBalancedBatchSampler([len(d.get("annotations", [])) for d in dicts],
+                                                 cfg.SOLVER.IMS_PER_BATCH // world_size, window=window,
+                                                 seed=comm.shared_random_seed(), rank=comm.get_rank(),
+                                                 world_size=world_size, infinite=True)
+    return torch.utils.data.DataLoader(dataset, batch_sampler=batch_sampler,
+                                       num_workers=cfg.DATALOADER.NUM_WORKERS if num_workers is None else num_workers,
+                                       collate_fn=trivial_batch_collator, worker_init_fn=worker_init_reset_seed)
+
+
+###########################################################################################################################################################
+# 基准测试: 与 shuffle=True 的随机 batch 对比  python -m toolbox.data_box.instance_sampler
+def benchmark(batch_size=3, world_size=2, epochs=20, seed=3407):
+    rng = np.random.RandomState(seed)
+    # 与训练集的分布接近: shsy5y 155 张 (多的 790 个细胞), astro 131 张, cort 320 张
+    counts = np.concatenate([rng.randint(50, 791, 155), rng.randint(5, 200, 131), rng.randint(4, 110, 320)])
+
+    def stats(batches):
+        loads = np.array([counts[b].sum() for b in batches[:len(batches) // world_size * world_size]])
+        steps = loads.reshape(-1, world_size)
+        # 每一步的时间由最慢的 rank 决定
+        return loads.max(), loads.std(), steps.max(axis=1).sum(), (steps.max(axis=1) - steps.min(axis=1)).mean()
+
+    random_stats, balanced_stats = [], []
+    start = time.perf_counter()
+    for epoch in range(epochs):
+        samplers = [InstanceBalancedBatchSampler(counts, batch_size, seed=seed, rank=r, world_size=world_size)
+                    for r in range(world_size)]
+        for sampler in samplers:
+            sampler.set_epoch(epoch)
+        per_rank = [list(sampler) for sampler in samplers]
+        assert all(len(batches) == len(samplers[0]) for batches in per_rank)
+        batches = [b for step in zip(*per_rank) for b in step]
+        # 每张图每个 epoch 恰好一次 (最后一步补齐的除外), 与 shuffle=True 相同
+        seen = np.bincount(np.concatenate(batches), minlength=len(counts))
+        assert seen.min() >= 1 and seen.sum() - len(counts) < batch_size * world_size
+        assert max(len(b) for b in batches) <= batch_size
+        balanced_stats.append(stats(batches))
+
+        order = np.random.RandomState(seed + epoch).permutation(len(counts))
+        random_stats.append(stats([order[i:i + batch_size] for i in range(0, len(order), batch_size)]))
+    t_sampler = (time.perf_counter() - start) / epochs
+
+    random_stats, balanced_stats = np.mean(random_stats, axis=0), np.mean(balanced_stats, axis=0)
+    print("{} images, {} images per batch x {} ranks, mean of {} epochs".format(len(counts), batch_size, world_size, epochs))
+    print("                      max batch  batch std  sum of slowest rank  rank gap per step")
+    for name, s in (("shuffle=True      ", random_stats), ("instance balanced ", balanced_stats)):
+        print("{}  : {:9.0f}  {:9.1f}  {:19.0f}  {:17.1f}".format(name, *s))
+    print("sampler cost per epoch : {:8.2f} ms".format(t_sampler * 1e3))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-#
+# -------------------------------------------------------------------------------
+# Name:         shard_store
+# Description:  分片的二进制数据集: 图片 + 紧凑标注打包进少数几个大文件, 外加下标索引
+#               现在的数据分散在 PNG / TIF 文件夹和一堆 fold json 里 (1997_split_*, 2021_new_split_*, starious_bie_*,
+#               albu_bie_*, semi_all_train.json), 同一张图在每个 fold 文件里都有一份标注副本,
+#               训练时对 /storage 共享卷上的每张图各做一次 open / stat。
+#               pack_coco 把若干 COCO json 流式读入 (CocoIndex), 每张图的原始编码字节只写一次, 标注统一成压缩 RLE 紧随其后,
+#               相同的 (图片, 标注) 只存一份记录; 每个 json 变成一个 subset, 即一列记录下标, fold 选择不再需要单独的 json 副本。
+#               ShardStore 按需 mmap 分片, 顺序或随机读取, 提供 detectron2 的 dataset dicts / read_image,
+#               torchvision 与 mmdet 的 loader 也可以直接用 imread / annotations
+# Author:       Administrator
+# Date:         2021/12/31
+# -------------------------------------------------------------------------------
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pycocotools.mask as mask_util
+
+from toolbox.rle_box.rle_codec import to_compressed
+
+# 格式变化时修改 (2: subset 记录打包时的源 json 路径)
+SHARD_VERSION = 2
+
+_ARRAYS = ("image_spans", "record_images", "ann_offsets", "ann_spans", "categories", "boxes", "iscrowd")
+
+
+class _ShardWriter:
+    # 依次追加字节, 当前分片超过 shard_bytes 时换下一个分片
+    def __init__(self, path, shard_bytes):
+        self.path = path
+        self.shard_bytes = shard_bytes
+        self.shard = -1
+        self.f = None
+        self.offset = 0
+
+    def write(self, data):
+        if self.f is None or self.offset >= self.shard_bytes:
+            self.close()
+            self.shard += 1
+            self.f = open(os.path.join(self.path, "shard_{:05d}.bin".format(self.shard)), "wb")
+            self.offset = 0
+        self.f.write(data)
+        span = (self.shard, self.offset, len(data))
+        self.offset += len(data)
+        return span
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+def pack_coco(json_files, image_root, path, shard_bytes=1 << 30):
+    """
+    Packs COCO annotation files and their images into shards.
+
+    Args:
+        json_files (dict or list): {subset name: json file}, a list uses the file names without extension as names,
+            e.g. ["../data/1997_split_train_fold1.json", "../data/1997_split_val_fold1.json"].
+        image_root (str): file_name of every image is relative to it, as for register_coco_instances.
+        path (str): directory of the store, written through a temporary directory renamed at the end;
+            when path already exists (packed concurrently by another process) it is kept and the new copy discarded.
+        shard_bytes (int): size after which a new shard file is started.
+    """
+    from toolbox.data_box.coco_stream import CocoIndex
+
+    if not isinstance(json_files, dict):
+        json_files = {os.path.splitext(os.path.basename(f))[0]: f for f in json_files}
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)))
+    writer = _ShardWriter(tmp, shard_bytes)
+
+    images, image_index, image_spans = [], {}, []
+    records, record_keys, record_images = [], {}, []
+    ann_offsets, ann_spans, categories, boxes, iscrowd = [0], [], [], [], []
+    subsets = {}
+    for name, json_file in json_files.items():
+        index = CocoIndex.load(json_file)
+        # 源 json 的路径一并记下, 注册后 MetadataCatalog 的 json_file 指向它 (GTCache.from_dataset 等按它读 GT)
+        subset = {"records": [], "categories": index.categories, "json_file": os.path.abspath(json_file)}
+        for img, anns in index:
+            file_name = os.path.normpath(img["file_name"])
+            if file_name not in image_index:
+                # 原始编码字节 (PNG / TIF) 原样存放, 读取时再解码
+                with open(os.path.join(image_root, file_name), "rb") as f:
+                    image_spans.append(writer.write(f.read()))
+                image_index[file_name] = len(images)
+                images.append({"file_name": file_name, "height": img["height"], "width": img["width"]})
+            k = image_index[file_name]
+            rles = [to_compressed(ann["segmentation"], img["height"], img["width"]) for ann in anns]
+            cats = [int(ann["category_id"]) for ann in anns]
+            bbox = [ann["bbox"] if "bbox" in ann else mask_util.toBbox(rle).tolist() for ann, rle in zip(anns, rles)]
+            crowd = [int(ann.get("iscrowd", 0)) for ann in anns]
+            # 同一张图、同样的标注在不同 fold 文件里只存一份
+            key = hashlib.sha1(json.dumps([k, img["id"], cats, bbox, crowd]).encode("utf-8")
+                               + b"".join(rle["counts"] for rle in rles)).hexdigest()
+            if key not in record_keys:
+                record_keys[key] = len(record_images)
+                record_images.append(k)
+                records.append({"id": img["id"]})
+                for rle in rles:
+                    ann_spans.append(writer.write(rle["counts"]))
+                categories.extend(cats)
+                boxes.extend(bbox)
+                iscrowd.extend(crowd)
+                ann_offsets.append(len(categories))
+            subset["records"].append(record_keys[key])
+        subsets[name] = subset
+    writer.close()
+
+    arrays = {
+        "image_spans": np.asarray(image_spans, dtype=np.int64).reshape(-1, 3),
+        "record_images": np.asarray(record_images, dtype=np.int64),
+        "ann_offsets": np.asarray(ann_offsets, dtype=np.int64),
+        "ann_spans": np.asarray(ann_spans, dtype=np.int64).reshape(-1, 3),
+        "categories": np.asarray(categories, dtype=np.int64),
+        "boxes": np.asarray(boxes, dtype=np.float64).reshape(-1, 4),
+        "iscrowd": np.asarray(iscrowd, dtype=np.int8),
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp, name + ".npy"), array)
+    with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"version": SHARD_VERSION, "n_shards": writer.shard + 1, "images": images, "records": records,
+                   "subsets": subsets}, f)
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # 其他进程 (例如 DDP 的另一个 rank) 已经先打包好了; 已存在的 store 可能正被 mmap, 不能删除
+        shutil.rmtree(tmp, ignore_errors=True)
+    return ShardStore(path)
+
+
+class ShardStore:
+    """
+    Read-only packed dataset written by pack_coco.
+
+    Record r is image images[record_images[r]] with the annotations ann_offsets[r]:ann_offsets[r + 1];
+    a subset (one packed json file, e.g. a fold) is a list of record indices.
+    Shards are memory-mapped on first use, pickling keeps only the path.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.n_shards = meta["n_shards"]
+        self.images = meta["images"]
+        self.records = meta["records"]
+        self.subsets = meta["subsets"]
+        for name in _ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, name + ".npy"), mmap_mode="r"))
+        self._file_index = None
+        self._shards = {}
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def __len__(self):
+        return len(self.records)
+
+    def subset(self, name):
+        """
+        Returns:
+            np array int64: record indices of the subset, e.g. a fold; any list of indices can be used the same way.
+        """
+        return np.asarray(self.subsets[name]["records"], dtype=np.int64)
+
+    def _bytes(self, span):
+        shard, offset, length = (int(x) for x in span)
+        if shard not in self._shards:
+            with open(os.path.join(self.path, "shard_{:05d}.bin".format(shard)), "rb") as f:
+                self._shards[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._shards[shard][offset:offset + length]
+
+    def image_info(self, record):
+        return self.images[int(self.record_images[record])]
+
+    def image_bytes(self, record):
+        """ Encoded bytes of the image file, as on disk. """
+        return self._bytes(self.image_spans[int(self.record_images[record])])
+
+    def imread(self, record, flags=None):
+        """
+        Same as cv2.imread(file, flags) on the packed image.
+        """
+        import cv2
+
+        data = np.frombuffer(self.image_bytes(record), dtype=np.uint8)
+        return cv2.imdecode(data, cv2.IMREAD_COLOR if flags is None else flags)
+
+    def annotations(self, record):
+        """
+        Returns:
+            list of dict: COCO annotations of the record, segmentation as compressed RLE with bytes counts.
+        """
+        info = self.image_info(record)
+        start, end = int(self.ann_offsets[record]), int(self.ann_offsets[record + 1])
+        if start == end:
+            return []
+        size = [info["height"], info["width"]]
+        spans = self.ann_spans[start:end]
+        if np.all(spans[:, 0] == spans[0, 0]) and np.all(spans[1:, 1] == spans[:-1, 1] + spans[:-1, 2]):
+            # 同一条记录的标注是连续写入的, 一次读出整块再切分
+            block = self._bytes((spans[0, 0], spans[0, 1], int(spans[-1, 1] + spans[-1, 2] - spans[0, 1])))
+            bounds = np.concatenate([[0], np.cumsum(spans[:, 2])]).tolist()
+            counts = [block[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+        else:
+            counts = [self._bytes(span) for span in spans]
+        return [{"segmentation": {"size": size, "counts": c}, "bbox": box, "category_id": cat, "iscrowd": crowd}
+                for c, box, cat, crowd in zip(counts, self.boxes[start:end].tolist(),
+                                              self.categories[start:end].tolist(), self.iscrowd[start:end].tolist())]
+
+    def record_of(self, file_path, image_root):
+        """
+        Index of the image file_path (image_root joined with a packed file_name), None if it is not packed.
+        """
+        if self._file_index is None:
+            self._file_index = {}
+            for r in range(len(self.record_images)):
+                self._file_index.setdefault(self.images[int(self.record_images[r])]["file_name"], r)
+        return self._file_index.get(os.path.normpath(os.path.relpath(file_path, image_root)))
+
+    def dataset_dicts(self, records, image_root, categories):
+        """
+        detectron2 dataset dicts of the records, as load_coco_json returns them (category ids made contiguous
+        in the order of categories, masks as compressed RLE, so cfg.INPUT.MASK_FORMAT must be "bitmask").
+        """
+        from detectron2.structures import BoxMode
+
+        id_map = {c["id"]: i for i, c in enumerate(sorted(categories, key=lambda c: c["id"]))}
+        dicts = []
+        for record in np.asarray(records).tolist():
+            info = self.image_info(record)
+            annotations = self.annotations(record)
+            for ann in annotations:
+                ann["bbox_mode"] = BoxMode.XYWH_ABS
+                ann["category_id"] = id_map[ann["category_id"]]
+            dicts.append({"file_name": os.path.join(image_root, info["file_name"]), "height": info["height"],
+                          "width": info["width"], "image_id": self.records[record]["id"], "annotations": annotations})
+        return dicts
+
+    ###########################################################################################################################################################
+    @classmethod
+    def load(cls, json_files, image_root, cache_dir="../data/.shards", shard_bytes=1 << 30):
+        """
+        Opens the store of (json_files, image_root), packs it first if it does not exist yet.
+        The directory name is the hash of the annotation files (images are assumed not to change under the same name).
+        """
+        from toolbox.data_box.dataset_dicts import _memo_file_hash
+
+        if not isinstance(json_files, dict):
+            json_files = {os.path.splitext(os.path.basename(f))[0]: f for f in json_files}
+        key = hashlib.sha1(json.dumps(sorted((name, _memo_file_hash(f)) for name, f in json_files.items())).encode("utf-8")
+                           + os.path.abspath(str(image_root)).encode("utf-8")).hexdigest()
+        path = os.path.join(cache_dir, "v{}_{}".format(SHARD_VERSION, key))
+        if not os.path.exists(os.path.join(path, "meta.json")):
+            return pack_coco(json_files, image_root, path, shard_bytes=shard_bytes)
+        return cls(path)
+
+
+def register_shard_dataset(name, store, subset, image_root):
+    """
+    Registers subset of store (a packed json name or a list of record indices) with detectron2, like
+    register_coco_instances, and makes detection_utils.read_image decode the packed images instead of opening files.
+    A packed json name also sets json_file to the source json, as evaluators (GTCache.from_dataset) expect;
+    a list of record indices has no json_file.
+    """
+    from detectron2.data import DatasetCatalog, MetadataCatalog, detection_utils
+
+    records = store.subset(subset) if isinstance(subset, str) else np.asarray(subset, dtype=np.int64)
+    categories = store.subsets[subset]["categories"] if isinstance(subset, str) else \
+        next(iter(store.subsets.values()))["categories"]
+    categories = sorted(categories, key=lambda c: c["id"])
+    DatasetCatalog.register(name, lambda: store.dataset_dicts(records, image_root, categories))
+    MetadataCatalog.get(name).set(image_root=image_root, evaluator_type="coco",
+                                  thing_classes=[c["name"] for c in categories],
+                                  thing_dataset_id_to_contiguous_id={c["id"]: i for i, c in enumerate(categories)})
+    if isinstance(subset, str):
+        MetadataCatalog.get(name).set(json_file=store.subsets[subset]["json_file"])
+
+    read_image = detection_utils.read_image
+    if getattr(read_image, "shard_store", None) is store:
+        return
+
+    def shard_read_image(file_name, format=None):
+        record = store.record_of(file_name, image_root)
+        if record is None:
+            return read_image(file_name, format=format)
+        from PIL import Image
+        import io
+
+        image = Image.open(io.BytesIO(store.image_bytes(record)))
+        image = detection_utils._apply_exif_orientation(image)
+        return detection_utils.convert_PIL_to_numpy(image, format)
+
+    shard_read_image.shard_store = store
+    shard_read_image.read_image = read_image
+    detection_utils.read_image = shard_read_image
+
+
+###########################################################################################################################################################
+# 基准测试: 与每张图 open + imread、每个 fold 单独解析 json 对比  python -m toolbox.data_box.shard_store
+def benchmark(n_images=40, n_truths=100, n_folds=5, seed=3407):
+    import cv2
+
+    from toolbox.metric_box.sparse_iou import _random_cells
+
+    tmp = tempfile.mkdtemp()
+    os.makedirs(os.path.join(tmp, "train"))
+    rng = np.random.RandomState(seed)
+    images, annotations = [], []
+    for k in range(n_images):
+        masks = _random_cells(n_truths, seed=seed + k)
+        gray = np.clip(128 + rng.normal(0, 8, masks.shape[1:]) + 40 * masks.any(axis=0), 0, 255).astype(np.uint8)
+        cv2.imwrite(os.path.join(tmp, "train", "img{}.png".format(k)), gray)
+        images.append({"id": k, "file_name": "train/img{}.png".format(k), "height": 520, "width": 704})
+        rles = mask_util.encode(np.asfortranarray(masks.transpose(1, 2, 0).astype(np.uint8)))
+        for rle, box in zip(rles, mask_util.toBbox(rles).tolist()):
+            rle["counts"] = rle["counts"].decode("ascii")
+            annotations.append({"id": len(annotations), "image_id": k, "segmentation": rle, "bbox": box,
+                                "category_id": 1 + k % 3, "iscrowd": 0})
+    categories = [{"id": i + 1, "name": n} for i, n in enumerate(("shsy5y", "astro", "cort"))]
+    json_files = []
+    for fold in range(n_folds):
+        for split in ("train", "val"):
+            keep = {k for k in range(n_images) if (k % n_folds == fold) == (split == "val")}
+            json_files.append(os.path.join(tmp, "split_{}_fold{}.json".format(split, fold)))
+            with open(json_files[-1], "w") as f:
+                json.dump({"images": [img for img in images if img["id"] in keep],
+                           "annotations": [a for a in annotations if a["image_id"] in keep],
+                           "categories": categories}, f)
+
+    def legacy_annotations(json_file):
+        with open(json_file, "r") as f:
+            dataset = json.load(f)
+        anns = {img["id"]: [] for img in dataset["images"]}
+        for ann in dataset["annotations"]:
+            anns[ann["image_id"]].append(ann)
+        return {img["id"]: (img["file_name"], anns[img["id"]]) for img in dataset["images"]}
+
+    start = time.perf_counter()
+    legacy = [legacy_annotations(f) for f in json_files]
+    t_ann_legacy = time.perf_counter() - start
+    start = time.perf_counter()
+    legacy_images = [[cv2.imread(os.path.join(tmp, x[0])) for x in fold.values()] for fold in legacy]
+    t_img_legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    store = ShardStore.load(json_files, tmp, cache_dir=os.path.join(tmp, ".shards"), shard_bytes=1 << 20)
+    t_pack = time.perf_counter() - start
+
+    start = time.perf_counter()
+    store = ShardStore.load(json_files, tmp, cache_dir=os.path.join(tmp, ".shards"))
+    subsets = [store.subset(os.path.splitext(os.path.basename(f))[0]).tolist() for f in json_files]
+    packed = [{store.records[r]["id"]: store.annotations(r) for r in records} for records in subsets]
+    t_ann = time.perf_counter() - start
+    start = time.perf_counter()
+    images = [[store.imread(r) for r in records] for records in subsets]
+    t_img = time.perf_counter() - start
+
+    for a, b, a_images, b_images in zip(legacy, packed, legacy_images, images):
+        assert list(a.keys()) == list(b.keys())
+        assert all(np.array_equal(x, y) for x, y in zip(a_images, b_images))
+        for image_id in a:
+            reference, anns = a[image_id][1], b[image_id]
+            assert [x["segmentation"]["counts"].encode("ascii") for x in reference] == \
+                   [x["segmentation"]["counts"] for x in anns]
+            assert [x["bbox"] for x in reference] == [x["bbox"] for x in anns]
+            assert [x["category_id"] for x in reference] == [x["category_id"] for x in anns]
+    # 另一个进程晚一步打完包时, 已经打开 (mmap) 的 store 保持不变, 多余的副本被丢弃
+    again = pack_coco(json_files, tmp, store.path, shard_bytes=1 << 20)
+    assert again.path == store.path and np.array_equal(store.imread(0), again.imread(0))
+    assert not [f for f in os.listdir(os.path.dirname(store.path)) if f.startswith("tmp")]
+    # 每个 subset 记得自己的源 json, 注册时作为 json_file
+    assert [store.subsets[os.path.splitext(os.path.basename(f))[0]]["json_file"] for f in json_files] == \
+           [os.path.abspath(f) for f in json_files]
+    # 10 个 fold 文件里每张图出现 n_folds 次, 打包后只有一份
+    assert len(store.records) == n_images and len(store.image_spans) == n_images
+    n_shards = store.n_shards
+    pack_bytes = sum(os.path.getsize(os.path.join(store.path, f)) for f in os.listdir(store.path))
+    json_bytes = sum(os.path.getsize(f) for f in json_files)
+    shutil.rmtree(tmp, ignore_errors=True)
+    print("{} images x {} instances, {} fold json files ({:.1f} MB), packed into {} shards ({:.1f} MB with images)".format(
+        n_images, n_truths, len(json_files), json_bytes / 2 ** 20, n_shards, pack_bytes / 2 ** 20))
+    print("pack (once)                     : {:8.2f} ms".format(t_pack * 1e3))
+    print("annotations, json per fold      : {:8.2f} ms".format(t_ann_legacy * 1e3))
+    print("annotations, offset index       : {:8.2f} ms  (x{:.1f})".format(t_ann * 1e3, t_ann_legacy / t_ann))
+    print("images, imread per file         : {:8.2f} ms  {} files opened".format(
+        t_img_legacy * 1e3, sum(len(x) for x in legacy_images)))
+    print("images, imdecode from shards    : {:8.2f} ms  {} files opened".format(t_img * 1e3, n_shards))
+
+
+if __name__ == '__main__':
+    benchmark()
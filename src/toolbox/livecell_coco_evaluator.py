@@ -13,7 +13,13 @@ import os
 import pickle
 from collections import OrderedDict
 import pycocotools.mask as mask_util
+from toolbox.metric_box.competition_metric import iou_map, counts_to_map
+from toolbox.metric_box.device_iou import LayeredLabels, device_counts
+from toolbox.metric_box.gt_cache import GTCache
+from toolbox.metric_box.parallel_score import ScorePool, rle_score
+from toolbox.metric_box.sparse_iou import InstanceCrops, sparse_mask_iou
 import torch
+import torch.distributed as dist
 from fvcore.common.file_io import PathManager
 from pycocotools.coco import COCO
 from pycocotools.cocoeval import COCOeval
@@ -36,76 +42,14 @@ except ImportError:
     _use_fast_impl = False
 
 
-def precision_at(threshold, iou):
-    """
-    Computes the precision at a given threshold.
-
-    Args:
-        threshold (float): Threshold.
-        iou (np array [n_truths x n_preds]): IoU matrix.
-
-    Returns:
-        int: Number of true positives,
-        int: Number of false positives,
-        int: Number of false negatives.
-    """
-    matches = iou > threshold
-    true_positives = np.sum(matches, axis=1) >= 1  # Correct objects
-    false_negatives = np.sum(matches, axis=1) == 0  # Missed objects
-    false_positives = np.sum(matches, axis=0) == 0  # Extra objects
-    tp, fp, fn = (
-        np.sum(true_positives),
-        np.sum(false_positives),
-        np.sum(false_negatives),
-    )
-    return tp, fp, fn
-
-
-def iou_map(ious,verbose=0):
-    """
-    Computes the metric for the competition.
-    Masks contain the segmented pixels where each object has one value associated,
-    and 0 is the background.
-
-    Args:
-        truths (list of masks): Ground truths.
-        preds (list of masks): Predictions.
-        verbose (int, optional): Whether to print infos. Defaults to 0.
-
-    Returns:
-        float: mAP.
-    """
-
-    if verbose:
-        print("Thresh\tTP\tFP\tFN\tPrec.")
-
-    prec = []
-    for t in np.arange(0.5, 1.0, 0.05):
-        tps, fps, fns = 0, 0, 0
-        tp, fp, fn = precision_at(t, ious)
-        tps += tp
-        fps += fp
-        fns += fn
-
-        p = tps / (tps + fps + fns)
-        prec.append(p)
-
-        if verbose:
-            print("{:1.3f}\t{}\t{}\t{}\t{:1.3f}".format(t, tps, fps, fns, p))
-
-    if verbose:
-        print("AP\t-\t-\t-\t{:1.3f}".format(np.mean(prec)))
-
-    return np.mean(prec)
-
-
 class COCOEvaluator(DatasetEvaluator):
     """
     Evaluate object proposal, instance detection/segmentation, keypoint detection
     outputs using COCO's metrics and APIs.
     """
 
-    def __init__(self, dataset_name, cfg, distributed, output_dir=None ,TOPK_TYPE = 'livecell'):
+    def __init__(self, dataset_name, cfg, distributed, output_dir=None ,TOPK_TYPE = 'livecell', IOU_TYPE = 'sparse', GT_CACHE_DIR = None,
+                 NUM_WORKERS = 0, POOL_TYPE = 'process'):
         """
         Args:
             dataset_name (str): name of the dataset to be evaluated.
@@ -125,6 +69,18 @@ class COCOEvaluator(DatasetEvaluator):
             TOPK_TYPE: 'default' 或者 'livecell'
                 当为 default 时， 积分阈值为 .15,.3,.55
                 当为 livecell时， 积分阈值为 .25,.45,.65
+            IOU_TYPE: 'sparse' 或者 'device' 或者 'rle'
+                当为 sparse 时， 在 process 中直接用 dense pred_masks 和缓存的 GT 裁剪块计算 bbox 剪枝后的稀疏 IoU
+                               不再对每个预测 mask 做 RLE 编码 (只有设置了 output_dir 才会编码用于保存)
+                当为 device 时， pred_masks 不拷回 CPU, 在模型所在设备上与缓存的 GT 标签层直接计算 IoU,
+                               只有每张图的 TP FP FN 离开设备
+                当为 rle 时，    保持原有方式 在 evaluate 中对 RLE 做全量 mask_util.iou
+                sparse 与 device 都在 process 中逐张图评分, 分布式时 evaluate 只 all-reduce (分数之和, 图片数),
+                不再把所有 rank 的预测 gather 到 rank 0 (设置了 output_dir 需要保存时除外)
+            GT_CACHE_DIR: GT 缓存 (toolbox.metric_box.gt_cache) 的目录, 默认为标注文件旁边的 .gt_cache
+                缓存以标注文件内容的哈希命名, 只在第一次构造 evaluator 时生成, 之后直接 mmap
+            NUM_WORKERS: IOU_TYPE 为 rle 时 evaluate 中逐张图评分使用的 worker 数, 0 表示在当前进程串行
+            POOL_TYPE: 'process' 或者 'thread', 见 toolbox.metric_box.parallel_score.ScorePool
         """
         print("__init__")
         self._tasks = self._tasks_from_config(cfg)
@@ -145,14 +101,15 @@ class COCOEvaluator(DatasetEvaluator):
             self._metadata.json_file = cache_path
             convert_to_coco_json(dataset_name, cache_path)
 
-        json_file = PathManager.get_local_path(self._metadata.json_file)
-        with contextlib.redirect_stdout(io.StringIO()):
-            self._coco_api = COCO(json_file)
+        self._json_file = PathManager.get_local_path(self._metadata.json_file)
+        # COCO(json_file) 只有走原始 COCO AP 流程时才需要, 延迟到第一次使用时再解析
+        self._coco = None
+        self._gt_cache = GTCache.load(self._json_file, cache_dir=GT_CACHE_DIR)
 
         self._kpt_oks_sigmas = cfg.TEST.KEYPOINT_OKS_SIGMAS
         # Test set json files do not contain annotations (evaluation must be
         # performed using the COCO evaluation server).
-        self._do_evaluation = "annotations" in self._coco_api.dataset
+        self._do_evaluation = self._gt_cache.num_annotations > 0
 
         # ShineWine Update:
         if TOPK_TYPE == 'default':
@@ -161,8 +118,19 @@ class COCOEvaluator(DatasetEvaluator):
             self._SCORE_THRESHOLD = [0.25,0.45,0.65]
         self._MIN_PIXELS = [60,140,75]
 
-        dataset_dicts = DatasetCatalog.get(dataset_name)
-        self._annotations_cache = {item['image_id']:item['annotations'] for item in dataset_dicts}
+        # 与原来 DatasetCatalog.get 得到的 {image_id: annotations} 用法相同
+        self._annotations_cache = self._gt_cache
+        self._IOU_TYPE = IOU_TYPE
+        self._score_pool = ScorePool(NUM_WORKERS, pool_type=POOL_TYPE)
+        self._gt_crops = {}
+        self._gt_labels = {}
+
+    @property
+    def _coco_api(self):
+        if self._coco is None:
+            with contextlib.redirect_stdout(io.StringIO()):
+                self._coco = COCO(self._json_file)
+        return self._coco
 
     def reset(self):
         self._predictions = []
@@ -216,16 +184,100 @@ class COCOEvaluator(DatasetEvaluator):
 
             # TODO this is ugly
             if "instances" in output:
-                instances = output["instances"].to(self._cpu_device)
-                prediction["instances"] = instances_to_coco_json(instances, input["image_id"])
+                # sparse / device 模式下边推理边评分, 每张图只留下一个分数, evaluate 时只需 all-reduce
+                if self._IOU_TYPE == 'device':
+                    self._scores.append(self._device_score(output["instances"], input["image_id"]))
+                # device 模式下只有需要保存结果时才把 mask 拷回 CPU
+                if self._IOU_TYPE != 'device' or self._output_dir:
+                    instances = output["instances"].to(self._cpu_device)
+                if self._IOU_TYPE == 'sparse':
+                    self._scores.append(self._sparse_score(instances, input["image_id"]))
+                if self._IOU_TYPE == 'rle' or self._output_dir:
+                    prediction["instances"] = instances_to_coco_json(instances, input["image_id"])
             if "proposals" in output:
                 prediction["proposals"] = output["proposals"].to(self._cpu_device)
-            self._predictions.append(prediction)
+            if len(prediction) > 1:
+                self._predictions.append(prediction)
+
+    def _get_gt_crops(self, image_id):
+        if image_id not in self._gt_crops:
+            self._gt_crops[image_id] = self._gt_cache.crops(image_id)
+        return self._gt_crops[image_id]
+
+    def _sparse_score(self, instances, image_id):
+        """
+        Scores one image from its dense pred_masks, only the overlapping (pred, GT) pairs are computed.
+        """
+        if len(instances) == 0:
+            return 0
+        pred_crops = InstanceCrops.from_dense(instances.pred_masks)
+        ious = sparse_mask_iou(pred_crops, self._get_gt_crops(image_id))
+        return iou_map(ious)
+
+    def _get_gt_labels(self, image_id, device):
+        if image_id not in self._gt_labels:
+            self._gt_labels[image_id] = LayeredLabels.from_rles(self._gt_cache.rles(image_id), device=device,
+                                                                image_size=self._gt_cache.image_size(image_id))
+        return self._gt_labels[image_id]
+
+    def _device_score(self, instances, image_id):
+        """
+        Scores one image on the device of pred_masks, 0 without predictions like the sparse path (no 0 / 0).
+        """
+        if len(instances) == 0:
+            return 0
+        return counts_to_map(*self._device_counts(instances, image_id))
+
+    def _device_counts(self, instances, image_id):
+        """
+        TP / FP / FN of one image, computed on the device of pred_masks.
+        """
+        targs = self._get_gt_labels(image_id, instances.pred_masks.device)
+        return device_counts(instances.pred_masks, targs)
+
+    def _reduce_scores(self):
+        """
+        Sums the per-image scores of every rank, only two numbers go through the process group.
+
+        Returns:
+            float: sum of the scores, int: number of scored images.
+        """
+        stats = torch.tensor([float(np.sum(self._scores)), float(len(self._scores))], dtype=torch.float64)
+        if self._distributed and comm.get_world_size() > 1:
+            if dist.get_backend() == "nccl":
+                stats = stats.cuda()
+            dist.all_reduce(stats)
+        return stats[0].item(), int(stats[1].item())
+
+    def _evaluate_streaming(self):
+        score_sum, num_images = self._reduce_scores()
+        if self._output_dir:
+            # 只有需要保存预测结果时才 gather
+            predictions = self._predictions
+            if self._distributed:
+                comm.synchronize()
+                predictions = list(itertools.chain(*comm.gather(self._predictions, dst=0)))
+            if comm.is_main_process():
+                PathManager.mkdirs(self._output_dir)
+                file_path = os.path.join(self._output_dir, "instances_predictions.pth")
+                with PathManager.open(file_path, "wb") as f:
+                    torch.save(predictions, f)
+
+        if self._distributed and not comm.is_main_process():
+            return {}
+        if num_images == 0:
+            self._logger.warning("[COCOEvaluator] Did not receive valid predictions.")
+            return {}
+        print("Eval nums is {}".format(num_images))
+        return {"MaP IoU": score_sum / num_images}
 
     def evaluate(self):
 
         print("evaluate")
 
+        if self._IOU_TYPE != 'rle':
+            return self._evaluate_streaming()
+
         if self._distributed:
             comm.synchronize()
             predictions = comm.gather(self._predictions, dst=0)
@@ -257,18 +309,10 @@ class COCOEvaluator(DatasetEvaluator):
             # 传入的 predections 是一个列表  列表中的每一项为  一个字典  表示单张图片的结果
             # 这个字典只有两个键值   instances  和   image_id
             # 然后 instances中保存的为列表， 列表的每一项为预测的 每一个结果
-            for per_img_dic in predictions:
-                targ = self._annotations_cache[per_img_dic["image_id"]]
-                enc_targs = list(map(lambda x:x['segmentation'], targ))
-
-                enc_preds = []
-                for pred_instance in per_img_dic["instances"]:
-                    enc_preds.append(pred_instance["segmentation"])
-                if enc_preds != []:
-                    ious = mask_util.iou(enc_preds, enc_targs, [0]*len(enc_targs))
-                    self._scores.append(iou_map(ious))
-                else:
-                    self._scores.append(0)
+            # 每张图 (enc_preds, enc_targs) 为一个任务, 分给 worker 并按原顺序取回分数
+            jobs = (([pred_instance["segmentation"] for pred_instance in per_img_dic["instances"]],
+                     self._gt_cache.rles(per_img_dic["image_id"])) for per_img_dic in predictions)
+            self._scores.extend(self._score_pool.map(rle_score, jobs))
             print("Eval nums is {}".format(len(self._scores)))
             ################################################################################################################################################
             # self._eval_predictions(set(self._tasks), predictions)
@@ -0,0 +1,460 @@
+# -*- coding: utf-8 -*-#
+# -------------------------------------------------------------------------------
+# Name:         competition_metric
+# Description:  比赛指标 (mAP over IoU 0.50:0.95) 的统一实现
+#               原来每个训练脚本 / evaluator / LocalCV 都各自复制了一份 precision_at + iou_map,
+#               并且对 10 个阈值逐个做 iou > t 以及行列求和。
+#               这里只对 IoU 矩阵做一次行 / 列最大值归约, 然后一次广播得到 10 个阈值下的 TP FP FN
+#               同时支持把多张图的 IoU 矩阵打包 (ragged + offsets) 之后一次性评分
+# Author:       Administrator
+# Date:         2021/12/26
+# -------------------------------------------------------------------------------
+import time
+from collections import namedtuple
+
+import numpy as np
+
+# 比赛规定的 IoU 阈值 与原实现中的 np.arange(0.5, 1.0, 0.05) 逐位相同
+IOU_THRESHOLDS = np.arange(0.5, 1.0, 0.05)
+
+# 稀疏 IoU 矩阵: 只记录真正重叠的 (row, col) 对, 其余位置均视为 0
+# 由 toolbox.metric_box.sparse_iou 生成, 可以直接传给 iou_map / precision_counts
+SparseIoU = namedtuple('SparseIoU', ['rows', 'cols', 'values', 'shape'])
+
+
+def precision_at(threshold, iou, strict=False):
+    """
+    Computes the precision at a given threshold.
+    Kept for backward compatibility, prefer precision_counts for all thresholds at once.
+
+    Args:
+        threshold (float): Threshold.
+        iou (np array [n_rows x n_cols]): IoU matrix. Rows are counted as TP / FN, columns as FP.
+        strict (bool): if True a row is a TP only when it has exactly one match
+            (the torchvision scripts' variant), otherwise at least one match.
+
+    Returns:
+        int: Number of true positives,
+        int: Number of false positives,
+        int: Number of false negatives.
+    """
+    tp, fp, fn = precision_counts(iou, thresholds=np.asarray([threshold]), strict=strict)
+    return tp[0], fp[0], fn[0]
+
+
+def _row_best(iou, strict):
+    """
+    Returns the best and (if strict) the second best value of every row of a dense IoU matrix.
+    Only these two values decide how many matches a row has at any threshold.
+    """
+    n_rows, n_cols = iou.shape
+    if n_cols == 0:
+        zeros = np.zeros(n_rows, dtype=iou.dtype)
+        return zeros, zeros
+    if not strict:
+        return iou.max(axis=1), None
+    if n_cols == 1:
+        return iou[:, 0], np.zeros(n_rows, dtype=iou.dtype)
+    top2 = np.partition(iou, n_cols - 2, axis=1)[:, -2:]
+    return top2[:, 1], top2[:, 0]
+
+
+def _counts_from_best(row_best, row_second, col_best, n_rows, n_cols, thresholds):
+    """
+    Broadcasts the per-row / per-column best IoU against every threshold.
+
+    Returns:
+        tuple of three int arrays [n_thresholds]: tp, fp, fn
+    """
+    thresholds = np.asarray(thresholds)[:, None]
+    row_hit = row_best[None, :] > thresholds
+    if row_second is None:
+        tp = row_hit.sum(axis=1)
+    else:
+        tp = (row_hit & ~(row_second[None, :] > thresholds)).sum(axis=1)
+    fn = n_rows - row_hit.sum(axis=1)
+    fp = n_cols - (col_best[None, :] > thresholds).sum(axis=1)
+    return tp, fp, fn
+
+
+def precision_counts(iou, thresholds=IOU_THRESHOLDS, strict=False):
+    """
+    TP / FP / FN of one IoU matrix at every threshold in a single pass.
+
+    Args:
+        iou (np array [n_rows x n_cols] or SparseIoU): IoU matrix.
+        thresholds (np array): IoU thresholds, defaults to the competition ones.
+        strict (bool): see precision_at.
+
+    Returns:
+        tuple of three int arrays [n_thresholds]: tp, fp, fn
+    """
+    if isinstance(iou, SparseIoU):
+        tp, fp, fn = sparse_batch_counts(np.zeros(len(iou.values), dtype=np.int64), iou.rows, iou.cols, iou.values,
+                                         [iou.shape], thresholds=thresholds, strict=strict)
+        return tp[0], fp[0], fn[0]
+    iou = np.asarray(iou)
+    n_rows, n_cols = iou.shape
+    row_best, row_second = _row_best(iou, strict)
+    col_best = iou.max(axis=0) if n_rows > 0 else np.zeros(n_cols, dtype=iou.dtype)
+    return _counts_from_best(row_best, row_second, col_best, n_rows, n_cols, thresholds)
+
+
+def counts_to_map(tp, fp, fn):
+    """
+    Averages tp / (tp + fp + fn) over the threshold axis (the last one).
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        prec = tp / (tp + fp + fn)
+    return np.mean(prec, axis=-1)
+
+
+def _print_table(thresholds, tp, fp, fn):
+    print("Thresh\tTP\tFP\tFN\tPrec.")
+    with np.errstate(divide='ignore', invalid='ignore'):
+        prec = tp / (tp + fp + fn)
+    for t, a, b, c, p in zip(thresholds, tp, fp, fn, prec):
+        print("{:1.3f}\t{}\t{}\t{}\t{:1.3f}".format(t, a, b, c, p))
+    print("AP\t-\t-\t-\t{:1.3f}".format(np.mean(prec)))
+
+
+def iou_map(ious, verbose=0, strict=False):
+    """
+    Computes the metric for the competition from one IoU matrix.
+    Drop-in replacement of the per-threshold loop used in the training scripts.
+
+    Args:
+        ious (np array [n_rows x n_cols] or SparseIoU): IoU matrix, e.g. mask_util.iou(enc_preds, enc_targs, ...).
+        verbose (int, optional): Whether to print infos. Defaults to 0.
+        strict (bool): see precision_at.
+
+    Returns:
+        float: mAP.
+    """
+    tp, fp, fn = precision_counts(ious, strict=strict)
+    if verbose:
+        _print_table(IOU_THRESHOLDS, tp, fp, fn)
+    return counts_to_map(tp, fp, fn)
+
+
+###########################################################################################################################################################
+# 批量模式: 多张图的 IoU 矩阵 展平后首尾相接, offsets 记录每张图在 values 中的起点
+def pack_ious(ious_list):
+    """
+    Packs a list of ragged IoU matrices into one flat buffer.
+
+    Args:
+        ious_list (list of np array [n_rows_i x n_cols_i]): per-image IoU matrices.
+
+    Returns:
+        values (np array [sum(n_rows_i * n_cols_i)]): all matrices flattened in C order,
+        shapes (np array [n_images x 2]): (n_rows_i, n_cols_i),
+        offsets (np array [n_images + 1]): start of every matrix inside values.
+    """
+    shapes = np.asarray([np.shape(iou) for iou in ious_list], dtype=np.int64).reshape(-1, 2)
+    sizes = shapes[:, 0] * shapes[:, 1]
+    offsets = np.zeros(len(shapes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    if len(ious_list) == 0:
+        return np.zeros(0), shapes, offsets
+    values = np.concatenate([np.asarray(iou, dtype=np.float64).ravel() for iou in ious_list])
+    return values, shapes, offsets
+
+
+def _segment_best(keys, values, n_keys, strict):
+    """
+    Best (and second best) value per key for a sparse list of (key, value) entries.
+    Keys without any entry get 0, which is below every competition threshold.
+    """
+    best = np.zeros(n_keys, dtype=np.float64)
+    if not strict:
+        np.maximum.at(best, keys, values)
+        return best, None
+    second = np.zeros(n_keys, dtype=np.float64)
+    if len(keys) == 0:
+        return best, second
+    order = np.lexsort((-values, keys))
+    keys, values = keys[order], values[order]
+    first = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    best[keys[first]] = values[first]
+    has_second = first + 1 < len(keys)
+    nxt = first[has_second] + 1
+    same = keys[nxt] == keys[first[has_second]]
+    second[keys[nxt[same]]] = values[nxt[same]]
+    return best, second
+
+
+def _segment_sum(hits, bounds):
+    """
+    Sums a [n_thresholds x n_items] boolean array over consecutive item segments.
+    """
+    csum = np.zeros((hits.shape[0], hits.shape[1] + 1), dtype=np.int64)
+    np.cumsum(hits, axis=1, out=csum[:, 1:])
+    return csum[:, bounds[1:]] - csum[:, bounds[:-1]]
+
+
+def sparse_batch_counts(image_ids, rows, cols, values, shapes, thresholds=IOU_THRESHOLDS, strict=False):
+    """
+    TP / FP / FN per image and per threshold from sparse IoU entries of many images.
+    Entries not listed are treated as IoU 0, so only pairs that actually overlap are needed.
+
+    Args:
+        image_ids, rows, cols (int arrays [n_entries]): position of every entry.
+        values (np array [n_entries]): IoU of every entry.
+        shapes (np array [n_images x 2]): (n_rows_i, n_cols_i) of every image.
+        thresholds (np array): IoU thresholds.
+        strict (bool): see precision_at.
+
+    Returns:
+        tuple of three int arrays [n_images x n_thresholds]: tp, fp, fn
+    """
+    thresholds = np.asarray(thresholds)
+    shapes = np.asarray(shapes, dtype=np.int64).reshape(-1, 2)
+    row_bounds = np.zeros(len(shapes) + 1, dtype=np.int64)
+    col_bounds = np.zeros(len(shapes) + 1, dtype=np.int64)
+    np.cumsum(shapes[:, 0], out=row_bounds[1:])
+    np.cumsum(shapes[:, 1], out=col_bounds[1:])
+
+    # 低于最小阈值的 IoU 对任何阈值都不构成匹配, 直接丢弃
+    values = np.asarray(values, dtype=np.float64)
+    keep = values > thresholds.min()
+    image_ids = np.asarray(image_ids, dtype=np.int64)[keep]
+    row_keys = row_bounds[image_ids] + np.asarray(rows, dtype=np.int64)[keep]
+    col_keys = col_bounds[image_ids] + np.asarray(cols, dtype=np.int64)[keep]
+    values = values[keep]
+
+    row_best, row_second = _segment_best(row_keys, values, row_bounds[-1], strict)
+    col_best, _ = _segment_best(col_keys, values, col_bounds[-1], False)
+
+    thr = thresholds[:, None]
+    row_hit = row_best[None, :] > thr
+    if row_second is None:
+        tp = _segment_sum(row_hit, row_bounds)
+    else:
+        tp = _segment_sum(row_hit & ~(row_second[None, :] > thr), row_bounds)
+    fn = shapes[:, 0][None, :] - _segment_sum(row_hit, row_bounds)
+    fp = shapes[:, 1][None, :] - _segment_sum(col_best[None, :] > thr, col_bounds)
+    return tp.T, fp.T, fn.T
+
+
+def batch_counts(values, shapes, offsets, thresholds=IOU_THRESHOLDS, strict=False):
+    """
+    TP / FP / FN per image and per threshold for a packed batch (see pack_ious).
+
+    Returns:
+        tuple of three int arrays [n_images x n_thresholds]: tp, fp, fn
+    """
+    thresholds = np.asarray(thresholds)
+    shapes = np.asarray(shapes, dtype=np.int64).reshape(-1, 2)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    # 只有超过最小阈值的位置才可能成为匹配, 所以先稀疏化再还原 (image, row, col)
+    flat = np.flatnonzero(np.asarray(values) > thresholds.min())
+    image_ids = np.searchsorted(offsets, flat, side='right') - 1
+    local = flat - offsets[image_ids]
+    n_cols = shapes[image_ids, 1]
+    return sparse_batch_counts(image_ids, local // n_cols, local % n_cols, np.asarray(values)[flat],
+                               shapes, thresholds=thresholds, strict=strict)
+
+
+def batch_iou_map(ious_list=None, packed=None, strict=False, reduce='image', verbose=0):
+    """
+    Scores a whole batch of images at once.
+
+    Args:
+        ious_list (list of np array): per-image IoU matrices, or
+        packed (tuple): (values, shapes, offsets) as returned by pack_ious.
+        strict (bool): see precision_at.
+        reduce (str): 'image' returns the score of every image (what the evaluators average),
+            'pool' sums TP / FP / FN over all images first (the torchvision scripts' iou_map).
+        verbose (int, optional): Whether to print the TP / FP / FN summed over the batch.
+
+    Returns:
+        np array [n_images] for 'image', float for 'pool'.
+    """
+    if packed is None:
+        packed = pack_ious(ious_list)
+    tp, fp, fn = batch_counts(*packed, strict=strict)
+    if verbose:
+        _print_table(IOU_THRESHOLDS, tp.sum(axis=0), fp.sum(axis=0), fn.sum(axis=0))
+    if reduce == 'pool':
+        return counts_to_map(tp.sum(axis=0), fp.sum(axis=0), fn.sum(axis=0))
+    return counts_to_map(tp, fp, fn)
+
+
+###########################################################################################################################################################
+# 阈值网格: 同一个 IoU 矩阵, 按 score / 面积 等阈值取预测 (行) 的子集, 一次算出整个网格的 TP FP FN
+def threshold_levels(values, grid_values):
+    """
+    How many thresholds of a grid axis every row passes (value >= threshold).
+    Row r belongs to the subset of the j-th smallest threshold iff level[r] > j.
+
+    Args:
+        values (np array [n_rows]): per-row value, e.g. the detection scores or the mask areas.
+        grid_values (np array [n_grid]): thresholds of the axis, compared in the dtype of values
+            (so float32 scores are cut exactly like `scores >= t` on a float32 tensor).
+    """
+    values = np.asarray(values)
+    grid_values = np.sort(np.asarray(grid_values).astype(values.dtype))
+    return np.searchsorted(grid_values, values, side='right')
+
+
+def _suffix_sum(hist, axes):
+    # hist[..., a, ...] 的下标 a 表示层级, 返回 out[..., j, ...] = sum_{a > j} hist[..., a, ...]
+    for axis in axes:
+        hist = np.flip(np.cumsum(np.flip(hist, axis=axis), axis=axis), axis=axis)
+        hist = np.take(hist, np.arange(1, hist.shape[axis]), axis=axis)
+    return hist
+
+
+def grid_counts(iou, levels_a, levels_b=None, grid_shape=None, thresholds=IOU_THRESHOLDS, strict=False):
+    """
+    TP / FP / FN of every cell of a threshold grid from a single IoU matrix.
+    Cell (j, k) keeps the rows with levels_a > j and levels_b > k, which is exactly what
+    rebuilding the prediction list with both thresholds and recomputing the IoU would give.
+
+    Args:
+        iou (np array [n_rows x n_cols] or SparseIoU): IoU matrix at the loosest setting, rows are predictions.
+        levels_a, levels_b (int arrays [n_rows]): see threshold_levels, levels_b may be omitted for a 1-D grid.
+        grid_shape (tuple): (n_a, n_b), the number of thresholds of each axis.
+        thresholds (np array): IoU thresholds.
+        strict (bool): see precision_at.
+
+    Returns:
+        tuple of three int arrays [n_a x n_b x n_thresholds]: tp, fp, fn
+    """
+    thresholds = np.asarray(thresholds)
+    n_thr = len(thresholds)
+    levels_a = np.asarray(levels_a, dtype=np.int64)
+    levels_b = np.ones_like(levels_a) if levels_b is None else np.asarray(levels_b, dtype=np.int64)
+    n_a, n_b = grid_shape if grid_shape is not None else (int(levels_a.max(initial=0)), 1)
+
+    if isinstance(iou, SparseIoU):
+        n_rows, n_cols = iou.shape
+        keep = iou.values > thresholds.min()
+        rows, cols, values = np.asarray(iou.rows)[keep], np.asarray(iou.cols)[keep], np.asarray(iou.values)[keep]
+    else:
+        iou = np.asarray(iou)
+        n_rows, n_cols = iou.shape
+        rows, cols = np.nonzero(iou > thresholds.min())
+        values = iou[rows, cols]
+    row_best, row_second = _segment_best(rows, values, n_rows, strict)
+
+    # 行: 每个 (层级 a, 层级 b) 组合的行数 / 命中数 / TP 数, 再做二维后缀和
+    thr = thresholds[:, None]
+    row_hit = row_best[None, :] > thr
+    row_tp = row_hit if row_second is None else row_hit & ~(row_second[None, :] > thr)
+    cell = levels_a * (n_b + 1) + levels_b
+    n_cells = (n_a + 1) * (n_b + 1)
+    count = np.bincount(cell, minlength=n_cells).reshape(n_a + 1, n_b + 1)
+    keys = (np.arange(n_thr)[:, None] * n_cells + cell[None, :]).ravel()
+    hit = np.bincount(keys, weights=row_hit.ravel(), minlength=n_thr * n_cells).reshape(n_thr, n_a + 1, n_b + 1)
+    tp = np.bincount(keys, weights=row_tp.ravel(), minlength=n_thr * n_cells).reshape(n_thr, n_a + 1, n_b + 1)
+    count = _suffix_sum(count, (0, 1))
+    hit = _suffix_sum(hit, (1, 2))
+    tp = _suffix_sum(tp, (1, 2))
+
+    # 列: 对每个阈值和 a 层级, 记录能匹配到该 GT 的行中最大的 b 层级, 列在 (j, k) 中被匹配 <=> 该值 > k
+    above = values[None, :] > thr
+    t_idx, e_idx = np.nonzero(above)
+    best_b = np.zeros((n_thr, n_cols, n_a + 1), dtype=np.int64)
+    np.maximum.at(best_b, (t_idx, cols[e_idx], levels_a[rows[e_idx]]), levels_b[rows[e_idx]])
+    best_b = np.flip(np.maximum.accumulate(np.flip(best_b, axis=2), axis=2), axis=2)[:, :, 1:]
+    keys = (np.arange(n_thr)[:, None, None] * n_a + np.arange(n_a)[None, None, :]) * (n_b + 1) + best_b
+    matched = np.bincount(keys.ravel(), minlength=n_thr * n_a * (n_b + 1)).reshape(n_thr, n_a, n_b + 1)
+    matched = _suffix_sum(matched, (2,))
+
+    tp = tp.astype(np.int64).transpose(1, 2, 0)
+    fn = count[:, :, None] - hit.astype(np.int64).transpose(1, 2, 0)
+    fp = n_cols - matched.transpose(1, 2, 0)
+    return tp, fp, fn
+
+
+def grid_iou_map(iou, levels_a, levels_b=None, grid_shape=None, strict=False):
+    """
+    Competition score of every cell of a threshold grid, see grid_counts.
+
+    Returns:
+        np array [n_a x n_b]: mAP of every cell.
+    """
+    return counts_to_map(*grid_counts(iou, levels_a, levels_b, grid_shape=grid_shape, strict=strict))
+
+
+###########################################################################################################################################################
+# 基准测试: 与原来逐阈值循环的实现对比  python -m toolbox.metric_box.competition_metric
+def _legacy_iou_map(ious):
+    prec = []
+    for t in np.arange(0.5, 1.0, 0.05):
+        matches = ious > t
+        tp = np.sum(np.sum(matches, axis=1) >= 1)
+        fn = np.sum(np.sum(matches, axis=1) == 0)
+        fp = np.sum(np.sum(matches, axis=0) == 0)
+        prec.append(tp / (tp + fp + fn))
+    return np.mean(prec)
+
+
+def _random_ious(n_preds, n_truths, rng):
+    # 模拟 shsy5y: 绝大多数 pair 不重叠, 每个预测只和附近少量 GT 有 IoU
+    ious = np.zeros((n_preds, n_truths))
+    for i in range(n_preds):
+        near = rng.choice(n_truths, size=3, replace=False)
+        ious[i, near] = rng.uniform(0, 1, size=3) ** 0.5
+    return ious
+
+
+def benchmark(n_preds=1000, n_truths=800, n_images=20, repeat=5, seed=3407):
+    rng = np.random.RandomState(seed)
+    ious_list = [_random_ious(n_preds, n_truths, rng) for _ in range(n_images)]
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        legacy = [_legacy_iou_map(iou) for iou in ious_list]
+    t_legacy = (time.perf_counter() - start) / repeat
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        vectorized = [iou_map(iou) for iou in ious_list]
+    t_vectorized = (time.perf_counter() - start) / repeat
+
+    packed = pack_ious(ious_list)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        batched = batch_iou_map(packed=packed)
+    t_batched = (time.perf_counter() - start) / repeat
+
+    assert np.allclose(legacy, vectorized) and np.allclose(legacy, batched)
+    print("{} images of {} preds x {} truths".format(n_images, n_preds, n_truths))
+    print("per-threshold loop : {:8.2f} ms".format(t_legacy * 1e3))
+    print("single broadcast   : {:8.2f} ms  (x{:.1f})".format(t_vectorized * 1e3, t_legacy / t_vectorized))
+    print("packed batch       : {:8.2f} ms  (x{:.1f})".format(t_batched * 1e3, t_legacy / t_batched))
+
+
+
+def benchmark_grid(n_preds=1000, n_truths=800, seed=3407):
+    # 19 x 19 的 (score, 面积) 网格, 原来每个格子重新取子集并重新计算 IoU 矩阵
+    rng = np.random.RandomState(seed)
+    ious = _random_ious(n_preds, n_truths, rng)
+    scores = rng.uniform(0, 1, n_preds).astype(np.float32)
+    areas = rng.randint(0, 200, n_preds)
+    score_grid, area_grid = np.arange(5, 100, 5) / 100, np.arange(5, 100, 5)
+
+    start = time.perf_counter()
+    legacy = np.zeros((len(score_grid), len(area_grid)))
+    for j, s in enumerate(score_grid):
+        for k, a in enumerate(area_grid):
+            legacy[j, k] = iou_map(ious[(scores >= np.float32(s)) & (areas >= a)])
+    t_legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    grid = grid_iou_map(ious, threshold_levels(scores, score_grid), threshold_levels(areas, area_grid),
+                        grid_shape=(len(score_grid), len(area_grid)))
+    t_grid = time.perf_counter() - start
+
+    assert np.allclose(legacy, grid)
+    print("19 x 19 grid over {} preds x {} truths".format(n_preds, n_truths))
+    print("subset per cell    : {:8.2f} ms".format(t_legacy * 1e3))
+    print("single grid pass   : {:8.2f} ms  (x{:.1f})".format(t_grid * 1e3, t_legacy / t_grid))
+
+
+if __name__ == '__main__':
+    benchmark()
+    benchmark_grid()
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-#
+# -------------------------------------------------------------------------------
+# Name:         device_iou
+# Description:  在模型所在的设备上直接计算 mask IoU 与 TP FP FN
+#               evaluator 原来要把每个 pred_masks 拷回 CPU, 逐个 RLE 编码后再做 mask_util.iou。
+#               这里 GT 只解码一次, 以分层的标签图 (通常 1 - 2 层) 缓存在设备上;
+#               交集 = 预测前景像素处的 GT 标签与预测编号组合后做一次 bincount,
+#               整个过程不离开设备, 最终只有每张图 10 个阈值下的 TP FP FN 拷回 CPU
+# Author:       Administrator
+# Date:         2021/12/28
+# -------------------------------------------------------------------------------
+import time
+
+import numpy as np
+import pycocotools.mask as mask_util
+import torch
+
+from toolbox.metric_box.competition_metric import IOU_THRESHOLDS, counts_to_map, iou_map
+from toolbox.rle_box.rle_codec import compress
+
+
+class LayeredLabels:
+    """
+    Ground truth instances stored as a few stacked label images (0 is background, instance i is i + 1).
+    GT masks may overlap slightly, a pixel covered by k instances appears in the first k layers,
+    so there are usually only 1 - 2 layers.
+
+    Attributes:
+        layers (torch tensor [L x H*W]): int16 / int32 label of every pixel in every layer.
+        areas (torch tensor [N]): number of foreground pixels of every instance.
+        image_size (tuple): (height, width).
+    """
+
+    def __init__(self, layers, areas, image_size):
+        self.layers = layers
+        self.areas = areas
+        self.image_size = tuple(image_size)
+
+    def __len__(self):
+        return len(self.areas)
+
+    @property
+    def device(self):
+        return self.layers.device
+
+    @classmethod
+    def from_rles(cls, rles, device="cpu", image_size=None, chunk_size=64):
+        """
+        Args:
+            rles (list of dict): COCO RLEs (compressed, or uncompressed with list counts).
+            device (str or torch.device): where the tensors are cached.
+            image_size (tuple, optional): (height, width), needed only when rles is empty.
+            chunk_size (int): how many RLEs are decoded to full images at once.
+        """
+        rles = [compress(rle) if isinstance(rle.get("counts"), list) else rle for rle in rles]
+        if len(rles) > 0:
+            image_size = tuple(rles[0]["size"])
+        height, width = image_size
+        ids, pixels = [], []
+        for start in range(0, len(rles), chunk_size):
+            dense = mask_util.decode(rles[start:start + chunk_size])
+            # (H, W, N) -> (N, H*W)
+            dense = np.ascontiguousarray(dense.transpose(2, 0, 1)).reshape(dense.shape[2], -1)
+            chunk_ids, chunk_pixels = np.nonzero(dense)
+            ids.append(chunk_ids + start)
+            pixels.append(chunk_pixels)
+        ids = np.concatenate(ids) if ids else np.zeros(0, dtype=np.int64)
+        pixels = np.concatenate(pixels) if pixels else np.zeros(0, dtype=np.int64)
+        areas = np.bincount(ids, minlength=len(rles))
+
+        # 同一个像素上的第 k 个实例放到第 k 层
+        order = np.argsort(pixels, kind='stable')
+        ids, pixels = ids[order], pixels[order]
+        first = np.r_[True, pixels[1:] != pixels[:-1]] if len(pixels) else np.zeros(0, dtype=bool)
+        group_start = np.flatnonzero(first)
+        rank = np.arange(len(pixels)) - np.repeat(group_start, np.diff(np.r_[group_start, len(pixels)]))
+        # 每张验证图都常驻显存, 实例数不超过 int16 时用 int16 存
+        dtype = np.int16 if len(rles) < np.iinfo(np.int16).max else np.int32
+        layers = np.zeros((int(rank.max(initial=0)) + 1, height * width), dtype=dtype)
+        layers[rank, pixels] = ids + 1
+        return cls(torch.as_tensor(layers, device=device),
+                   torch.as_tensor(areas, dtype=torch.int64, device=device), (height, width))
+
+
+def device_mask_iou(pred_masks, targs):
+    """
+    Mask IoU between boolean pred_masks and cached ground truths, computed on pred_masks' device.
+    Same values as mask_util.iou(enc_preds, enc_targs, [0] * len(enc_targs)).
+
+    Args:
+        pred_masks (torch tensor [P x H x W]): bool (or 0 / 1) predicted masks.
+        targs (LayeredLabels): ground truths, on the same device.
+
+    Returns:
+        torch tensor [P x G]: IoU matrix, preds are rows.
+    """
+    n_preds = len(pred_masks)
+    n_targs = len(targs)
+    device = pred_masks.device
+    if n_preds == 0 or n_targs == 0:
+        return torch.zeros((n_preds, n_targs), dtype=torch.float32, device=device)
+    # 预测的每个前景像素查一次 GT 标签, 再对 (pred, GT) 组合计数即为交集
+    pred_flat = pred_masks.reshape(n_preds, -1).bool()
+    if pred_flat.is_cuda:
+        pred_ids, pixels = pred_flat.nonzero(as_tuple=True)
+    else:
+        # CPU 上 torch.nonzero 比 numpy 慢数倍
+        flat = torch.from_numpy(np.flatnonzero(pred_flat.numpy()))
+        pred_ids, pixels = flat // pred_flat.shape[1], flat % pred_flat.shape[1]
+    labels = targs.layers[:, pixels].long()
+    keys = (pred_ids[None, :] * (n_targs + 1) + labels).reshape(-1)
+    inter = torch.bincount(keys, minlength=n_preds * (n_targs + 1)).reshape(n_preds, n_targs + 1)[:, 1:]
+    pred_areas = torch.bincount(pred_ids, minlength=n_preds)
+    union = pred_areas[:, None] + targs.areas[None, :] - inter
+    return inter.float() / union.clamp(min=1).float()
+
+
+def device_precision_counts(iou, thresholds=IOU_THRESHOLDS, strict=False):
+    """
+    Torch version of competition_metric.precision_counts, runs on iou's device.
+
+    Args:
+        iou (torch tensor [n_rows x n_cols]): IoU matrix.
+        thresholds (np array): IoU thresholds.
+        strict (bool): see competition_metric.precision_at.
+
+    Returns:
+        tuple of three int64 tensors [n_thresholds]: tp, fp, fn
+    """
+    n_rows, n_cols = iou.shape
+    thr = torch.as_tensor(np.asarray(thresholds), dtype=iou.dtype, device=iou.device)[:, None]
+    if n_cols == 0:
+        row_best = row_second = iou.new_zeros(n_rows)
+    elif strict and n_cols > 1:
+        top2 = iou.topk(2, dim=1).values
+        row_best, row_second = top2[:, 0], top2[:, 1]
+    else:
+        row_best = iou.max(dim=1).values
+        row_second = iou.new_zeros(n_rows) if strict else None
+    col_best = iou.max(dim=0).values if n_rows > 0 else iou.new_zeros(n_cols)
+
+    row_hit = row_best[None, :] > thr
+    if row_second is None:
+        tp = row_hit.sum(dim=1)
+    else:
+        tp = (row_hit & ~(row_second[None, :] > thr)).sum(dim=1)
+    fn = n_rows - row_hit.sum(dim=1)
+    fp = n_cols - (col_best[None, :] > thr).sum(dim=1)
+    return tp, fp, fn
+
+
+def device_counts(pred_masks, targs, strict=False):
+    """
+    TP / FP / FN of one image, only these 3 x n_thresholds integers are copied back to the host.
+
+    Returns:
+        tuple of three int arrays [n_thresholds]: tp, fp, fn
+    """
+    iou = device_mask_iou(pred_masks, targs)
+    counts = torch.stack(device_precision_counts(iou, strict=strict)).cpu().numpy()
+    return counts[0], counts[1], counts[2]
+
+
+###########################################################################################################################################################
+# 基准测试: 与 encode + mask_util.iou 对比  python -m toolbox.metric_box.device_iou
+def benchmark(n_preds=1000, n_truths=800, seed=3407):
+    from toolbox.metric_box.sparse_iou import _random_cells
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    truths = _random_cells(n_truths, seed=seed)
+    preds = np.concatenate([np.roll(truths, 2, axis=2), _random_cells(n_preds - n_truths, seed=seed + 1)])
+    enc_targs = mask_util.encode(np.asfortranarray(truths.transpose(1, 2, 0).astype(np.uint8)))
+    targs = LayeredLabels.from_rles(enc_targs, device=device)
+    pred_masks = torch.as_tensor(preds, device=device)
+
+    start = time.perf_counter()
+    enc_preds = [mask_util.encode(np.asarray(p, order='F', dtype=np.uint8)) for p in pred_masks.cpu().numpy()]
+    dense = mask_util.iou(enc_preds, enc_targs, [0] * len(enc_targs))
+    score_rle = iou_map(dense)
+    t_rle = time.perf_counter() - start
+
+    device_counts(pred_masks, targs)
+    if device == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    score_device = counts_to_map(*device_counts(pred_masks, targs))
+    t_device = time.perf_counter() - start
+
+    assert np.allclose(dense, device_mask_iou(pred_masks, targs).cpu().numpy(), atol=1e-6)
+    assert np.isclose(score_rle, score_device)
+    print("{} preds x {} truths on {}".format(n_preds, n_truths, device))
+    print("cpu + encode + mask_util.iou : {:8.2f} ms".format(t_rle * 1e3))
+    print("on-device IoU + counts       : {:8.2f} ms  (x{:.1f})".format(t_device * 1e3, t_rle / t_device))
+
+
+if __name__ == '__main__':
+    benchmark()
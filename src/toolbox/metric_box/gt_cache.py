@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-#
+# -------------------------------------------------------------------------------
+# Name:         gt_cache
+# Description:  评估用 GT 的持久化缓存
+#               DefaultTrainer.test 每个 EVAL_PERIOD 都会重新构造 evaluator, 每次都要 DatasetCatalog.get()
+#               以及 COCO(json_file) 重新解析整个标注文件, 一个 run 里要重复几十次。
+#               这里把每张图的 GT RLE / 面积 / bbox / 按位压缩的 bbox 裁剪 mask 预先算好写到磁盘,
+#               目录名为标注文件内容的哈希, 之后所有 evaluator 直接 np.load(mmap_mode='r') 使用
+# Author:       Administrator
+# Date:         2021/12/29
+# -------------------------------------------------------------------------------
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pycocotools.mask as mask_util
+
+from toolbox.metric_box.sparse_iou import InstanceCrops
+from toolbox.rle_box.rle_codec import to_compressed
+
+# 缓存格式变化时修改, 旧缓存自动失效
+CACHE_VERSION = 1
+
+_ARRAYS = ("ann_offsets", "areas", "boxes", "bit_offsets", "bits", "rle_offsets", "rle_bytes")
+
+
+def file_hash(path, chunk_size=1 << 24):
+    """
+    sha1 of the file content, so the cache follows the annotations and not the file name.
+    """
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _to_rle(segm, height, width):
+    # 标注可能是 polygon, 未压缩 RLE 或者压缩 RLE, 统一经 rle_codec 转成压缩 RLE
+    return to_compressed(segm, height, width)
+
+
+def _counts_bytes(rle):
+    counts = rle["counts"]
+    return counts.encode("ascii") if isinstance(counts, str) else bytes(counts)
+
+
+class GTCache:
+    """
+    Read-only, memory-mapped ground truth of one COCO annotation file.
+
+    Instances of image k are ann_offsets[k]:ann_offsets[k + 1] in every per-instance array:
+        areas (np array [N]): foreground pixels of every instance.
+        boxes (np array [N x 4]): int (x0, y0, x1, y1) crop window, x1 / y1 exclusive.
+        bits (np array): np.packbits of every instance's crop, instance i is bits[bit_offsets[i]:bit_offsets[i + 1]].
+        rle_bytes (np array): compressed RLE counts of every instance, rle_bytes[rle_offsets[i]:rle_offsets[i + 1]].
+
+    It also behaves like the old {image_id: annotations} dict built from DatasetCatalog.get(),
+    cache[image_id] returns a list of {"segmentation", "area", "bbox"} dicts.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        self.image_ids = meta["image_ids"]
+        self.image_sizes = [tuple(size) for size in meta["image_sizes"]]
+        self._index = {image_id: k for k, image_id in enumerate(self.image_ids)}
+        for name in _ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, name + ".npy"), mmap_mode="r"))
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def __contains__(self, image_id):
+        return image_id in self._index
+
+    def __getitem__(self, image_id):
+        return self.annotations(image_id)
+
+    @property
+    def num_annotations(self):
+        return int(self.ann_offsets[-1])
+
+    def _span(self, image_id):
+        k = self._index[image_id]
+        return int(self.ann_offsets[k]), int(self.ann_offsets[k + 1]), self.image_sizes[k]
+
+    def image_size(self, image_id):
+        return self.image_sizes[self._index[image_id]]
+
+    def rles(self, image_id):
+        """
+        Returns:
+            list of dict: compressed COCO RLEs of the image, ready for mask_util.iou.
+        """
+        start, end, size = self._span(image_id)
+        offsets = self.rle_offsets[start:end + 1]
+        return [{"size": list(size), "counts": self.rle_bytes[offsets[i]:offsets[i + 1]].tobytes()}
+                for i in range(end - start)]
+
+    def annotations(self, image_id):
+        start, end, _ = self._span(image_id)
+        boxes = self.boxes[start:end]
+        return [{"segmentation": rle, "area": int(area), "bbox": [int(x0), int(y0), int(x1 - x0), int(y1 - y0)]}
+                for rle, area, (x0, y0, x1, y1) in zip(self.rles(image_id), self.areas[start:end], boxes)]
+
+    def crops(self, image_id):
+        """
+        Returns:
+            InstanceCrops: unpacked bbox crops of the image, without decoding any RLE.
+        """
+        start, end, size = self._span(image_id)
+        boxes = np.asarray(self.boxes[start:end])
+        crops = []
+        for i, (x0, y0, x1, y1) in enumerate(boxes):
+            h, w = y1 - y0, x1 - x0
+            bits = self.bits[self.bit_offsets[start + i]:self.bit_offsets[start + i + 1]]
+            crops.append(np.unpackbits(bits, count=h * w).reshape(h, w).astype(bool))
+        return InstanceCrops(boxes, crops, np.asarray(self.areas[start:end]), size)
+
+    ###########################################################################################################################################################
+    @classmethod
+    def load(cls, json_file, cache_dir=None):
+        """
+        Opens the cache of json_file, builds it first if it does not exist yet.
+
+        Args:
+            json_file (str): COCO format annotation file.
+            cache_dir (str, optional): where caches are kept, defaults to .gt_cache next to json_file.
+        """
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(os.path.abspath(json_file)), ".gt_cache")
+        path = os.path.join(cache_dir, "v{}_{}".format(CACHE_VERSION, file_hash(json_file)))
+        if not os.path.exists(os.path.join(path, "meta.json")):
+            cls.build(json_file, path)
+        return cls(path)
+
+    @classmethod
+    def from_dataset(cls, dataset_name, cache_dir=None):
+        """
+        Cache of a dataset registered with register_coco_instances.
+        """
+        from detectron2.data import MetadataCatalog
+
+        return cls.load(MetadataCatalog.get(dataset_name).json_file, cache_dir=cache_dir)
+
+    @staticmethod
+    def build(json_file, path, chunk_size=64):
+        """
+        Decodes every annotation of json_file once and writes the cache to path.
+        The cache is written to a temporary directory and renamed, so ranks building it at the same time are safe.
+        """
+        from toolbox.data_box.coco_stream import CocoIndex
+
+        # 流式索引, 逐张图读取标注, 不把整个 json 留在内存里
+        index = CocoIndex.load(json_file)
+
+        image_ids, image_sizes = [], []
+        ann_offsets, areas, boxes = [0], [], []
+        bit_blobs, bit_offsets = [], [0]
+        rle_blobs, rle_offsets = [], [0]
+        for img, anns in index:
+            height, width = img["height"], img["width"]
+            rles = [_to_rle(ann["segmentation"], height, width) for ann in anns]
+            image_ids.append(img["id"])
+            image_sizes.append((height, width))
+            ann_offsets.append(ann_offsets[-1] + len(rles))
+            if len(rles) == 0:
+                continue
+            crops = InstanceCrops.from_rles(rles, chunk_size=chunk_size)
+            areas.extend(crops.areas.tolist())
+            boxes.append(crops.boxes)
+            for crop, rle in zip(crops.crops, rles):
+                bit_blobs.append(np.packbits(crop.ravel()))
+                bit_offsets.append(bit_offsets[-1] + len(bit_blobs[-1]))
+                rle_blobs.append(np.frombuffer(_counts_bytes(rle), dtype=np.uint8))
+                rle_offsets.append(rle_offsets[-1] + len(rle_blobs[-1]))
+
+        arrays = {
+            "ann_offsets": np.asarray(ann_offsets, dtype=np.int64),
+            "areas": np.asarray(areas, dtype=np.int64),
+            "boxes": np.concatenate(boxes).astype(np.int64) if boxes else np.zeros((0, 4), dtype=np.int64),
+            "bit_offsets": np.asarray(bit_offsets, dtype=np.int64),
+            "bits": np.concatenate(bit_blobs) if bit_blobs else np.zeros(0, dtype=np.uint8),
+            "rle_offsets": np.asarray(rle_offsets, dtype=np.int64),
+            "rle_bytes": np.concatenate(rle_blobs) if rle_blobs else np.zeros(0, dtype=np.uint8),
+        }
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(path))
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, name + ".npy"), array)
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump({"json_file": os.path.abspath(json_file), "image_ids": image_ids,
+                       "image_sizes": image_sizes}, f)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # 其他进程已经先写好了
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+###########################################################################################################################################################
+# 基准测试: 与每次解析 json 再 DatasetCatalog 式分组对比  python -m toolbox.metric_box.gt_cache
+def benchmark(n_images=60, n_truths=300, seed=3407):
+    from toolbox.metric_box.sparse_iou import _random_cells
+
+    tmp = tempfile.mkdtemp()
+    json_file = os.path.join(tmp, "val.json")
+    images, annotations = [], []
+    for k in range(n_images):
+        masks = _random_cells(n_truths, seed=seed + k)
+        images.append({"id": "img{}".format(k), "height": masks.shape[1], "width": masks.shape[2]})
+        for mask in masks:
+            rle = mask_util.encode(np.asfortranarray(mask.astype(np.uint8)))
+            rle["counts"] = rle["counts"].decode("ascii")
+            annotations.append({"id": len(annotations), "image_id": images[-1]["id"], "segmentation": rle,
+                                "category_id": 1, "iscrowd": 0})
+    with open(json_file, "w") as f:
+        json.dump({"images": images, "annotations": annotations, "categories": [{"id": 1, "name": "cell"}]}, f)
+
+    start = time.perf_counter()
+    with open(json_file, "r") as f:
+        dataset = json.load(f)
+    legacy = {img["id"]: [] for img in dataset["images"]}
+    for ann in dataset["annotations"]:
+        legacy[ann["image_id"]].append(ann)
+    legacy_crops = {image_id: InstanceCrops.from_rles([a["segmentation"] for a in anns])
+                    for image_id, anns in legacy.items()}
+    t_legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    GTCache.load(json_file)
+    t_build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cache = GTCache.load(json_file)
+    cached_crops = {image_id: cache.crops(image_id) for image_id in cache.image_ids}
+    t_cached = time.perf_counter() - start
+
+    for image_id in cache.image_ids:
+        a, b = legacy_crops[image_id], cached_crops[image_id]
+        assert np.array_equal(a.boxes, b.boxes) and np.array_equal(a.areas, b.areas)
+        assert all(np.array_equal(x, y) for x, y in zip(a.crops, b.crops))
+        rles = [x["segmentation"] for x in legacy[image_id]]
+        assert np.allclose(np.diag(mask_util.iou(cache.rles(image_id), rles, [0] * len(rles))), 1)
+    shutil.rmtree(tmp, ignore_errors=True)
+    print("{} images x {} instances".format(n_images, n_truths))
+    print("parse json + decode every eval : {:8.2f} ms".format(t_legacy * 1e3))
+    print("build cache (once)             : {:8.2f} ms".format(t_build * 1e3))
+    print("open cache + unpack crops      : {:8.2f} ms  (x{:.1f})".format(t_cached * 1e3, t_legacy / t_cached))
+
+
+if __name__ == '__main__':
+    benchmark()
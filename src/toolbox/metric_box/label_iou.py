@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-#
+# -------------------------------------------------------------------------------
+# Name:         label_iou
+# Description:  标签图 (每个实例一个整数值, 0 为背景) 之间的 IoU 矩阵
+#               原来 torchvision 脚本中的 compute_iou 用 np.histogram2d 对两张 float 标签图分箱,
+#               既慢, 又默认标签值是从 0 开始连续的 (不连续时分箱会把不同实例合并到一起)。
+#               这里把 (truth, pred) 合成一个整数 key, 只做一次 np.bincount, 标签按整数精确处理
+# Author:       Administrator
+# Date:         2021/12/28
+# -------------------------------------------------------------------------------
+import time
+
+import numpy as np
+
+
+def _as_labels(image):
+    image = np.asarray(image)
+    if image.dtype.kind == 'f':
+        image = np.rint(image)
+    return image.astype(np.int64, copy=False).ravel()
+
+
+def _iou_from_hist(hist, n_true, n_pred):
+    """
+    Turns a joint (truth, pred) histogram into the IoU matrix of the labels that are present.
+
+    Args:
+        hist (np array [(n_true + 1) * (n_pred + 1)]): pixel count of every (truth, pred) label pair.
+
+    Returns:
+        np array [true_objects x pred_objects]: IoU matrix without background,
+        rows / columns follow the increasing label values.
+    """
+    intersection = hist.reshape(n_true + 1, n_pred + 1)
+    area_true = intersection.sum(axis=1)
+    area_pred = intersection.sum(axis=0)
+    # 不连续的标签值没有像素, 直接剔除; 0 为背景
+    true_ids = np.flatnonzero(area_true[1:]) + 1
+    pred_ids = np.flatnonzero(area_pred[1:]) + 1
+    intersection = intersection[np.ix_(true_ids, pred_ids)]
+    union = area_true[true_ids][:, None] + area_pred[pred_ids][None, :] - intersection
+    return intersection / union
+
+
+def label_iou(labels, y_pred):
+    """
+    Computes the IoU for instance labels and predictions.
+
+    Args:
+        labels (np array [H x W]): ground truth label image, 0 is background.
+        y_pred (np array [H x W]): predicted label image, 0 is background.
+
+    Returns:
+        np array: IoU matrix, of size true_objects x pred_objects.
+    """
+    labels = _as_labels(labels)
+    y_pred = _as_labels(y_pred)
+    n_true = int(labels.max(initial=0))
+    n_pred = int(y_pred.max(initial=0))
+    hist = np.bincount(labels * (n_pred + 1) + y_pred, minlength=(n_true + 1) * (n_pred + 1))
+    return _iou_from_hist(hist, n_true, n_pred)
+
+
+def batch_label_iou(truths, preds):
+    """
+    Same as label_iou for several images, with a single np.bincount over all of them.
+
+    Args:
+        truths (list of np array [H x W]): ground truth label images.
+        preds (list of np array [H x W]): predicted label images.
+
+    Returns:
+        list of np array: IoU matrix of every image.
+    """
+    if len(truths) == 0:
+        return []
+    truths = [np.asarray(truth) for truth in truths]
+    preds = [np.asarray(pred) for pred in preds]
+    n_true = np.asarray([int(np.rint(truth.max(initial=0))) for truth in truths], dtype=np.int64)
+    n_pred = np.asarray([int(np.rint(pred.max(initial=0))) for pred in preds], dtype=np.int64)
+    sizes = (n_true + 1) * (n_pred + 1)
+    offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+
+    # 所有图片的 key 直接写进同一块 buffer, 避免每张图的临时数组再 concatenate 一次
+    pixels = np.cumsum([0] + [truth.size for truth in truths])
+    keys = np.empty(pixels[-1], dtype=np.int64)
+    for i, (truth, pred) in enumerate(zip(truths, preds)):
+        key = keys[pixels[i]:pixels[i + 1]]
+        key[:] = _as_labels(truth)
+        key *= n_pred[i] + 1
+        key += _as_labels(pred)
+        key += offsets[i]
+    hist = np.bincount(keys, minlength=offsets[-1])
+    return [_iou_from_hist(hist[offsets[i]:offsets[i + 1]], n_true[i], n_pred[i]) for i in range(len(truths))]
+
+
+###########################################################################################################################################################
+# 基准测试: 与原来 np.histogram2d 的实现对比  python -m toolbox.metric_box.label_iou
+def _histogram2d_iou(labels, y_pred):
+    true_objects = len(np.unique(labels))
+    pred_objects = len(np.unique(y_pred))
+    intersection = np.histogram2d(labels.flatten(), y_pred.flatten(), bins=(true_objects, pred_objects))[0]
+    area_true = np.expand_dims(np.histogram(labels, bins=true_objects)[0], -1)
+    area_pred = np.expand_dims(np.histogram(y_pred, bins=pred_objects)[0], 0)
+    union = area_true + area_pred - intersection
+    intersection = intersection[1:, 1:]
+    union = union[1:, 1:]
+    union[union == 0] = 1e-9
+    return intersection / union
+
+
+def _random_label_image(n, height=520, width=704, seed=0):
+    rng = np.random.RandomState(seed)
+    image = np.zeros((height, width), dtype=np.float64)
+    for m in range(1, n + 1):
+        r = rng.randint(5, 11)
+        cy, cx = rng.randint(r, height - r), rng.randint(r, width - r)
+        image[cy - r:cy + r, cx - r:cx + r] = m
+    return image
+
+
+def benchmark(n_truths=340, n_preds=400, n_images=10, seed=3407):
+    truths = [_random_label_image(n_truths, seed=seed + i) for i in range(n_images)]
+    preds = [np.roll(_random_label_image(n_preds, seed=seed + i), 3, axis=1) for i in range(n_images)]
+
+    start = time.perf_counter()
+    legacy = [_histogram2d_iou(t, p) for t, p in zip(truths, preds)]
+    t_legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    single = [label_iou(t, p) for t, p in zip(truths, preds)]
+    t_single = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batched = batch_label_iou(truths, preds)
+    t_batched = time.perf_counter() - start
+
+    # 后画的实例会覆盖前面的, 只有两边都完整出现所有标签时才能和 histogram2d 逐位比较
+    for a, b, c, t, p in zip(legacy, single, batched, truths, preds):
+        if len(np.unique(t)) == n_truths + 1 and len(np.unique(p)) == n_preds + 1:
+            assert np.allclose(a, b)
+        assert np.array_equal(b, c)
+    print("{} images, {} truths x {} preds".format(n_images, n_truths, n_preds))
+    print("np.histogram2d   : {:8.2f} ms".format(t_legacy * 1e3))
+    print("np.bincount      : {:8.2f} ms  (x{:.1f})".format(t_single * 1e3, t_legacy / t_single))
+    print("batched bincount : {:8.2f} ms  (x{:.1f})".format(t_batched * 1e3, t_legacy / t_batched))
+
+
+if __name__ == '__main__':
+    benchmark()
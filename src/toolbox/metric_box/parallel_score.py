@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-#
+# -------------------------------------------------------------------------------
+# Name:         parallel_score
+# Description:  逐张图评分的并行分发
+#               evaluator 的 evaluate() 和 LocalCV 脚本都是在 Python 里一张图一张图地做 mask_util.iou + iou_map,
+#               这段时间 CPU 其他核空闲, GPU 也在等。
+#               ScorePool 把任务按 chunk 分给进程池 / 线程池, 结果严格按任务顺序返回, 保证可复现;
+#               imap 边产生任务边评分 (例如 LocalCV 中推理一张评一张), 同时在途的 chunk 数有上限
+# Author:       Administrator
+# Date:         2021/12/29
+# -------------------------------------------------------------------------------
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+
+import numpy as np
+import pycocotools.mask as mask_util
+
+from toolbox.metric_box.competition_metric import iou_map
+
+
+def rle_score(enc_preds, enc_targs):
+    """
+    Competition score of one image from COCO RLEs, 0 when there is no prediction.
+    Module level so it can be sent to a process pool.
+    """
+    if len(enc_preds) == 0:
+        return 0
+    ious = mask_util.iou(enc_preds, enc_targs, [0] * len(enc_targs))
+    return iou_map(ious)
+
+
+def _run_chunk(fn, chunk):
+    return [fn(*args) for args in chunk]
+
+
+def _chunks(jobs, chunk_size):
+    jobs = iter(jobs)
+    while True:
+        chunk = list(islice(jobs, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class ScorePool:
+    """
+    Runs fn(*job) for every job on a pool of workers, results keep the order of the jobs.
+
+    Args:
+        num_workers (int): 0 runs everything in the calling thread, as before.
+        pool_type (str): 'process' for jobs that are cheap to pickle (e.g. RLEs),
+            'thread' for jobs holding large arrays or CUDA tensors.
+        chunk_size (int): jobs sent to a worker at once.
+        max_pending (int, optional): chunks in flight, bounds the memory held by imap.
+            Defaults to 2 * num_workers.
+    """
+
+    def __init__(self, num_workers=0, pool_type='process', chunk_size=8, max_pending=None):
+        assert pool_type in ('process', 'thread'), pool_type
+        self.num_workers = num_workers
+        self.pool_type = pool_type
+        self.chunk_size = chunk_size
+        self.max_pending = max_pending if max_pending is not None else 2 * max(num_workers, 1)
+
+    def imap(self, fn, jobs):
+        """
+        Lazily scores jobs (any iterable of argument tuples), yielding results in order.
+        """
+        if self.num_workers <= 0:
+            for args in jobs:
+                yield fn(*args)
+            return
+        executor_cls = ProcessPoolExecutor if self.pool_type == 'process' else ThreadPoolExecutor
+        with executor_cls(max_workers=self.num_workers) as executor:
+            pending = deque()
+            for chunk in _chunks(jobs, self.chunk_size):
+                pending.append(executor.submit(_run_chunk, fn, chunk))
+                while len(pending) >= self.max_pending:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+    def map(self, fn, jobs):
+        return list(self.imap(fn, jobs))
+
+
+###########################################################################################################################################################
+# 基准测试: 与串行循环对比  python -m toolbox.metric_box.parallel_score
+def benchmark(n_images=24, n_preds=400, n_truths=300, num_workers=4, seed=3407):
+    from toolbox.metric_box.sparse_iou import _random_cells
+
+    jobs = []
+    for k in range(n_images):
+        truths = _random_cells(n_truths, seed=seed + k)
+        preds = np.concatenate([np.roll(truths, 2, axis=2), _random_cells(n_preds - n_truths, seed=seed + k + 1000)])
+        jobs.append(([mask_util.encode(np.asarray(p, order='F', dtype=np.uint8)) for p in preds],
+                     mask_util.encode(np.asfortranarray(truths.transpose(1, 2, 0).astype(np.uint8)))))
+
+    start = time.perf_counter()
+    serial = ScorePool().map(rle_score, jobs)
+    t_serial = time.perf_counter() - start
+
+    print("{} images of {} preds x {} truths".format(n_images, n_preds, n_truths))
+    print("{:<19}: {:8.2f} ms".format("serial", t_serial * 1e3))
+    for pool_type in ('process', 'thread'):
+        start = time.perf_counter()
+        parallel = ScorePool(num_workers, pool_type=pool_type, chunk_size=2).map(rle_score, jobs)
+        t_parallel = time.perf_counter() - start
+        assert parallel == serial
+        print("{:<19}: {:8.2f} ms  (x{:.1f})".format("{} x{}".format(pool_type, num_workers), t_parallel * 1e3,
+                                                    t_serial / t_parallel))
+
+
+if __name__ == '__main__':
+    benchmark()
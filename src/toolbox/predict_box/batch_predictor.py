@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-#
+# -------------------------------------------------------------------------------
+# Name:         batch_predictor
+# Description:  按 batch 推理、后台线程预取的 predictor
+#               Detectron2_LocalCV_Submit 的 predict_all 一张一张地 cv2.imread + DefaultPredictor(im),
+#               读图、缩放、模型前向、把预测转成 RLE / 裁剪 (PredictionWriter) 全部串行, GPU 在读图和编码时空等。
+#               BatchPredictor 与 DefaultPredictor 的预处理相同 (ResizeShortestEdge + 格式转换), 但一次接收一组图片;
+#               predict_batches 在后台线程读入并缩放下一组图片, 主线程只跑模型,
+#               再配合 PredictionCache.load_or_predict(num_workers=) 把转换交给线程池, 与下一组的前向重叠
+# Author:       Administrator
+# Date:         2021/12/31
+# -------------------------------------------------------------------------------
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+
+
+def prefetch(iterable, depth=2):
+    """
+    Iterates iterable on a background thread, at most depth items ahead; exceptions are raised in the caller.
+    """
+    items = queue.Queue(maxsize=depth)
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put((item, None))
+        except BaseException as e:
+            items.put((None, e))
+            return
+        items.put((done, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    while True:
+        item, error = items.get()
+        if error is not None:
+            raise error
+        if item is done:
+            break
+        yield item
+    thread.join()
+
+
+class BatchPredictor:
+    """
+    DefaultPredictor taking a list of images, model inputs are built by preprocess (thread safe, no GPU work).
+
+    Args:
+        model: a detectron2 model in eval mode, called with a list of {"image", "height", "width"}.
+        transform (callable, optional): resizes one original image, e.g. ResizeShortestEdge of the test cfg.
+        input_format (str): cfg.INPUT.FORMAT, images are given as BGR (or H x W x 1 for "L") like DefaultPredictor.
+    """
+
+    def __init__(self, model, transform=None, input_format="BGR"):
+        self.model = model
+        self.transform = transform
+        self.input_format = input_format
+
+    @classmethod
+    def from_cfg(cls, cfg):
+        """ Same model, weights and test resizing as DefaultPredictor(cfg). """
+        import detectron2.data.transforms as T
+        from detectron2.checkpoint import DetectionCheckpointer
+        from detectron2.modeling import build_model
+
+        model = build_model(cfg.clone())
+        model.eval()
+        DetectionCheckpointer(model).load(cfg.MODEL.WEIGHTS)
+        aug = T.ResizeShortestEdge([cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MIN_SIZE_TEST], cfg.INPUT.MAX_SIZE_TEST)
+        return cls(model, lambda image: aug.get_transform(image).apply_image(image), cfg.INPUT.FORMAT)
+
+    def preprocess(self, original_image):
+        if self.input_format == "RGB":
+            original_image = original_image[:, :, ::-1]
+        height, width = original_image.shape[:2]
+        image = original_image if self.transform is None else self.transform(original_image)
+        if image.ndim == 2:
+            image = image[:, :, None]
+        image = torch.as_tensor(np.ascontiguousarray(image.astype("float32").transpose(2, 0, 1)))
+        return {"image": image, "height": height, "width": width}
+
+    def __call__(self, original_images):
+        """
+        Returns:
+            list of dict: model outputs of every image ({"instances": ...} for Mask R-CNN), in the same order.
+        """
+        return self.predict([self.preprocess(image) for image in original_images])
+
+    def predict(self, inputs):
+        with torch.no_grad():
+            return self.model(inputs)
+
+
+def _batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def predict_batches(predictor, items, read_image, batch_size=4, depth=2):
+    """
+    Runs predictor over items batch by batch, reading and resizing the next batches on a background thread.
+
+    Args:
+        items (iterable): e.g. the dataset dicts of the validation set.
+        read_image (callable): item -> original image, e.g. lambda item: cv2.imread(item['file_name']).
+
+    Yields:
+        tuple: (item, model output) in the order of items.
+    """
+    def load():
+        for batch in _batches(items, batch_size):
+            yield batch, [predictor.preprocess(read_image(item)) for item in batch]
+
+    for batch, inputs in prefetch(load(), depth):
+        yield from zip(batch, predictor.predict(inputs))
+
+
+###########################################################################################################################################################
+# 基准测试: 与逐张 imread + 推理 + 写缓存的循环对比  python -m toolbox.predict_box.batch_predictor
+class _BenchmarkModel:
+    # 代替 GPU 上的 Mask R-CNN: 前向时 CPU 空闲 (sleep), 一个 batch 的耗时 = 固定开销 + 每张图的耗时;
+    # 输出的 mask 为每张图预先生成的细胞
+    def __init__(self, masks, batch_overhead=0.03, per_image=0.01):
+        self.masks = masks
+        self.batch_overhead = batch_overhead
+        self.per_image = per_image
+
+    def __call__(self, inputs):
+        from types import SimpleNamespace
+
+        time.sleep(self.batch_overhead + self.per_image * len(inputs))
+        outputs = []
+        for x in inputs:
+            masks = self.masks[int(x["image"][0, 0, 0]) % len(self.masks)]
+            n = len(masks)
+            outputs.append({"instances": SimpleNamespace(scores=torch.linspace(1, 0, n), pred_classes=torch.zeros(n, dtype=torch.int64),
+                                                         pred_boxes=torch.zeros(n, 4), pred_masks=torch.as_tensor(masks))})
+        return outputs
+
+
+def benchmark(n_images=24, n_preds=200, batch_size=4, num_workers=2, seed=3407):
+    import os
+    import shutil
+    import tempfile
+
+    import cv2
+
+    from toolbox.metric_box.sparse_iou import _random_cells
+    from toolbox.predict_box.prediction_cache import PredictionCache, PredictionWriter
+
+    tmp = tempfile.mkdtemp()
+    masks = [_random_cells(n_preds, seed=seed + k) for k in range(4)]
+    items = []
+    for k in range(n_images):
+        # 左上角像素记录用哪一组 mask
+        image = np.full((520, 704, 3), 128, dtype=np.uint8)
+        image[0, 0] = k % len(masks)
+        items.append({"image_id": "img{}".format(k), "file_name": os.path.join(tmp, "img{}.png".format(k))})
+        cv2.imwrite(items[-1]["file_name"], image)
+    predictor = BatchPredictor(_BenchmarkModel(masks))
+    checkpoint = os.path.join(tmp, "model.pth")
+    with open(checkpoint, "wb") as f:
+        f.write(os.urandom(1 << 10))
+
+    # 原来的循环: 一张一张 imread + predictor(im), 写缓存也在同一个线程
+    start = time.perf_counter()
+    writer = PredictionWriter(os.path.join(tmp, "legacy"))
+    for item in items:
+        pred = predictor([cv2.imread(item["file_name"])])[0]
+        writer.add_instances(item["image_id"], pred["instances"])
+    legacy = writer.close()
+    t_legacy = time.perf_counter() - start
+
+    def predict_all():
+        for item, pred in predict_batches(predictor, items, lambda item: cv2.imread(item["file_name"]), batch_size):
+            yield item["image_id"], pred["instances"]
+
+    start = time.perf_counter()
+    cache = PredictionCache.load_or_predict(tmp, checkpoint, "val_fold1", "cfg", predict_all, num_workers=num_workers)
+    t_batched = time.perf_counter() - start
+
+    assert cache.image_ids == legacy.image_ids
+    for image_id in legacy.image_ids:
+        a, b = legacy.crops(image_id), cache.crops(image_id)
+        assert np.array_equal(a.areas, b.areas) and all(np.array_equal(x, y) for x, y in zip(a.crops, b.crops))
+    shutil.rmtree(tmp, ignore_errors=True)
+    print("{} images x {} predictions, model: 30 ms per batch + 10 ms per image (CPU idle, as on GPU)".format(n_images, n_preds))
+    print("imread + predict + write, one by one   : {:8.2f} ms  {:6.1f} images/s".format(t_legacy * 1e3, n_images / t_legacy))
+    print("batch {}, prefetch, {} writer threads   : {:8.2f} ms  {:6.1f} images/s  (x{:.1f})".format(
+        batch_size, num_workers, t_batched * 1e3, n_images / t_batched, t_legacy / t_batched))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-#
+# -------------------------------------------------------------------------------
+# Name:         prediction_cache
+# Description:  模型原始预测的磁盘缓存
+#               LocalCV / 阈值搜索脚本每改一次阈值或过滤条件, 都要把整个验证 fold 重新过一遍 DefaultPredictor / inference_detector。
+#               这里按 (checkpoint 内容哈希, 数据集, 推理配置, 二值 / 软 mask 阈值) 生成缓存目录, 只推理一次,
+#               把每个实例的 score / 类别 / bbox / 面积 / 压缩 RLE 写到磁盘, 之后的评分、过滤、阈值实验全部从磁盘回放
+# Author:       Administrator
+# Date:         2021/12/30
+# -------------------------------------------------------------------------------
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pycocotools.mask as mask_util
+
+from toolbox.metric_box.gt_cache import file_hash
+from toolbox.metric_box.parallel_score import ScorePool
+from toolbox.metric_box.sparse_iou import InstanceCrops
+
+# 缓存格式变化时修改
+CACHE_VERSION = 2
+
+
+def _to_numpy(x):
+    if hasattr(x, "tensor"):
+        x = x.tensor
+    if hasattr(x, "cpu"):
+        x = x.cpu().numpy()
+    return np.asarray(x)
+
+
+def _offsets(blobs):
+    offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in blobs], out=offsets[1:])
+    return offsets
+
+
+def cache_key(checkpoint, dataset, inference_cfg, mask_thresholds=None):
+    """
+    Args:
+        checkpoint (str): path of the weights, hashed by content.
+        dataset (str): annotation json of the images (hashed by content) or any string naming them.
+        inference_cfg (str): text of everything else that changes the outputs, e.g. cfg.dump() or cfg.pretty_text.
+        mask_thresholds (list of float, optional): see PredictionWriter, binary and soft caches of the same model
+            are different entries.
+    """
+    dataset_key = file_hash(dataset) if os.path.isfile(dataset) else dataset
+    masks_key = "binary" if mask_thresholds is None else ",".join(repr(float(t)) for t in mask_thresholds)
+    text = "v{}|{}|{}|{}|{}".format(CACHE_VERSION, file_hash(checkpoint), dataset_key, inference_cfg, masks_key)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class PredictionWriter:
+    """
+    Collects the raw predictions image by image, then writes them as a PredictionCache.
+
+    Args:
+        path (str): final cache directory.
+        mask_thresholds (list of float, optional): when the masks are soft (e.g. sigmoid outputs),
+            they are binarized and stored once per threshold. None means the masks are already binary.
+    """
+
+    def __init__(self, path, mask_thresholds=None):
+        self.path = path
+        self.mask_thresholds = None if mask_thresholds is None else [float(t) for t in mask_thresholds]
+        n_layers = 1 if mask_thresholds is None else len(mask_thresholds)
+        self._image_ids, self._image_sizes, self._image_offsets = [], [], [0]
+        self._scores, self._classes, self._boxes = [], [], []
+        self._areas = [[] for _ in range(n_layers)]
+        self._rles = [[] for _ in range(n_layers)]
+        # 同时保存按位压缩的 bbox 裁剪, 回放时不用再把 RLE 解码成整图
+        self._crop_boxes = [[] for _ in range(n_layers)]
+        self._bits = [[] for _ in range(n_layers)]
+
+    def prepare(self, image_id, scores, classes, boxes, masks):
+        """
+        Converts the predictions of one image to what the cache stores (binary masks, crops, RLEs).
+        It does not touch the writer, so it can run on a thread pool while the model predicts the next images.
+
+        Args:
+            scores (array [N]), classes (array [N]), boxes (array [N x 4] XYXY_ABS), masks (array [N x H x W]):
+                numpy arrays or torch tensors (on any device), masks may be soft when mask_thresholds is set.
+        """
+        if hasattr(masks, "tensor"):
+            masks = masks.tensor
+        thresholds = [None] if self.mask_thresholds is None else self.mask_thresholds
+        layers = []
+        for threshold in thresholds:
+            # 在 masks 所在的设备上二值化, 只有 bool mask 会拷回 CPU; 已经是 bool 的 (detectron2 的 pred_masks) 不再比较
+            if threshold is None and str(masks.dtype).endswith("bool"):
+                binary = _to_numpy(masks)
+            else:
+                binary = _to_numpy(masks != 0 if threshold is None else masks > threshold)
+            crops = InstanceCrops.from_dense(binary)
+            counts = []
+            if len(binary):
+                rles = mask_util.encode(np.asfortranarray(binary.transpose(1, 2, 0).astype(np.uint8)))
+                counts = [rle["counts"] for rle in rles]
+            layers.append((crops.areas.astype(np.int32), crops.boxes, [np.packbits(crop.ravel()) for crop in crops.crops],
+                           counts))
+        return (image_id, tuple(int(x) for x in masks.shape[1:]), len(masks),
+                _to_numpy(scores).astype(np.float32).reshape(-1), _to_numpy(classes).astype(np.int16).reshape(-1),
+                _to_numpy(boxes).astype(np.float32).reshape(-1, 4), layers)
+
+    def prepare_item(self, *item):
+        """ prepare of (image_id, scores, classes, boxes, masks) or of a detectron2 (image_id, instances). """
+        if len(item) == 2:
+            image_id, instances = item
+            return self.prepare(image_id, instances.scores, instances.pred_classes, instances.pred_boxes,
+                                instances.pred_masks)
+        return self.prepare(*item)
+
+    def add_prepared(self, prepared):
+        image_id, image_size, n, scores, classes, boxes, layers = prepared
+        self._image_ids.append(image_id)
+        self._image_sizes.append(image_size)
+        self._image_offsets.append(self._image_offsets[-1] + n)
+        self._scores.append(scores)
+        self._classes.append(classes)
+        self._boxes.append(boxes)
+        for layer, (areas, crop_boxes, bits, counts) in enumerate(layers):
+            self._areas[layer].append(areas)
+            self._crop_boxes[layer].append(crop_boxes)
+            self._bits[layer].extend(bits)
+            self._rles[layer].extend(counts)
+
+    def add(self, image_id, scores, classes, boxes, masks):
+        """
+        Adds the predictions of one image, see prepare.
+        """
+        self.add_prepared(self.prepare(image_id, scores, classes, boxes, masks))
+
+    def add_instances(self, image_id, instances):
+        """
+        Adds a detectron2 Instances (scores, pred_classes, pred_boxes, pred_masks).
+        """
+        self.add_prepared(self.prepare_item(image_id, instances))
+
+    def close(self, meta=None):
+        arrays = {
+            "image_offsets": np.asarray(self._image_offsets, dtype=np.int64),
+            "scores": np.concatenate(self._scores) if self._scores else np.zeros(0, dtype=np.float32),
+            "classes": np.concatenate(self._classes) if self._classes else np.zeros(0, dtype=np.int16),
+            "boxes": np.concatenate(self._boxes) if self._boxes else np.zeros((0, 4), dtype=np.float32),
+        }
+        for layer, (areas, counts, crop_boxes, bits) in enumerate(zip(self._areas, self._rles, self._crop_boxes,
+                                                                        self._bits)):
+            arrays["areas_{}".format(layer)] = np.concatenate(areas) if areas else np.zeros(0, dtype=np.int32)
+            arrays["rle_offsets_{}".format(layer)] = _offsets(counts)
+            arrays["rle_bytes_{}".format(layer)] = np.frombuffer(b"".join(counts), dtype=np.uint8)
+            arrays["crop_boxes_{}".format(layer)] = (np.concatenate(crop_boxes).astype(np.int32) if crop_boxes
+                                                     else np.zeros((0, 4), dtype=np.int32))
+            arrays["bit_offsets_{}".format(layer)] = _offsets(bits)
+            arrays["bits_{}".format(layer)] = np.concatenate(bits) if bits else np.zeros(0, dtype=np.uint8)
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(self.path)))
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, name + ".npy"), array)
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump(dict(meta or {}, image_ids=self._image_ids, image_sizes=self._image_sizes,
+                           mask_thresholds=self.mask_thresholds), f)
+        try:
+            os.rename(tmp, self.path)
+        except OSError:
+            # 其他进程已经先写好了
+            shutil.rmtree(tmp, ignore_errors=True)
+        return PredictionCache(self.path)
+
+
+class PredictionCache:
+    """
+    Read-only, memory-mapped raw predictions of one (checkpoint, dataset, inference config).
+    Instances of image k are image_offsets[k]:image_offsets[k + 1], sorted as the model returned them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        self.image_ids = self.meta["image_ids"]
+        self.image_sizes = [tuple(size) for size in self.meta["image_sizes"]]
+        self.mask_thresholds = self.meta["mask_thresholds"]
+        self._index = {image_id: k for k, image_id in enumerate(self.image_ids)}
+        load = lambda name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+        self.image_offsets = load("image_offsets")
+        self.scores = load("scores")
+        self.classes = load("classes")
+        self.boxes = load("boxes")
+        n_layers = 1 if self.mask_thresholds is None else len(self.mask_thresholds)
+        self.areas = [load("areas_{}".format(layer)) for layer in range(n_layers)]
+        self.rle_offsets = [load("rle_offsets_{}".format(layer)) for layer in range(n_layers)]
+        self.rle_bytes = [load("rle_bytes_{}".format(layer)) for layer in range(n_layers)]
+        self.crop_boxes = [load("crop_boxes_{}".format(layer)) for layer in range(n_layers)]
+        self.bit_offsets = [load("bit_offsets_{}".format(layer)) for layer in range(n_layers)]
+        self.bits = [load("bits_{}".format(layer)) for layer in range(n_layers)]
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def __contains__(self, image_id):
+        return image_id in self._index
+
+    def get(self, image_id, layer=0):
+        """
+        Args:
+            image_id: id given to PredictionWriter.add.
+            layer (int): index into mask_thresholds when the masks were stored at several thresholds.
+
+        Returns:
+            dict with numpy arrays "scores", "classes", "boxes", "areas" and the list "rles" (compressed COCO RLEs).
+        """
+        k = self._index[image_id]
+        start, end = int(self.image_offsets[k]), int(self.image_offsets[k + 1])
+        size = list(self.image_sizes[k])
+        offsets = self.rle_offsets[layer][start:end + 1]
+        blob = self.rle_bytes[layer]
+        return {
+            "scores": np.asarray(self.scores[start:end]),
+            "classes": np.asarray(self.classes[start:end]),
+            "boxes": np.asarray(self.boxes[start:end]),
+            "areas": np.asarray(self.areas[layer][start:end]),
+            "rles": [{"size": size, "counts": blob[offsets[i]:offsets[i + 1]].tobytes()} for i in range(end - start)],
+        }
+
+    def crops(self, image_id, keep=None, layer=0):
+        """
+        InstanceCrops of the (kept) predictions of one image, ready for sparse_mask_iou, without decoding any RLE.
+
+        Args:
+            keep (np array [N], optional): bool mask or indices of the predictions to keep.
+        """
+        k = self._index[image_id]
+        start, end = int(self.image_offsets[k]), int(self.image_offsets[k + 1])
+        index = np.arange(start, end)
+        if keep is not None:
+            index = index[keep]
+        boxes = np.asarray(self.crop_boxes[layer][index], dtype=np.int64).reshape(-1, 4)
+        bit_offsets, bits = self.bit_offsets[layer], self.bits[layer]
+        crops = []
+        for i, (x0, y0, x1, y1) in zip(index, boxes):
+            h, w = y1 - y0, x1 - x0
+            crops.append(np.unpackbits(bits[bit_offsets[i]:bit_offsets[i + 1]], count=h * w).reshape(h, w).astype(bool))
+        return InstanceCrops(boxes, crops, np.asarray(self.areas[layer][index]), self.image_sizes[k])
+
+    @classmethod
+    def load_or_predict(cls, cache_dir, checkpoint, dataset, inference_cfg, predict, mask_thresholds=None, num_workers=0):
+        """
+        Opens the cache of (checkpoint, dataset, inference_cfg), running the model only on a miss.
+
+        Args:
+            cache_dir (str): root directory of all prediction caches.
+            checkpoint, dataset, inference_cfg: see cache_key.
+            predict (callable): returns an iterable of (image_id, scores, classes, boxes, masks), or of
+                (image_id, instances) for detectron2. Only called when the cache does not exist.
+            mask_thresholds (list of float, optional): see PredictionWriter.
+            num_workers (int): threads converting the predictions (PredictionWriter.prepare) while predict()
+                produces the next ones, 0 converts them in the calling thread.
+        """
+        path = os.path.join(cache_dir, cache_key(checkpoint, dataset, inference_cfg, mask_thresholds))
+        if os.path.exists(os.path.join(path, "meta.json")):
+            print("Replay predictions from {}".format(path))
+            return cls(path)
+        writer = PredictionWriter(path, mask_thresholds=mask_thresholds)
+        # 结果按 predict() 的顺序返回, 在途的图片数有上限
+        for prepared in ScorePool(num_workers, pool_type='thread', chunk_size=1).imap(writer.prepare_item, predict()):
+            writer.add_prepared(prepared)
+        return writer.close(meta={"checkpoint": os.path.abspath(checkpoint), "dataset": dataset})
+
+
+###########################################################################################################################################################
+# 基准测试: 回放缓存与每次重新编码 / 裁剪预测 mask 对比 (模型推理本身的耗时不计入)  python -m toolbox.predict_box.prediction_cache
+def benchmark(n_images=20, n_preds=400, seed=3407):
+    import time
+    from toolbox.metric_box.sparse_iou import _random_cells
+
+    tmp = tempfile.mkdtemp()
+    checkpoint = os.path.join(tmp, "model.pth")
+    with open(checkpoint, "wb") as f:
+        f.write(os.urandom(1 << 20))
+    rng = np.random.RandomState(seed)
+    outputs = []
+    for k in range(n_images):
+        masks = _random_cells(n_preds, seed=seed + k)
+        outputs.append(("img{}".format(k), rng.rand(n_preds).astype(np.float32), rng.randint(0, 3, n_preds),
+                        np.zeros((n_preds, 4), dtype=np.float32), masks))
+
+    start = time.perf_counter()
+    legacy = [InstanceCrops.from_dense(masks[scores >= 0.5]) for _, scores, _, _, masks in outputs]
+    t_legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    PredictionCache.load_or_predict(tmp, checkpoint, "val_fold1", "cfg", lambda: outputs)
+    t_build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cache = PredictionCache.load_or_predict(tmp, checkpoint, "val_fold1", "cfg", None)
+    replay = [cache.crops(image_id, keep=cache.get(image_id)["scores"] >= 0.5) for image_id in cache.image_ids]
+    t_replay = time.perf_counter() - start
+
+    for a, b in zip(legacy, replay):
+        assert np.array_equal(a.areas, b.areas)
+        assert all(np.array_equal(x, y) for x, y in zip(a.crops, b.crops))
+
+    # 同一 checkpoint / 数据集 / cfg 的二值缓存与软 mask 缓存不能共用一个目录
+    thresholds = [0.25, 0.5]
+    assert cache_key(checkpoint, "val_fold1", "cfg") != cache_key(checkpoint, "val_fold1", "cfg", thresholds)
+    assert cache_key(checkpoint, "val_fold1", "cfg", thresholds) != cache_key(checkpoint, "val_fold1", "cfg", [0.5])
+    soft = [(image_id, scores, classes, boxes, masks[:50] * np.float32(0.4)) for image_id, scores, classes, boxes, masks in outputs[:2]]
+    soft_cache = PredictionCache.load_or_predict(tmp, checkpoint, "val_fold1", "cfg", lambda: soft, mask_thresholds=thresholds)
+    assert soft_cache.path != cache.path and soft_cache.mask_thresholds == thresholds
+    assert soft_cache.areas[0].sum() > 0 and soft_cache.areas[1].sum() == 0
+    assert PredictionCache.load_or_predict(tmp, checkpoint, "val_fold1", "cfg", None).mask_thresholds is None
+    shutil.rmtree(tmp, ignore_errors=True)
+    print("{} images x {} predictions".format(n_images, n_preds))
+    print("crop dense predictions : {:8.2f} ms".format(t_legacy * 1e3))
+    print("write cache (once)     : {:8.2f} ms".format(t_build * 1e3))
+    print("replay from cache      : {:8.2f} ms".format(t_replay * 1e3))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-#
+# -------------------------------------------------------------------------------
+# Name:         submission_writer
+# Description:  流式生成 Kaggle 的 submission.csv
+#               提交 notebook 先把每张测试图的稠密 mask 全部留在列表里, 再用 used 图或 remove_overlapping_pixels 逐个去重叠,
+#               每个 mask 单独 rle_encode, 最后整体构造 DataFrame 写出, 内存随测试集大小增长。
+#               这里每张图的预测在 mask 所在的设备上过滤、二值化后立即转成 InstanceRuns (只拷回前景下标),
+#               去重叠 + MIN_PIXELS + Kaggle RLE 编码交给 ScorePool 的 worker, 结果按图片顺序逐行追加写入 csv,
+#               同时在处理的图片数量由 max_pending 限定, 与测试集大小无关
+# Author:       Administrator
+# Date:         2021/12/31
+# -------------------------------------------------------------------------------
+import csv
+import os
+import time
+
+import numpy as np
+
+from toolbox.metric_box.parallel_score import ScorePool
+from toolbox.predict_box.prediction_cache import _to_numpy
+from toolbox.rle_box.rle_ops import InstanceRuns
+
+
+def image_rows(image_id, runs, min_pixels):
+    """
+    Overlap removal and encoding of one image, module level so it can be sent to a process pool.
+
+    Args:
+        image_id (str): id column of the submission.
+        runs (InstanceRuns): binary masks of the image in the order of priority, pixels numbered row by row.
+        min_pixels (int): instances left with fewer pixels after the overlap removal are dropped.
+
+    Returns:
+        list of tuple: (image_id, Kaggle RLE) rows, a single row with an empty RLE when nothing is left.
+    """
+    runs = runs.remove_overlaps(min_pixels)
+    rles = runs.select(runs.n_runs > 0).to_kaggle()
+    if len(rles) == 0:
+        return [(image_id, "")]
+    return [(image_id, rle) for rle in rles]
+
+
+class SubmissionWriter:
+    """
+    Streams per-image predictions into a submission csv (id, predicted).
+
+    As in the submission notebooks the class of an image is the majority class of its predictions,
+    the instances with score >= score_thresholds[class] are kept, earlier (higher score) instances win
+    the overlapping pixels and the ones left with fewer than min_pixels[class] pixels are dropped.
+
+    Args:
+        path (str): csv to write, e.g. "submission.csv".
+        score_thresholds (list of float): indexed by class.
+        min_pixels (list of int): indexed by class.
+        mask_threshold (float): binarization of soft masks, binary masks are used as they are.
+        num_workers (int), pool_type (str), chunk_size (int), max_pending (int): see ScorePool.
+            Images prepared but not yet written are bounded by chunk_size * max_pending.
+    """
+
+    def __init__(self, path, score_thresholds, min_pixels, mask_threshold=0.5,
+                 num_workers=0, pool_type='process', chunk_size=2, max_pending=None):
+        self.path = path
+        self.score_thresholds = list(score_thresholds)
+        self.min_pixels = list(min_pixels)
+        self.mask_threshold = mask_threshold
+        self.pool = ScorePool(num_workers, pool_type=pool_type, chunk_size=chunk_size, max_pending=max_pending)
+
+    def prepare(self, image_id, scores, classes, masks):
+        """
+        Filters and binarizes the masks of one image on their device, only the foreground indices are copied back.
+
+        Args:
+            scores (array [N]), classes (array [N]), masks (array [N x H x W]): numpy arrays or torch tensors.
+
+        Returns:
+            tuple: arguments of image_rows.
+        """
+        if hasattr(masks, "tensor"):
+            masks = masks.tensor
+        scores, classes = _to_numpy(scores), _to_numpy(classes).astype(np.int64)
+        if len(classes) == 0:
+            return image_id, InstanceRuns.from_dense(np.zeros((0,) + tuple(masks.shape[1:]), dtype=bool), order='C'), 0
+        pred_class = int(np.bincount(classes).argmax())
+        # 按 score 从高到低, 重叠的像素归 score 高的实例
+        keep = np.flatnonzero(scores >= self.score_thresholds[pred_class])
+        keep = keep[np.argsort(-scores[keep], kind='stable')]
+        if hasattr(masks, "cpu"):
+            import torch
+            masks = masks[torch.as_tensor(keep, device=masks.device)]
+            binary = masks if masks.dtype == torch.bool else masks > self.mask_threshold
+        else:
+            masks = np.asarray(masks)[keep]
+            binary = masks if masks.dtype == bool else masks > self.mask_threshold
+        return image_id, InstanceRuns.from_dense(binary, order='C'), self.min_pixels[pred_class]
+
+    def _jobs(self, predictions):
+        for item in predictions:
+            if len(item) == 2:
+                image_id, instances = item
+                yield self.prepare(image_id, instances.scores, instances.pred_classes, instances.pred_masks)
+            else:
+                image_id, scores, classes, _, masks = item
+                yield self.prepare(image_id, scores, classes, masks)
+
+    def write(self, predictions):
+        """
+        Args:
+            predictions (iterable): (image_id, scores, classes, boxes, masks) or, for detectron2, (image_id, instances)
+                of every test image, e.g. a generator running the model image by image (same items as
+                PredictionCache.load_or_predict). It is consumed lazily.
+
+        Returns:
+            int: number of rows written.
+        """
+        n_rows = 0
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["id", "predicted"])
+            for rows in self.pool.imap(image_rows, self._jobs(predictions)):
+                writer.writerows(rows)
+                n_rows += len(rows)
+                f.flush()
+        # 写完整之后再替换, 中断时不会留下半个 submission.csv
+        os.replace(tmp, self.path)
+        return n_rows
+
+
+###########################################################################################################################################################
+# 基准测试: 与提交 notebook 的稠密 used 图 + 逐个 rle_encode + DataFrame 对比  python -m toolbox.predict_box.submission_writer
+def _legacy_rle_encode(img):
+    pixels = img.flatten()
+    pixels = np.concatenate([[0], pixels, [0]])
+    runs = np.where(pixels[1:] != pixels[:-1])[0] + 1
+    runs[1::2] -= runs[::2]
+    return ' '.join(str(x) for x in runs)
+
+
+def _legacy_submission(outputs, score_thresholds, min_pixels, path):
+    import pandas as pd
+
+    ids, masks = [], []
+    for image_id, scores, classes, _, pred_masks in outputs:
+        pred_class = int(np.bincount(classes).argmax())
+        order = np.argsort(-scores, kind='stable')
+        pred_masks = pred_masks[order][scores[order] >= score_thresholds[pred_class]]
+        used = np.zeros(pred_masks.shape[1:], dtype=int)
+        res = []
+        for mask in pred_masks:
+            mask = mask * (1 - used)
+            if mask.sum() >= min_pixels[pred_class]:
+                used += mask
+                res.append(_legacy_rle_encode(mask))
+        if len(res) == 0:
+            res = [""]
+        for rle in res:
+            ids.append(image_id)
+            masks.append(rle)
+    pd.DataFrame({"id": ids, "predicted": masks}).to_csv(path, index=False)
+
+
+def benchmark(n_images=8, n_preds=500, seed=3407):
+    import shutil
+    import tempfile
+
+    import pandas as pd
+
+    from toolbox.metric_box.sparse_iou import _random_cells
+
+    score_thresholds, min_pixels = [0.15, 0.30, 0.55], [60, 140, 75]
+    rng = np.random.RandomState(seed)
+    outputs = []
+    for k in range(n_images):
+        # 一半预测是另一半平移几个像素, 重叠很多
+        half = _random_cells(n_preds // 2, seed=seed + k)
+        outputs.append(("img{}".format(k), rng.rand(n_preds).astype(np.float32), np.full(n_preds, k % 3),
+                        np.zeros((n_preds, 4), dtype=np.float32), np.concatenate([half, np.roll(half, 3, axis=2)])))
+
+    tmp = tempfile.mkdtemp()
+    start = time.perf_counter()
+    _legacy_submission(outputs, score_thresholds, min_pixels, os.path.join(tmp, "legacy.csv"))
+    t_legacy = time.perf_counter() - start
+
+    results = {}
+    for num_workers in (0, 2):
+        start = time.perf_counter()
+        SubmissionWriter(os.path.join(tmp, "submission{}.csv".format(num_workers)), score_thresholds, min_pixels,
+                         num_workers=num_workers).write(iter(outputs))
+        results[num_workers] = time.perf_counter() - start
+
+    legacy = pd.read_csv(os.path.join(tmp, "legacy.csv"), keep_default_na=False)
+    for num_workers in results:
+        streamed = pd.read_csv(os.path.join(tmp, "submission{}.csv".format(num_workers)), keep_default_na=False)
+        assert legacy.equals(streamed)
+    shutil.rmtree(tmp, ignore_errors=True)
+    print("{} images x {} predictions, {} rows".format(n_images, n_preds, len(legacy)))
+    print("dense used map + rle_encode + DataFrame : {:8.2f} ms".format(t_legacy * 1e3))
+    for num_workers, t in results.items():
+        print("streaming writer, {} workers            : {:8.2f} ms  (x{:.1f})".format(num_workers, t * 1e3,
+                                                                                    t_legacy / t))
+
+
+if __name__ == '__main__':
+    benchmark()
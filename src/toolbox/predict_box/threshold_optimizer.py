@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-#
+# -------------------------------------------------------------------------------
+# Name:         threshold_optimizer
+# Description:  按类别联合搜索 SCORE_THRESHOLDS 与 MIN_PIXELS
+#               原来的阈值搜索脚本每张图推理一次再跑网格, 只输出原始的 threshold_search_fast_fold*.json,
+#               每个类别的阈值靠人工看表挑选, 然后在各个脚本里各写一份。
+#               这里直接读取 PredictionCache 中每个 fold 的原始预测, 每张图 (跨图片跨 fold 并行) 只算一次稀疏 IoU,
+#               之后所有网格都由 grid_counts 从同一个 IoU 矩阵得到; 先粗网格, 再在最优点附近逐轮细化,
+#               最后输出每个类别的最优阈值表
+# Author:       Administrator
+# Date:         2021/12/30
+# -------------------------------------------------------------------------------
+import time
+
+import numpy as np
+
+from toolbox.metric_box.competition_metric import grid_iou_map, iou_map, threshold_levels
+from toolbox.metric_box.gt_cache import GTCache
+from toolbox.metric_box.parallel_score import ScorePool
+from toolbox.metric_box.sparse_iou import sparse_mask_iou
+from toolbox.predict_box.prediction_cache import PredictionCache
+
+# 初始粗网格
+SCORE_GRID = np.arange(5, 100, 5) / 100
+AREA_GRID = np.arange(0, 310, 10)
+
+# 每个进程里打开过的缓存, 任务只传路径
+_opened = {}
+
+
+def _open(cls, path):
+    if (cls, path) not in _opened:
+        _opened[(cls, path)] = cls(path)
+    return _opened[(cls, path)]
+
+
+def image_ious(pred_path, gt_path, image_id):
+    """
+    Sparse IoU of one image at the loosest setting (every cached prediction kept).
+    Module level so it can be sent to a process pool.
+
+    Returns:
+        tuple: (pred_class, scores, areas, ious), pred_class is the majority class of the predictions
+            as in Detectron2_LocalCV_Submit.score_method1, None when the image has no prediction.
+    """
+    preds = _open(PredictionCache, pred_path)
+    targs = _open(GTCache, gt_path)
+    pred = preds.get(image_id)
+    if len(pred["classes"]) == 0:
+        return None, pred["scores"], pred["areas"], None
+    ious = sparse_mask_iou(preds.crops(image_id), targs.crops(image_id))
+    return int(np.bincount(pred["classes"]).argmax()), pred["scores"], pred["areas"], ious
+
+
+def _grid_total(images, score_grid, area_grid, strict):
+    total = np.zeros((len(score_grid), len(area_grid)))
+    for scores, areas, ious in images:
+        total += grid_iou_map(ious, threshold_levels(scores, score_grid), threshold_levels(areas, area_grid),
+                              grid_shape=(len(score_grid), len(area_grid)), strict=strict)
+    return total
+
+
+def _refine(grid, best, zoom, lower, upper, integer=False):
+    # 以最优点为中心, 范围为左右相邻格点, 步长缩小 zoom 倍
+    step = (grid[-1] - grid[0]) / max(len(grid) - 1, 1)
+    lo, hi = max(grid[best] - step, lower), min(grid[best] + step, upper)
+    if integer:
+        return np.unique(np.round(np.linspace(lo, hi, 2 * zoom + 1)).astype(np.int64))
+    return np.unique(np.round(np.linspace(lo, hi, 2 * zoom + 1), 4))
+
+
+def optimize_class(images, score_grid=SCORE_GRID, area_grid=AREA_GRID, rounds=2, zoom=4, strict=False):
+    """
+    Best (score threshold, min pixels) of the images of one class.
+
+    Args:
+        images (list of tuple): (scores, areas, ious) of every image, see image_ious.
+        score_grid, area_grid (np array): initial coarse grids.
+        rounds (int): refinements around the best cell, each one divides the steps by zoom.
+        zoom (int): refinement factor.
+        strict (bool): see competition_metric.precision_at.
+
+    Returns:
+        tuple: (score_threshold, min_pixels, mean score of the images)
+    """
+    score_grid = np.round(np.asarray(score_grid, dtype=np.float64), 4)
+    area_grid = np.asarray(area_grid, dtype=np.int64)
+    best = (float(score_grid[0]), int(area_grid[0]), -np.inf)
+    for r in range(rounds + 1):
+        total = _grid_total(images, score_grid, area_grid, strict)
+        # 并列时取最宽松的阈值
+        j, k = np.unravel_index(np.argmax(total), total.shape)
+        if total[j, k] > best[2]:
+            best = (float(score_grid[j]), int(area_grid[k]), float(total[j, k]))
+        score_grid = _refine(score_grid, j, zoom, 0.0, 1.0)
+        area_grid = _refine(area_grid, k, zoom, 0, np.inf, integer=True)
+    return best[0], best[1], best[2] / max(len(images), 1)
+
+
+def optimize_thresholds(folds, score_grid=SCORE_GRID, area_grid=AREA_GRID, rounds=2, zoom=4, strict=False,
+                        num_workers=0, pool_type='process', verbose=1):
+    """
+    Jointly searches the per-class score threshold and minimum mask area over the cached predictions of every fold.
+    The class of an image is the majority class of its predictions, so the classes can be searched independently.
+
+    Args:
+        folds (list of tuple): (PredictionCache or its path, GTCache or its path) of every fold.
+        num_workers (int), pool_type (str): see ScorePool, the IoUs of all images of all folds are computed in one pool.
+        verbose (int): print the table.
+        others: see optimize_class.
+
+    Returns:
+        dict: "SCORE_THRESHOLDS" and "MIN_PIXELS" lists indexed by class, "table" with one row per class
+            and "cv", the mean score over all images with the best thresholds.
+    """
+    jobs = []
+    for preds, targs in folds:
+        pred_path = preds.path if isinstance(preds, PredictionCache) else preds
+        gt_path = targs.path if isinstance(targs, GTCache) else targs
+        jobs.extend((pred_path, gt_path, image_id) for image_id in _open(PredictionCache, pred_path).image_ids)
+    results = ScorePool(num_workers, pool_type=pool_type, chunk_size=4).map(image_ious, jobs)
+
+    per_class = {}
+    for pred_class, scores, areas, ious in results:
+        if pred_class is not None:
+            per_class.setdefault(pred_class, []).append((scores, areas, ious))
+
+    n_classes = max(per_class) + 1 if per_class else 0
+    table, score_thresholds, min_pixels = [], [float(score_grid[0])] * n_classes, [int(area_grid[0])] * n_classes
+    total = 0.0
+    for c in sorted(per_class):
+        score_threshold, min_pixel, score = optimize_class(per_class[c], score_grid, area_grid, rounds, zoom, strict)
+        score_thresholds[c], min_pixels[c] = score_threshold, min_pixel
+        table.append({"class": c, "n_images": len(per_class[c]), "score_threshold": score_threshold,
+                      "min_pixels": min_pixel, "score": score})
+        total += score * len(per_class[c])
+    # 没有任何预测的图得分为 0, 只计入分母
+    cv = total / max(len(results), 1)
+
+    if verbose:
+        print("Class\tImages\tScore\tPixels\tmAP")
+        for row in table:
+            print("{}\t{}\t{:.4f}\t{}\t{:.4f}".format(row["class"], row["n_images"], row["score_threshold"],
+                                                      row["min_pixels"], row["score"]))
+        print("CV\t{}\t-\t-\t{:.4f}".format(len(results), cv))
+    return {"SCORE_THRESHOLDS": score_thresholds, "MIN_PIXELS": min_pixels, "table": table, "cv": cv}
+
+
+###########################################################################################################################################################
+# 基准测试: 与每个格点重新过滤 + 重新计算 IoU 的暴力网格对比  python -m toolbox.predict_box.threshold_optimizer
+def benchmark(n_folds=2, n_images=6, n_truths=200, n_preds=300, seed=3407):
+    import json
+    import os
+    import shutil
+    import tempfile
+
+    import pycocotools.mask as mask_util
+
+    from toolbox.metric_box.sparse_iou import InstanceCrops, _random_cells
+
+    tmp = tempfile.mkdtemp()
+    checkpoint = os.path.join(tmp, "model.pth")
+    with open(checkpoint, "wb") as f:
+        f.write(os.urandom(1 << 16))
+    rng = np.random.RandomState(seed)
+    folds, brute_jobs = [], []
+    for fold in range(n_folds):
+        images, annotations, outputs = [], [], []
+        for k in range(n_images):
+            image_id = fold * n_images + k
+            truths = _random_cells(n_truths, seed=seed + image_id)
+            images.append({"id": image_id, "height": truths.shape[1], "width": truths.shape[2]})
+            for mask in truths:
+                rle = mask_util.encode(np.asfortranarray(mask.astype(np.uint8)))
+                rle["counts"] = rle["counts"].decode("ascii")
+                annotations.append({"id": len(annotations), "image_id": image_id, "segmentation": rle,
+                                    "category_id": 1, "iscrowd": 0})
+            # 真实的预测 score 偏高, 误检 score 偏低
+            preds = np.concatenate([np.roll(truths, rng.randint(0, 4), axis=2),
+                                    _random_cells(n_preds - n_truths, seed=seed + 1000 + image_id)])
+            scores = np.r_[rng.uniform(0.3, 1.0, n_truths), rng.uniform(0.0, 0.6, n_preds - n_truths)]
+            classes = np.full(n_preds, image_id % 3)
+            outputs.append((image_id, scores.astype(np.float32), classes, np.zeros((n_preds, 4)), preds))
+            brute_jobs.append((image_id % 3, scores.astype(np.float32), preds.reshape(n_preds, -1).sum(axis=1),
+                               InstanceCrops.from_dense(preds), InstanceCrops.from_dense(truths)))
+        json_file = os.path.join(tmp, "val_fold{}.json".format(fold))
+        with open(json_file, "w") as f:
+            json.dump({"images": images, "annotations": annotations, "categories": [{"id": 1, "name": "cell"}]}, f)
+        preds = PredictionCache.load_or_predict(tmp, checkpoint, json_file, "cfg", lambda: outputs)
+        folds.append((preds, GTCache.load(json_file)))
+
+    start = time.perf_counter()
+    brute = {}
+    for c in range(3):
+        jobs = [job for job in brute_jobs if job[0] == c]
+        for s in SCORE_GRID:
+            for a in AREA_GRID:
+                total = 0.0
+                for _, scores, areas, pred_crops, targ_crops in jobs:
+                    keep = np.flatnonzero((scores >= np.float32(s)) & (areas >= a))
+                    if len(keep):
+                        kept = InstanceCrops(pred_crops.boxes[keep], [pred_crops.crops[i] for i in keep],
+                                             pred_crops.areas[keep], pred_crops.image_size)
+                        total += iou_map(sparse_mask_iou(kept, targ_crops))
+                brute[(c, s, a)] = total / len(jobs)
+    t_brute = time.perf_counter() - start
+
+    start = time.perf_counter()
+    coarse = optimize_thresholds(folds, rounds=0, verbose=0)
+    t_coarse = time.perf_counter() - start
+
+    start = time.perf_counter()
+    refined = optimize_thresholds(folds, rounds=2)
+    t_refined = time.perf_counter() - start
+
+    for row in coarse["table"]:
+        best = max(v for (c, _, _), v in brute.items() if c == row["class"])
+        assert np.isclose(row["score"], best)
+        assert np.isclose(brute[(row["class"], row["score_threshold"], row["min_pixels"])], best)
+    assert all(r["score"] >= c["score"] - 1e-12 for r, c in zip(refined["table"], coarse["table"]))
+    shutil.rmtree(tmp, ignore_errors=True)
+    print("{} folds x {} images, {} grid cells per class".format(n_folds, n_images, len(SCORE_GRID) * len(AREA_GRID)))
+    print("filter + IoU per grid cell     : {:8.2f} ms".format(t_brute * 1e3))
+    print("one IoU per image, coarse grid : {:8.2f} ms  (x{:.1f})".format(t_coarse * 1e3, t_brute / t_coarse))
+    print("coarse + 2 refinements         : {:8.2f} ms".format(t_refined * 1e3))
+
+
+if __name__ == '__main__':
+    benchmark()
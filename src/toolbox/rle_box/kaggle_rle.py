@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-#
+# -------------------------------------------------------------------------------
+# Name:         kaggle_rle
+# Description:  Kaggle 格式 RLE ("start length start length ...", start 从 1 开始) 的批量编解码
+#               训练脚本里的 rle_decode / pdata.py 的 decode_rle_mask 每个标注单独解析,
+#               再用 Python 循环一段一段地填; CellDataset.__getitem__ 每张图要调用几百次 (shsy5y 平均约 337 个, 最多 790 个)。
+#               这里一次解析一张图的全部 RLE 字符串, 用 np.repeat + arange 得到所有前景像素的下标后一次写入,
+#               可以返回 (N, H, W) 的 mask 堆叠, 或者 uint16 的标签图, bbox 也直接由像素下标得到。
+#               编码: rle_encoding 逐个前景像素循环, rle_encode 逐个 mask 展平拼接; 这里对 (N, H, W) 整体做一次差分,
+#               在 mask 所在的设备上找出全部游程边界, 只把边界下标拷回 CPU
+# Author:       Administrator
+# Date:         2021/12/30
+# -------------------------------------------------------------------------------
+import time
+
+import numpy as np
+
+
+def parse_kaggle_rles(rles):
+    """
+    Parses many Kaggle RLE strings at once.
+
+    Args:
+        rles (list of str): "start length ..." strings, starts are 1-based. Empty strings or NaN give no run.
+
+    Returns:
+        tuple: starts (0-based, int64 [R]), lengths (int64 [R]), n_runs (int64 [N]) the runs of every string.
+    """
+    runs = [np.fromstring(rle, dtype=np.int64, sep=' ') if isinstance(rle, str) else np.zeros(0, dtype=np.int64)
+            for rle in rles]
+    n_runs = np.asarray([len(r) // 2 for r in runs], dtype=np.int64)
+    flat = np.concatenate(runs) if runs else np.zeros(0, dtype=np.int64)
+    return flat[0::2] - 1, flat[1::2], n_runs
+
+
+def format_kaggle_rles(starts, lengths, n_runs):
+    """
+    Inverse of parse_kaggle_rles: formats the runs of many instances at once.
+
+    Args:
+        starts (int [R]): 0-based run starts, grouped by instance.
+        lengths (int [R]): run lengths.
+        n_runs (int [N]): number of runs of every instance.
+
+    Returns:
+        list of str: N Kaggle RLE strings ("" for an instance without runs).
+    """
+    tokens = np.stack([np.asarray(starts) + 1, lengths], axis=1).ravel().astype(str).tolist()
+    offsets = np.zeros(len(n_runs) + 1, dtype=np.int64)
+    np.cumsum(np.asarray(n_runs) * 2, out=offsets[1:])
+    return [' '.join(tokens[a:b]) for a, b in zip(offsets[:-1], offsets[1:])]
+
+
+def _pixels(starts, lengths, n_runs):
+    # 所有前景像素的 (实例编号, 展平后的像素下标), 按实例顺序排列
+    total = int(lengths.sum())
+    run_first = np.cumsum(lengths) - lengths
+    pixels = np.repeat(starts - run_first, lengths) + np.arange(total)
+    ids = np.repeat(np.repeat(np.arange(len(n_runs)), n_runs), lengths)
+    return ids, pixels
+
+
+def _to_c_order(pixels, shape, order):
+    # Fortran 顺序 (按列) 的下标转成按行的下标
+    if order == 'F':
+        height, width = shape
+        return (pixels % height) * width + pixels // height
+    return pixels
+
+
+def decode_kaggle_rles(rles, shape, order='C', dtype=np.uint8, return_boxes=False):
+    """
+    Decodes every RLE of an image at once.
+
+    Args:
+        rles (list of str): Kaggle RLE strings.
+        shape (tuple): (height, width).
+        order (str): 'C' when the pixels are numbered row by row (this competition), 'F' column by column.
+        dtype: dtype of the masks.
+        return_boxes (bool): also return the [xmin, ymin, xmax, ymax] box (inclusive) of every mask.
+
+    Returns:
+        np array [N x H x W] (and np array [N x 4] when return_boxes).
+    """
+    height, width = shape
+    starts, lengths, n_runs = parse_kaggle_rles(rles)
+    ids, pixels = _pixels(starts, lengths, n_runs)
+    pixels = _to_c_order(pixels, shape, order)
+    masks = np.zeros((len(n_runs), height * width), dtype=dtype)
+    masks[ids, pixels] = 1
+    masks = masks.reshape(len(n_runs), height, width)
+    if return_boxes:
+        return masks, _boxes(ids, pixels, len(n_runs), width)
+    return masks
+
+
+def decode_kaggle_labels(rles, shape, order='C', dtype=np.uint16):
+    """
+    Decodes every RLE of an image into one label image, 0 is background and instance i is i + 1.
+    Where instances overlap the later one wins, like combine_masks.
+
+    Returns:
+        np array [H x W]
+    """
+    height, width = shape
+    assert len(rles) <= np.iinfo(dtype).max, "too many instances for {}".format(np.dtype(dtype).name)
+    starts, lengths, n_runs = parse_kaggle_rles(rles)
+    ids, pixels = _pixels(starts, lengths, n_runs)
+    labels = np.zeros(height * width, dtype=dtype)
+    np.maximum.at(labels, _to_c_order(pixels, shape, order), (ids + 1).astype(dtype))
+    return labels.reshape(height, width)
+
+
+def _boxes(ids, pixels, n, width):
+    boxes = np.zeros((n, 4), dtype=np.int64)
+    if len(pixels) == 0:
+        return boxes
+    ys, xs = pixels // width, pixels % width
+    # 像素已按实例分组, 每组的起点做 reduceat
+    present = np.flatnonzero(np.bincount(ids, minlength=n))
+    first = np.searchsorted(ids, present)
+    boxes[present, 0] = np.minimum.reduceat(xs, first)
+    boxes[present, 1] = np.minimum.reduceat(ys, first)
+    boxes[present, 2] = np.maximum.reduceat(xs, first)
+    boxes[present, 3] = np.maximum.reduceat(ys, first)
+    return boxes
+
+
+def _foreground(masks, order):
+    # 全部前景像素在 (N, H*W) 展平后的下标 (按实例、再按 order 顺序排列), 只有这些下标会拷回 CPU
+    n, height, width = masks.shape
+    if hasattr(masks, "cpu") and masks.is_cuda:
+        fg = masks.reshape(-1).nonzero().reshape(-1).cpu().numpy()
+    else:
+        # CPU 上 torch.nonzero 比 numpy 慢数倍
+        masks = masks.numpy() if hasattr(masks, "cpu") else np.asarray(masks)
+        fg = np.flatnonzero(masks)
+    if order == 'F':
+        inst, pixel = fg // (height * width), fg % (height * width)
+        fg = np.sort(inst * (height * width) + (pixel % width) * height + pixel // width)
+    return fg
+
+
+def encode_kaggle_rles(masks, order='C'):
+    """
+    Encodes every mask at once, the work is proportional to the foreground pixels and not to N x H x W.
+
+    Args:
+        masks (np array or torch tensor [N x H x W]): binary masks, torch tensors may stay on the model device.
+        order (str): 'C' numbers the pixels row by row (this competition), 'F' column by column.
+
+    Returns:
+        list of str: N Kaggle RLE strings ("" for an empty mask).
+    """
+    n, height, width = masks.shape
+    size = height * width
+    fg = _foreground(masks, order)
+    inst = fg // size
+    # 下标不连续或者换了实例的位置是一个新游程的起点
+    first = np.ones(len(fg), dtype=bool)
+    first[1:] = (np.diff(fg) != 1) | (inst[1:] != inst[:-1])
+    run_first = np.flatnonzero(first)
+    lengths = np.diff(np.append(run_first, len(fg)))
+    return format_kaggle_rles(fg[run_first] - inst[run_first] * size, lengths, np.bincount(inst[run_first], minlength=n))
+
+
+###########################################################################################################################################################
+# 基准测试: 与训练脚本中逐个标注解码 + get_box 对比  python -m toolbox.rle_box.kaggle_rle
+def _legacy_decode(mask_rle, shape):
+    s = mask_rle.split()
+    starts = list(map(lambda x: int(x) - 1, s[0::2]))
+    lengths = list(map(int, s[1::2]))
+    ends = [x + y for x, y in zip(starts, lengths)]
+    img = np.zeros(shape[0] * shape[1], dtype=np.float32)
+    for start, end in zip(starts, ends):
+        img[start: end] = 1
+    return img.reshape(shape)
+
+
+def _legacy_box(a_mask):
+    pos = np.where(a_mask)
+    return [np.min(pos[1]), np.min(pos[0]), np.max(pos[1]), np.max(pos[0])]
+
+
+def _encode(mask):
+    pixels = np.concatenate([[0], mask.ravel(), [0]])
+    runs = np.where(pixels[1:] != pixels[:-1])[0] + 1
+    runs[1::2] -= runs[::2]
+    return ' '.join(str(x) for x in runs)
+
+
+def benchmark(seed=3407, repeat=3):
+    from toolbox.metric_box.sparse_iou import _random_cells
+
+    # shsy5y 平均约 337 个实例, 最多 790 个
+    for n in (337, 790):
+        truths = _random_cells(n, seed=seed)
+        rles = [_encode(mask) for mask in truths]
+        shape = truths.shape[1:]
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            legacy = np.zeros((n,) + shape, dtype=np.uint8)
+            legacy_boxes = []
+            for i, rle in enumerate(rles):
+                a_mask = _legacy_decode(rle, shape) > 0
+                legacy[i] = a_mask
+                legacy_boxes.append(_legacy_box(a_mask))
+        t_legacy = (time.perf_counter() - start) / repeat
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            masks, boxes = decode_kaggle_rles(rles, shape, return_boxes=True)
+        t_batch = (time.perf_counter() - start) / repeat
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            labels = decode_kaggle_labels(rles, shape)
+        t_labels = (time.perf_counter() - start) / repeat
+
+        assert np.array_equal(legacy, masks) and np.array_equal(np.asarray(legacy_boxes), boxes)
+        combined = np.zeros(shape, dtype=np.uint16)
+        for m, mask in enumerate(truths, 1):
+            combined[mask] = m
+        assert np.array_equal(combined, labels)
+        f_rles = [_encode(mask.T) for mask in truths]
+        assert np.array_equal(decode_kaggle_rles(f_rles, shape, order='F'), masks)
+        print("{} instances".format(n))
+        print("per-annotation decode + get_box : {:8.2f} ms".format(t_legacy * 1e3))
+        print("batched decode + boxes          : {:8.2f} ms  (x{:.1f})".format(t_batch * 1e3, t_legacy / t_batch))
+        print("batched uint16 label image      : {:8.2f} ms  (x{:.1f})".format(t_labels * 1e3, t_legacy / t_labels))
+
+
+# 基准测试: 与训练脚本中逐个前景像素循环的 rle_encoding 对比
+def _legacy_encoding(x):
+    dots = np.where(x.flatten() == 1)[0]
+    run_lengths = []
+    prev = -2
+    for b in dots:
+        if (b > prev + 1): run_lengths.extend((b + 1, 0))
+        run_lengths[-1] += 1
+        prev = b
+    return ' '.join(map(str, run_lengths))
+
+
+def benchmark_encode(seed=3407, repeat=3):
+    import torch
+    from toolbox.metric_box.sparse_iou import _random_cells
+
+    for n in (337, 790):
+        masks = _random_cells(n, seed=seed)
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            legacy = [_legacy_encoding(mask.astype(np.uint8)) for mask in masks]
+        t_legacy = (time.perf_counter() - start) / repeat
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            per_mask = [_encode(mask.astype(np.uint8)) for mask in masks]
+        t_per_mask = (time.perf_counter() - start) / repeat
+
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        tensor = torch.as_tensor(masks, device=device)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            batched = encode_kaggle_rles(tensor)
+        t_batch = (time.perf_counter() - start) / repeat
+
+        assert legacy == per_mask == batched
+        assert encode_kaggle_rles(masks, order='F') == [_encode(mask.T.astype(np.uint8)) for mask in masks]
+        assert np.array_equal(decode_kaggle_rles(batched, masks.shape[1:]), masks)
+        print("{} masks ({})".format(n, device))
+        print("per-pixel rle_encoding   : {:8.2f} ms".format(t_legacy * 1e3))
+        print("per-mask rle_encode      : {:8.2f} ms".format(t_per_mask * 1e3))
+        print("batched encode           : {:8.2f} ms  (x{:.1f})".format(t_batch * 1e3, t_legacy / t_batch))
+
+
+if __name__ == '__main__':
+    benchmark()
+    benchmark_encode()
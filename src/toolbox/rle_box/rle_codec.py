@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-#
+# -------------------------------------------------------------------------------
+# Name:         rle_codec
+# Description:  统一的 RLE 编解码层
+#               项目里同时存在三种 RLE: Kaggle 的 "start length" 字符串 (按行, start 从 1 开始),
+#               COCO 未压缩 RLE (bie 的 json, counts 为 list, 按列) 以及 COCO 压缩 RLE (counts 为字符串)。
+#               test31 记录过压缩与未压缩的标注给出不同的分数, test.py 中的 SplitBie 也只是为了对比二者。
+#               这里所有格式之间的转换都在游程上完成, 不经过整图 mask (代价与游程数 / 前景像素数成正比);
+#               verify_json 并行地对整个标注文件做往返校验, compare_json 逐个实例比较两份标注文件的 mask 是否一致
+# Author:       Administrator
+# Date:         2021/12/31
+# -------------------------------------------------------------------------------
+import json
+import time
+
+import numpy as np
+import pycocotools.mask as mask_util
+
+from toolbox.metric_box.parallel_score import ScorePool
+from toolbox.rle_box.kaggle_rle import decode_kaggle_labels, decode_kaggle_rles, encode_kaggle_rles, parse_kaggle_rles
+
+# 压缩 RLE 每个字符携带 5 bit, 64 位整数最多 13 个字符
+_MAX_CHARS = 13
+
+
+###########################################################################################################################################################
+# 压缩 RLE 字符串 <-> counts, 与 pycocotools 的 rleToString / rleFrString 逐字节一致
+def string_to_counts(counts):
+    """
+    Decodes the counts string of a compressed COCO RLE.
+
+    Args:
+        counts (bytes or str): e.g. rle["counts"] of mask_util.encode.
+
+    Returns:
+        np array int64: the uncompressed counts (alternating background / foreground, column major).
+    """
+    if isinstance(counts, str):
+        counts = counts.encode("ascii")
+    v = np.frombuffer(counts, dtype=np.uint8).astype(np.int64) - 48
+    if len(v) == 0:
+        return np.zeros(0, dtype=np.int64)
+    last = (v & 0x20) == 0
+    first = np.r_[True, last[:-1]]
+    group_start = np.flatnonzero(first)
+    shift = 5 * (np.arange(len(v)) - np.repeat(group_start, np.diff(np.r_[group_start, len(v)])))
+    x = np.add.reduceat((v & 0x1f) << shift, group_start)
+    # 最后一个字符的 0x10 位为符号位
+    negative = (v[last] & 0x10) != 0
+    x[negative] |= -1 << (shift[last][negative] + 5)
+    # 第 3 个以后的值是与前面第 2 个值的差
+    x[1::2] = np.cumsum(x[1::2])
+    x[2::2] = np.cumsum(x[2::2])
+    return x
+
+
+def counts_to_string(counts):
+    """
+    Encodes uncompressed COCO counts into the compressed string (bytes), inverse of string_to_counts.
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    x = counts.copy()
+    x[3:] -= counts[1:-2]
+    chars = np.zeros((len(x), _MAX_CHARS), dtype=np.uint8)
+    alive = np.zeros((len(x), _MAX_CHARS), dtype=bool)
+    more = np.ones(len(x), dtype=bool)
+    for k in range(_MAX_CHARS):
+        alive[:, k] = more
+        c = x & 0x1f
+        x = x >> 5
+        next_more = np.where((c & 0x10) != 0, x != -1, x != 0)
+        chars[:, k] = (c | (next_more << 5)) + 48
+        more = more & next_more
+        if not more.any():
+            break
+    return chars[alive].tobytes()
+
+
+###########################################################################################################################################################
+# counts <-> 游程 (start 从 0 开始, length), 游程是所有格式之间的公共表示
+def counts_to_runs(counts):
+    counts = np.asarray(counts, dtype=np.int64)
+    ends = np.cumsum(counts)
+    lengths = counts[1::2]
+    starts = ends[0::2][:len(lengths)]
+    keep = lengths > 0
+    return starts[keep], lengths[keep]
+
+
+def runs_to_counts(starts, lengths, size):
+    """
+    Uncompressed counts of runs (sorted, non-overlapping), adjacent runs are merged like mask_util.encode does.
+    """
+    starts, lengths = _merge_runs(starts, lengths)
+    ends = starts + lengths
+    zeros = starts - np.r_[0, ends[:-1]]
+    counts = np.stack([zeros, lengths], axis=1).ravel()
+    tail = size - (ends[-1] if len(ends) else 0)
+    return np.r_[counts, tail] if tail > 0 or len(counts) == 0 else counts
+
+
+def _merge_runs(starts, lengths):
+    starts, lengths = np.asarray(starts, dtype=np.int64), np.asarray(lengths, dtype=np.int64)
+    keep = lengths > 0
+    starts, lengths = starts[keep], lengths[keep]
+    if len(starts) < 2:
+        return starts, lengths
+    ends = starts + lengths
+    first = np.r_[True, starts[1:] != ends[:-1]]
+    group_start = np.flatnonzero(first)
+    return starts[group_start], np.add.reduceat(lengths, group_start)
+
+
+def reorder_runs(starts, lengths, shape, src, dst):
+    """
+    Converts runs numbered row by row ('C', Kaggle) to column by column ('F', COCO) or back,
+    through the foreground pixel indices only.
+    """
+    if src == dst:
+        return _merge_runs(starts, lengths)
+    height, width = shape
+    starts, lengths = np.asarray(starts, dtype=np.int64), np.asarray(lengths, dtype=np.int64)
+    total = int(lengths.sum())
+    pixels = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(total)
+    if src == 'C':
+        pixels = np.sort((pixels % width) * height + pixels // width)
+    else:
+        pixels = np.sort((pixels % height) * width + pixels // height)
+    if total == 0:
+        return pixels, pixels
+    first = np.flatnonzero(np.r_[True, np.diff(pixels) != 1])
+    return pixels[first], np.diff(np.r_[first, total])
+
+
+###########################################################################################################################################################
+# 对外接口
+def _size(rle):
+    return [int(x) for x in rle["size"]]
+
+
+def coco_counts(rle):
+    """
+    Uncompressed counts of a COCO RLE, compressed or not.
+    """
+    counts = rle["counts"]
+    if isinstance(counts, list):
+        return np.asarray(counts, dtype=np.int64)
+    return string_to_counts(counts)
+
+
+def compress(rle):
+    """
+    COCO RLE (compressed or uncompressed) -> compressed RLE with bytes counts, same as mask_util.frPyObjects.
+    """
+    if not isinstance(rle["counts"], list):
+        counts = rle["counts"]
+        return {"size": _size(rle), "counts": counts.encode("ascii") if isinstance(counts, str) else bytes(counts)}
+    return {"size": _size(rle), "counts": counts_to_string(rle["counts"])}
+
+
+def decompress(rle):
+    """
+    COCO RLE (compressed or uncompressed) -> uncompressed RLE with list counts.
+    """
+    return {"size": _size(rle), "counts": coco_counts(rle).tolist()}
+
+
+def to_compressed(segm, height=None, width=None):
+    """
+    Any COCO segmentation (polygons, uncompressed or compressed RLE) -> compressed RLE.
+    Only polygons need height / width, they are rasterized by pycocotools.
+    """
+    if isinstance(segm, list):
+        return mask_util.merge(mask_util.frPyObjects(segm, height, width))
+    return compress(segm)
+
+
+def kaggle_to_coco(rle, shape, compressed=True):
+    """
+    Kaggle "start length" string (row by row, 1-based) -> COCO RLE (column by column).
+    """
+    starts, lengths, _ = parse_kaggle_rles([rle])
+    starts, lengths = reorder_runs(starts, lengths, shape, 'C', 'F')
+    counts = runs_to_counts(starts, lengths, shape[0] * shape[1])
+    if compressed:
+        return {"size": list(shape), "counts": counts_to_string(counts)}
+    return {"size": list(shape), "counts": counts.tolist()}
+
+
+def coco_to_kaggle(rle):
+    """
+    COCO RLE (compressed or uncompressed) -> Kaggle "start length" string.
+    """
+    starts, lengths = counts_to_runs(coco_counts(rle))
+    starts, lengths = reorder_runs(starts, lengths, _size(rle), 'F', 'C')
+    return ' '.join(np.stack([starts + 1, lengths], axis=1).ravel().astype(str).tolist())
+
+
+def area(rle):
+    """
+    Foreground pixels of a COCO RLE, from the counts only.
+    """
+    return int(coco_counts(rle)[1::2].sum())
+
+
+###########################################################################################################################################################
+# 标注文件的批量校验
+def _verify_chunk(annotations):
+    problems = []
+    for ann_id, segm, height, width, bbox, ann_area in annotations:
+        try:
+            rle = to_compressed(segm, height, width)
+            counts = coco_counts(rle)
+            if int(counts.sum()) != height * width or tuple(rle["size"]) != (height, width):
+                problems.append((ann_id, "size"))
+                continue
+            if counts_to_string(counts) != rle["counts"]:
+                problems.append((ann_id, "compressed <-> uncompressed"))
+            if mask_util.frPyObjects(decompress(rle), height, width)["counts"] != rle["counts"]:
+                problems.append((ann_id, "differs from pycocotools"))
+            if kaggle_to_coco(coco_to_kaggle(rle), (height, width))["counts"] != rle["counts"]:
+                problems.append((ann_id, "coco <-> kaggle"))
+            if not isinstance(segm, list):
+                if ann_area is not None and int(round(ann_area)) != area(rle):
+                    problems.append((ann_id, "area"))
+                # 未压缩 RLE 若按行 (C 顺序) 写出, bbox 会对不上
+                if bbox is not None and np.abs(np.asarray(bbox) - mask_util.toBbox(rle)).max() > 1:
+                    problems.append((ann_id, "bbox"))
+        except Exception as e:
+            problems.append((ann_id, "error: {}".format(e)))
+    return problems
+
+
+def _annotation_jobs(dataset, chunk_size):
+    sizes = {img["id"]: (img["height"], img["width"]) for img in dataset["images"]}
+    rows = [(ann.get("id"), ann["segmentation"]) + sizes[ann["image_id"]] + (ann.get("bbox"), ann.get("area"))
+            for ann in dataset.get("annotations", [])]
+    return [(rows[start:start + chunk_size],) for start in range(0, len(rows), chunk_size)]
+
+
+def verify_json(json_file, num_workers=0, chunk_size=512, verbose=1):
+    """
+    Round-trips every annotation of a COCO file through all the formats
+    (compressed <-> uncompressed <-> Kaggle, and against pycocotools) and checks its area / bbox.
+
+    Returns:
+        list of tuple: (annotation id, problem), empty when the whole file is lossless.
+    """
+    with open(json_file, "r") as f:
+        dataset = json.load(f)
+    jobs = _annotation_jobs(dataset, chunk_size)
+    problems = [p for chunk in ScorePool(num_workers, chunk_size=1).imap(_verify_chunk, jobs) for p in chunk]
+    if verbose:
+        print("{}: {} annotations, {} problems".format(json_file, len(dataset.get("annotations", [])), len(problems)))
+        for ann_id, problem in problems[:20]:
+            print("    annotation {}: {}".format(ann_id, problem))
+    return problems
+
+
+def _compare_chunk(pairs):
+    different = []
+    for ann_id, segm_a, segm_b, height, width in pairs:
+        runs_a = counts_to_runs(coco_counts(to_compressed(segm_a, height, width)))
+        runs_b = counts_to_runs(coco_counts(to_compressed(segm_b, height, width)))
+        if not (np.array_equal(runs_a[0], runs_b[0]) and np.array_equal(runs_a[1], runs_b[1])):
+            different.append(ann_id)
+    return different
+
+
+def compare_json(json_a, json_b, num_workers=0, chunk_size=512, verbose=1):
+    """
+    Compares the masks of two annotation files of the same split (e.g. bie's uncompressed file
+    and the compressed one), instances are matched by annotation id.
+
+    Returns:
+        list: ids of the annotations whose masks differ, or that are missing from one of the files.
+    """
+    with open(json_a, "r") as f:
+        dataset_a = json.load(f)
+    with open(json_b, "r") as f:
+        dataset_b = json.load(f)
+    sizes = {img["id"]: (img["height"], img["width"]) for img in dataset_a["images"]}
+    anns_b = {ann["id"]: ann for ann in dataset_b.get("annotations", [])}
+    missing = set(anns_b) ^ {ann["id"] for ann in dataset_a.get("annotations", [])}
+    rows = [(ann["id"], ann["segmentation"], anns_b[ann["id"]]["segmentation"]) + sizes[ann["image_id"]]
+            for ann in dataset_a.get("annotations", []) if ann["id"] in anns_b]
+    jobs = [(rows[start:start + chunk_size],) for start in range(0, len(rows), chunk_size)]
+    different = [i for chunk in ScorePool(num_workers, chunk_size=1).imap(_compare_chunk, jobs) for i in chunk]
+    if verbose:
+        print("{} annotations compared, {} differ, {} missing".format(len(rows), len(different), len(missing)))
+    return sorted(different) + sorted(missing)
+
+
+###########################################################################################################################################################
+# 基准测试: 与经过整图 mask 的转换对比  python -m toolbox.rle_box.rle_codec
+def benchmark(n=300, seed=3407):
+    import os
+    import shutil
+    import tempfile
+
+    from toolbox.metric_box.sparse_iou import _random_cells
+
+    masks = _random_cells(n, seed=seed)
+    shape = masks.shape[1:]
+    coco = mask_util.encode(np.asfortranarray(masks.transpose(1, 2, 0).astype(np.uint8)))
+    kaggle = encode_kaggle_rles(masks)
+
+    start = time.perf_counter()
+    dense_kaggle = encode_kaggle_rles(mask_util.decode(coco).transpose(2, 0, 1))
+    dense_coco = mask_util.encode(np.asfortranarray(decode_kaggle_rles(kaggle, shape).transpose(1, 2, 0)))
+    t_dense = time.perf_counter() - start
+
+    start = time.perf_counter()
+    run_kaggle = [coco_to_kaggle(rle) for rle in coco]
+    run_coco = [kaggle_to_coco(rle, shape) for rle in kaggle]
+    t_runs = time.perf_counter() - start
+
+    assert run_kaggle == dense_kaggle == kaggle
+    assert [r["counts"] for r in run_coco] == [r["counts"] for r in dense_coco] == [r["counts"] for r in coco]
+    for rle in coco:
+        assert string_to_counts(rle["counts"]).tolist() == decompress(rle)["counts"]
+        assert mask_util.frPyObjects(decompress(rle), *shape)["counts"] == rle["counts"]
+        assert area(rle) == mask_util.area(rle)
+    labels = decode_kaggle_labels(kaggle, shape)
+    assert labels.max() == n
+    print("{} instances".format(n))
+    print("coco <-> kaggle through dense masks : {:8.2f} ms".format(t_dense * 1e3))
+    print("coco <-> kaggle on runs             : {:8.2f} ms  (x{:.1f})".format(t_runs * 1e3, t_dense / t_runs))
+
+    tmp = tempfile.mkdtemp()
+    json_file = os.path.join(tmp, "val.json")
+    annotations = []
+    for k, rle in enumerate(coco):
+        # 一半写成未压缩 RLE, 一半写成压缩 RLE
+        segm = decompress(rle) if k % 2 else {"size": rle["size"], "counts": rle["counts"].decode("ascii")}
+        annotations.append({"id": k, "image_id": 0, "segmentation": segm, "area": area(rle),
+                            "bbox": mask_util.toBbox(rle).tolist(), "category_id": 1, "iscrowd": 0})
+    # 按行写出的未压缩 RLE (常见错误), 校验应当发现
+    starts, lengths, _ = parse_kaggle_rles([coco_to_kaggle(coco[0])])
+    bad = {"size": list(shape), "counts": runs_to_counts(starts, lengths, shape[0] * shape[1]).tolist()}
+    annotations.append({"id": n, "image_id": 0, "segmentation": bad, "area": area(coco[0]),
+                        "bbox": mask_util.toBbox(coco[0]).tolist(), "category_id": 1, "iscrowd": 0})
+    with open(json_file, "w") as f:
+        json.dump({"images": [{"id": 0, "height": shape[0], "width": shape[1]}], "annotations": annotations,
+                   "categories": [{"id": 1, "name": "cell"}]}, f)
+    start = time.perf_counter()
+    problems = verify_json(json_file, num_workers=2, chunk_size=64)
+    t_verify = time.perf_counter() - start
+    assert [p[0] for p in problems] == [n], problems
+    print("verify {} annotations                : {:8.2f} ms".format(len(annotations), t_verify * 1e3))
+    shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-#
+# -------------------------------------------------------------------------------
+# Name:         rle_ops
+# Description:  直接在游程上做 mask 的集合运算 (面积 / 交 / 并 / 差 / 去除与之前 mask 的重叠), 不解码成稠密数组
+#               torchvision 脚本的 remove_overlapping_pixels 对每个新 mask 都和之前所有 mask 做一次 520x704 的 logical_and,
+#               一张图几百个预测就是 O(N^2) 次整图运算; detectron2 脚本的 MIN_PIXELS 过滤对每个稠密 mask 调一次 mask.sum()。
+#               这里把一张图的全部实例存成 InstanceRuns (按实例分组的游程), 面积是游程长度之和,
+#               去重叠是一次扫描: 所有游程的端点把像素轴切成基本区间, 每个基本区间归属覆盖它的最早的实例,
+#               开销只与游程数有关, 与像素数无关; 结果可以直接输出 COCO RLE / Kaggle RLE, 后处理全程不需要稠密 mask
+# Author:       Administrator
+# Date:         2021/12/31
+# -------------------------------------------------------------------------------
+import time
+
+import numpy as np
+
+from toolbox.rle_box.kaggle_rle import _foreground, _pixels, _to_c_order, format_kaggle_rles, parse_kaggle_rles
+from toolbox.rle_box.rle_codec import _merge_runs, coco_counts, counts_to_runs, counts_to_string, runs_to_counts
+
+
+###########################################################################################################################################################
+# 单个 mask 的游程 (starts, lengths): 已排序、互不重叠, 两个操作数的像素编号顺序 ('C' / 'F') 必须一致
+def coco_runs(rle):
+    """
+    Runs (0-based starts, lengths) of a COCO RLE, compressed or not, pixels numbered column by column.
+    """
+    return counts_to_runs(coco_counts(rle))
+
+
+def _inside(starts, lengths, points):
+    # 每个点是否落在某个游程内
+    i = np.searchsorted(starts, points, side='right') - 1
+    inside = i >= 0
+    inside[inside] = points[inside] < starts[i[inside]] + lengths[i[inside]]
+    return inside
+
+
+def _combine(a, b, op):
+    a_starts, a_lengths = np.asarray(a[0], dtype=np.int64), np.asarray(a[1], dtype=np.int64)
+    b_starts, b_lengths = np.asarray(b[0], dtype=np.int64), np.asarray(b[1], dtype=np.int64)
+    # 两组游程的全部端点切出基本区间, 每个基本区间要么整个在 mask 内, 要么整个在外
+    bounds = np.unique(np.concatenate([a_starts, a_starts + a_lengths, b_starts, b_starts + b_lengths]))
+    if len(bounds) < 2:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    points = bounds[:-1]
+    keep = op(_inside(a_starts, a_lengths, points), _inside(b_starts, b_lengths, points))
+    return _merge_runs(points[keep], np.diff(bounds)[keep])
+
+
+def intersection(a, b):
+    """
+    Args:
+        a, b (tuple): (starts, lengths) runs of two masks.
+
+    Returns:
+        tuple: (starts, lengths) runs of a & b.
+    """
+    return _combine(a, b, np.logical_and)
+
+
+def union(a, b):
+    """ Runs of a | b, see intersection. """
+    return _combine(a, b, np.logical_or)
+
+
+def difference(a, b):
+    """ Runs of a & ~b, see intersection. """
+    return _combine(a, b, lambda x, y: x & ~y)
+
+
+def area(runs):
+    """ Number of pixels of (starts, lengths) runs. """
+    return int(np.sum(runs[1]))
+
+
+def intersection_area(a, b):
+    return area(intersection(a, b))
+
+
+###########################################################################################################################################################
+class InstanceRuns:
+    """
+    Every instance mask of an image as runs of foreground pixels.
+
+    Attributes:
+        starts, lengths (np array [R]): 0-based runs grouped by instance, sorted and merged inside every instance.
+        n_runs (np array [N]): number of runs of every instance.
+        shape (tuple): (height, width).
+        order (str): 'F' pixels numbered column by column (COCO), 'C' row by row (Kaggle).
+    """
+
+    def __init__(self, starts, lengths, n_runs, shape, order='F'):
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.n_runs = np.asarray(n_runs, dtype=np.int64)
+        self.shape = tuple(int(x) for x in shape)
+        self.order = order
+
+    def __len__(self):
+        return len(self.n_runs)
+
+    @property
+    def ids(self):
+        """ Instance of every run. """
+        return np.repeat(np.arange(len(self.n_runs)), self.n_runs)
+
+    @property
+    def offsets(self):
+        offsets = np.zeros(len(self.n_runs) + 1, dtype=np.int64)
+        np.cumsum(self.n_runs, out=offsets[1:])
+        return offsets
+
+    def runs(self, i):
+        """ (starts, lengths) of instance i. """
+        a, b = self.offsets[i:i + 2]
+        return self.starts[a:b], self.lengths[a:b]
+
+    @classmethod
+    def from_dense(cls, masks, order='F'):
+        """
+        Args:
+            masks (np array or torch tensor [N x H x W]): binary masks, torch tensors may stay on the model device,
+                only the foreground indices are copied back.
+            order (str): pixel numbering of the runs.
+        """
+        n, height, width = masks.shape
+        size = height * width
+        fg = _foreground(masks, order)
+        inst = fg // size
+        first = np.ones(len(fg), dtype=bool)
+        first[1:] = (np.diff(fg) != 1) | (inst[1:] != inst[:-1])
+        run_first = np.flatnonzero(first)
+        lengths = np.diff(np.append(run_first, len(fg)))
+        starts = fg[run_first] - inst[run_first] * size
+        return cls(starts, lengths, np.bincount(inst[run_first], minlength=n), (height, width), order)
+
+    @classmethod
+    def from_coco(cls, rles, shape=None):
+        """
+        Args:
+            rles (list of dict): COCO RLEs, compressed or not.
+            shape (tuple, optional): (height, width), only used when rles is empty.
+        """
+        runs = [coco_runs(rle) for rle in rles]
+        if rles:
+            shape = tuple(rles[0]["size"])
+        starts = np.concatenate([r[0] for r in runs]) if runs else np.zeros(0, dtype=np.int64)
+        lengths = np.concatenate([r[1] for r in runs]) if runs else np.zeros(0, dtype=np.int64)
+        return cls(starts, lengths, [len(r[0]) for r in runs], shape, 'F')
+
+    @classmethod
+    def from_kaggle(cls, rles, shape):
+        """
+        Args:
+            rles (list of str): Kaggle RLE strings (runs must not overlap inside a string).
+            shape (tuple): (height, width).
+        """
+        starts, lengths, n_runs = parse_kaggle_rles(rles)
+        # 同一个实例内部按位置排序
+        ids = np.repeat(np.arange(len(n_runs)), n_runs)
+        order = np.lexsort((starts, ids))
+        return cls(starts[order], lengths[order], n_runs, shape, 'C')
+
+    def areas(self):
+        """ Number of pixels of every instance, the run-length counterpart of masks.sum((1, 2)). """
+        return np.bincount(self.ids, weights=self.lengths, minlength=len(self)).astype(np.int64)
+
+    def select(self, keep):
+        """
+        Args:
+            keep (np array): bool mask or indices of the instances to keep, in the new order.
+        """
+        keep = np.asarray(keep)
+        keep = np.flatnonzero(keep) if keep.dtype == bool else keep.astype(np.int64)
+        counts = self.n_runs[keep]
+        run_first = np.cumsum(counts) - counts
+        index = np.repeat(self.offsets[keep] - run_first, counts) + np.arange(int(counts.sum()))
+        return InstanceRuns(self.starts[index], self.lengths[index], counts, self.shape, self.order)
+
+    def remove_overlaps(self, min_area=0):
+        """
+        Removes from every instance the union of all previous instances in one sweep,
+        the run-length counterpart of calling remove_overlapping_pixels on the masks in order.
+
+        Args:
+            min_area (int or np array [N]): instances left with fewer pixels are dropped and do not cover later ones,
+                like the `mask * (1 - used)` / MIN_PIXELS loop of the submission notebooks.
+
+        Returns:
+            InstanceRuns: instances in the same order, dropped or empty ones keep zero runs.
+        """
+        n = len(self)
+        empty = InstanceRuns(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(n, dtype=np.int64),
+                             self.shape, self.order)
+        if len(self.starts) == 0:
+            return empty
+        ends = self.starts + self.lengths
+        bounds = np.unique(np.concatenate([self.starts, ends]))
+        first_seg = np.searchsorted(bounds, self.starts)
+        n_seg = np.searchsorted(bounds, ends) - first_seg
+        # 每个游程展开成它覆盖的基本区间, 已按 (实例, 位置) 排列
+        seg = np.repeat(first_seg - (np.cumsum(n_seg) - n_seg), n_seg) + np.arange(int(n_seg.sum()))
+        owner = np.repeat(self.ids, n_seg)
+        if np.any(np.asarray(min_area) > 0):
+            # 是否保留取决于之前保留了哪些实例, 只能按顺序处理, 但每个实例只看它自己的基本区间
+            min_area = np.broadcast_to(min_area, (n,))
+            seg_lengths = np.diff(bounds)
+            used = np.zeros(len(bounds) - 1, dtype=bool)
+            keep = np.zeros(len(seg), dtype=bool)
+            seg_offsets = np.r_[0, np.cumsum(np.bincount(owner, minlength=n))]
+            for i, (a, b) in enumerate(zip(seg_offsets[:-1], seg_offsets[1:])):
+                free = ~used[seg[a:b]]
+                if seg_lengths[seg[a:b][free]].sum() >= min_area[i]:
+                    used[seg[a:b]] = True
+                    keep[a:b] = free
+            seg, owner = seg[keep], owner[keep]
+        else:
+            # 每个基本区间只保留最早的实例, 再按 (实例, 位置) 重新排列
+            order = np.lexsort((owner, seg))
+            seg, owner = seg[order], owner[order]
+            first = np.r_[True, seg[1:] != seg[:-1]]
+            seg, owner = seg[first], owner[first]
+            order = np.lexsort((seg, owner))
+            seg, owner = seg[order], owner[order]
+        if len(seg) == 0:
+            return empty
+        starts, lengths = bounds[seg], bounds[seg + 1] - bounds[seg]
+        # 同一实例中首尾相接的基本区间合并成一个游程
+        join = (owner[1:] == owner[:-1]) & (starts[1:] == starts[:-1] + lengths[:-1])
+        run_first = np.flatnonzero(np.r_[True, ~join])
+        return InstanceRuns(starts[run_first], np.add.reduceat(lengths, run_first),
+                            np.bincount(owner[run_first], minlength=n), self.shape, self.order)
+
+    def reorder(self, order):
+        """ Same instances with the pixels numbered in the other order ('C' <-> 'F'). """
+        if order == self.order:
+            return self
+        height, width = self.shape
+        size = height * width
+        ids, pixels = _pixels(self.starts, self.lengths, self.n_runs)
+        if self.order == 'C':
+            pixels = (pixels % width) * height + pixels // width
+        else:
+            pixels = (pixels % height) * width + pixels // height
+        fg = np.sort(ids * size + pixels)
+        inst = fg // size
+        first = np.ones(len(fg), dtype=bool)
+        first[1:] = (np.diff(fg) != 1) | (inst[1:] != inst[:-1])
+        run_first = np.flatnonzero(first)
+        lengths = np.diff(np.append(run_first, len(fg)))
+        return InstanceRuns(fg[run_first] - inst[run_first] * size, lengths,
+                            np.bincount(inst[run_first], minlength=len(self)), self.shape, order)
+
+    def to_coco(self):
+        """
+        Returns:
+            list of dict: compressed COCO RLEs ({"size", "counts" bytes}), same as mask_util.encode.
+        """
+        runs = self.reorder('F')
+        size = self.shape[0] * self.shape[1]
+        offsets = runs.offsets
+        return [{"size": list(self.shape),
+                 "counts": counts_to_string(runs_to_counts(runs.starts[a:b], runs.lengths[a:b], size))}
+                for a, b in zip(offsets[:-1], offsets[1:])]
+
+    def to_kaggle(self):
+        """
+        Returns:
+            list of str: Kaggle RLE strings ("" for an empty instance).
+        """
+        runs = self.reorder('C')
+        return format_kaggle_rles(runs.starts, runs.lengths, runs.n_runs)
+
+    def to_dense(self, dtype=bool):
+        """
+        Returns:
+            np array [N x H x W]
+        """
+        height, width = self.shape
+        ids, pixels = _pixels(self.starts, self.lengths, self.n_runs)
+        masks = np.zeros((len(self), height * width), dtype=dtype)
+        masks[ids, _to_c_order(pixels, self.shape, self.order)] = 1
+        return masks.reshape(len(self), height, width)
+
+
+###########################################################################################################################################################
+# 基准测试: 与 remove_overlapping_pixels 和稠密的 mask.sum() 对比  python -m toolbox.rle_box.rle_ops
+def _legacy_remove_overlapping_pixels(mask, other_masks):
+    for other_mask in other_masks:
+        if np.sum(np.logical_and(mask, other_mask)) > 0:
+            mask[np.logical_and(mask, other_mask)] = 0
+    return mask
+
+
+def benchmark(seed=3407, repeat=3):
+    import pycocotools.mask as mask_util
+
+    from toolbox.metric_box.sparse_iou import _random_cells
+
+    # 预测之间大量重叠: 一半是另一半平移几个像素
+    for n in (100, 300):
+        half = _random_cells(n // 2, seed=seed)
+        masks = np.concatenate([half, np.roll(half, 3, axis=2)])[np.random.RandomState(seed).permutation(n)]
+
+        start = time.perf_counter()
+        legacy = []
+        for mask in masks:
+            legacy.append(_legacy_remove_overlapping_pixels(mask.copy(), legacy))
+        legacy = np.asarray(legacy)
+        t_legacy = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            cleaned = InstanceRuns.from_dense(masks).remove_overlaps()
+        t_runs = (time.perf_counter() - start) / repeat
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            dense_areas = np.asarray([mask.sum() for mask in masks])
+        t_dense_area = (time.perf_counter() - start) / repeat
+
+        runs = InstanceRuns.from_dense(masks)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            run_areas = runs.areas()
+        t_run_area = (time.perf_counter() - start) / repeat
+
+        assert np.array_equal(cleaned.to_dense(), legacy)
+        assert np.array_equal(run_areas, dense_areas)
+        assert np.array_equal(cleaned.areas(), legacy.reshape(n, -1).sum(axis=1))
+        enc = mask_util.encode(np.asfortranarray(legacy.transpose(1, 2, 0).astype(np.uint8)))
+        assert [rle["counts"] for rle in cleaned.to_coco()] == [rle["counts"] for rle in enc]
+        kaggle = InstanceRuns.from_dense(masks, order='C').remove_overlaps().to_kaggle()
+        assert kaggle == cleaned.to_kaggle()
+        assert np.array_equal(InstanceRuns.from_kaggle(kaggle, masks.shape[1:]).to_dense(), legacy)
+        assert np.array_equal(InstanceRuns.from_coco(enc).select(np.arange(n)[::-1]).to_dense(), legacy[::-1])
+
+        # 两两集合运算与稠密结果对比
+        for i in range(0, n - 1, max(n // 50, 1)):
+            a, b = runs.runs(i), runs.runs(i + 1)
+            single = InstanceRuns(np.r_[a[0], b[0]], np.r_[a[1], b[1]], [len(a[0]), len(b[0])], runs.shape)
+            ma, mb = single.to_dense()
+            for op, dense in ((intersection, ma & mb), (union, ma | mb), (difference, ma & ~mb)):
+                starts, lengths = op(a, b)
+                assert np.array_equal(InstanceRuns(starts, lengths, [len(starts)], runs.shape).to_dense()[0], dense)
+            assert intersection_area(a, b) == np.count_nonzero(ma & mb)
+
+        print("{} overlapping masks".format(n))
+        print("remove_overlapping_pixels (dense) : {:8.2f} ms".format(t_legacy * 1e3))
+        print("encode + remove_overlaps (runs)   : {:8.2f} ms  (x{:.1f})".format(t_runs * 1e3, t_legacy / t_runs))
+        print("mask.sum() areas                  : {:8.2f} ms".format(t_dense_area * 1e3))
+        print("run-length areas                  : {:8.2f} ms  (x{:.1f})".format(t_run_area * 1e3,
+                                                                               t_dense_area / t_run_area))
+
+
+if __name__ == '__main__':
+    benchmark()